@@ -0,0 +1,241 @@
+"""
+In-process accounting and quotas for AI endpoints.
+
+Every AI call is attributed to a user and, when known, a barbershop. Counters
+(calls, errors, uploaded bytes, latency, cache hits) live in a dict and are
+flushed to Mongo in one unordered `bulk_write` per interval, so the hot path
+never waits on the database. Quotas combine a per-subject token bucket (burst
+control) with daily call limits checked against the flushed totals plus the
+calls this worker has admitted since, including those still in flight. Calls
+that fail upstream are given back with `release` and don't count against the
+daily limits.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+_COUNTER_FIELDS = ("calls", "errors", "bytes_in", "latency_ms", "cache_hits")
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `capacity`."""
+
+    rate: float
+    capacity: float
+    tokens: float = field(default=-1.0)
+    updated: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self) -> None:
+        if self.tokens < 0:
+            self.tokens = self.capacity
+
+    def try_acquire(self, amount: float = 1.0) -> float:
+        """Take `amount` tokens; returns 0 on success or the seconds to wait."""
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _seconds_until_midnight() -> float:
+    now = datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (tomorrow - now).total_seconds()
+
+
+class UsageTracker:
+    """Per-subject AI usage counters with batched persistence and quotas.
+
+    `subjects` are dicts like `{"user": "user_abc", "shop": "shop_xyz"}`;
+    `daily_limits` maps a subject scope to its maximum calls per UTC day
+    (0 disables the limit) and the token bucket applies to the first subject,
+    which should be one the caller can't choose freely (the client IP).
+    """
+
+    def __init__(
+        self,
+        collection,
+        daily_limits: Dict[str, int],
+        rate_per_minute: float,
+        burst: int,
+        max_buckets: int = 10000,
+    ):
+        self.collection = collection
+        self.daily_limits = daily_limits
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._pending: Dict[Tuple[str, str, str, str], Dict[str, float]] = {}
+        self._daily: Dict[Tuple[str, str, str], int] = {}
+        # Calls admitted by `check` but not recorded yet, so not in any flushed total.
+        self._in_flight: Dict[Tuple[str, str, str], int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def check(self, subjects: Dict[str, str]) -> None:
+        """Admit one upstream call or raise `QuotaExceeded`."""
+
+        if self.rate_per_second > 0 and subjects:
+            scope, subject_id = next(iter(subjects.items()))
+            key = f"{scope}:{subject_id}"
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._evict_full_buckets()
+                bucket = self._buckets[key] = TokenBucket(self.rate_per_second, self.burst)
+            wait = bucket.try_acquire()
+            if wait:
+                raise QuotaExceeded("rate", wait)
+
+        day = _today()
+        admitted: List[Tuple[str, str, str]] = []
+        for scope, subject_id in subjects.items():
+            limit = self.daily_limits.get(scope, 0)
+            if not limit:
+                continue
+            key = (scope, subject_id, day)
+            if key not in self._daily:
+                persisted = await self._persisted_calls(scope, subject_id, day)
+                # Another check may have loaded and incremented it during the await.
+                self._daily.setdefault(key, persisted + self._in_flight.get(key, 0))
+            if self._daily[key] >= limit:
+                for previous in admitted:
+                    self._daily[previous] -= 1
+                    self._in_flight[previous] -= 1
+                raise QuotaExceeded(f"daily_{scope}", _seconds_until_midnight())
+            self._daily[key] += 1
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            admitted.append(key)
+
+    def release(self, subjects: Dict[str, str]) -> None:
+        """Give back the daily quota taken by `check` for a call that failed upstream."""
+
+        day = _today()
+        for scope, subject_id in subjects.items():
+            key = (scope, subject_id, day)
+            if self.daily_limits.get(scope, 0) and self._daily.get(key, 0) > 0:
+                self._daily[key] -= 1
+
+    def record(
+        self,
+        subjects: Dict[str, str],
+        endpoint: str,
+        ok: bool,
+        latency: float,
+        bytes_in: int = 0,
+        cache_hit: bool = False,
+    ) -> None:
+        """Count a finished call; anything but a cache hit must have passed `check`."""
+
+        day = _today()
+        for scope, subject_id in subjects.items():
+            if not cache_hit and self._in_flight.get((scope, subject_id, day), 0) > 0:
+                self._in_flight[(scope, subject_id, day)] -= 1
+            counters = self._pending.setdefault((scope, subject_id, day, endpoint), dict.fromkeys(_COUNTER_FIELDS, 0))
+            counters["calls"] += 1
+            counters["errors"] += 0 if ok else 1
+            counters["bytes_in"] += bytes_in
+            counters["latency_ms"] += round(latency * 1000, 3)
+            counters["cache_hits"] += 1 if cache_hit else 0
+
+    async def flush(self) -> int:
+        """Write pending counters with a single bulk upsert; returns the docs touched."""
+
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"scope": scope, "scope_id": subject_id, "day": day, "endpoint": endpoint},
+                {"$inc": counters, "$set": {"updated_at": now}},
+                upsert=True,
+            )
+            for (scope, subject_id, day, endpoint), counters in pending.items()
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.warning(f"Could not flush AI usage counters: {e}")
+            for key, counters in pending.items():
+                merged = self._pending.setdefault(key, dict.fromkeys(_COUNTER_FIELDS, 0))
+                for name, value in counters.items():
+                    merged[name] += value
+            return 0
+
+        # Re-read daily totals on next check so other workers' calls count too.
+        today = _today()
+        flushed = {(scope, subject_id, day) for scope, subject_id, day, _ in pending}
+        self._daily = {key: value for key, value in self._daily.items() if key[2] == today and key not in flushed}
+        self._in_flight = {key: value for key, value in self._in_flight.items() if key[2] == today and value > 0}
+        return len(operations)
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def usage(self, scope: str, subject_id: str, day: Optional[str] = None) -> dict:
+        """Persisted plus pending usage for a subject on a given day."""
+
+        day = day or _today()
+        totals = {"scope": scope, "scope_id": subject_id, "day": day, "endpoints": {}}
+        async for doc in self.collection.find({"scope": scope, "scope_id": subject_id, "day": day}, {"_id": 0}):
+            totals["endpoints"][doc["endpoint"]] = {name: doc.get(name, 0) for name in _COUNTER_FIELDS}
+        for (p_scope, p_id, p_day, endpoint), counters in self._pending.items():
+            if (p_scope, p_id, p_day) != (scope, subject_id, day):
+                continue
+            merged = totals["endpoints"].setdefault(endpoint, dict.fromkeys(_COUNTER_FIELDS, 0))
+            for name, value in counters.items():
+                merged[name] += value
+        totals["calls"] = sum(item["calls"] for item in totals["endpoints"].values())
+        limit = self.daily_limits.get(scope, 0)
+        totals["daily_limit"] = limit or None
+        return totals
+
+    async def _persisted_calls(self, scope: str, subject_id: str, day: str) -> int:
+        cursor = self.collection.find(
+            {"scope": scope, "scope_id": subject_id, "day": day}, {"_id": 0, "calls": 1, "errors": 1, "cache_hits": 1}
+        )
+        total = 0
+        async for doc in cursor:
+            # Cache hits never reached the provider and errors were released, so neither uses quota.
+            total += doc.get("calls", 0) - doc.get("errors", 0) - doc.get("cache_hits", 0)
+        for (p_scope, p_id, p_day, _), counters in self._pending.items():
+            if (p_scope, p_id, p_day) == (scope, subject_id, day):
+                total += counters["calls"] - counters["errors"] - counters["cache_hits"]
+        return int(total)
+
+    def _evict_full_buckets(self) -> None:
+        now = time.monotonic()
+        idle = [
+            key for key, bucket in self._buckets.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity
+        ]
+        for key in idle or list(self._buckets)[: len(self._buckets) // 2]:
+            self._buckets.pop(key, None)
@@ -0,0 +1 @@
+"""Benchmarks and load tools for the backend. Run modules from `backend/` with `python -m benchmarks.<name>`."""
@@ -0,0 +1,393 @@
+"""
+Latency and throughput benchmark for the API hot paths.
+
+The FastAPI app runs in-process behind httpx's ASGI transport, so no uvicorn
+or sockets sit between the client and the handlers. It uses a throwaway
+database on a local MongoDB, the deterministic fake LLM (`AI_PROVIDER=fake`)
+and a stub Expo push server on localhost. The database is seeded from
+`--seed` (shops, barbers, services, clients with push tokens, past and
+upcoming appointments). Then each scenario is run `--requests` times by
+`--concurrency` workers:
+
+- book: POST /api/appointments
+- list: GET /api/appointments for a shop, 50 per page
+- dashboard: GET /api/dashboard/stats
+- reminders: POST /api/appointments/reminders/run, with reminders due
+- loyalty_earn: POST /api/loyalty/earn/appointment for completed appointments
+- ai_scan: POST /api/ai-scan, with the provider's result cache off
+
+Results (throughput, p50/p90/p99/max latency and errors per scenario) are
+printed and written as JSON. `--compare` prints the change against an
+earlier result file.
+
+    cd backend
+    docker run --rm -d -p 27017:27017 --tmpfs /data/db mongo:6
+    python -m benchmarks.api_bench --requests 500 --concurrency 8 --output before.json
+    python -m benchmarks.api_bench --requests 500 --concurrency 8 --compare before.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile; 0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    """Throughput and latency (ms) of one scenario run."""
+    total = len(latencies)
+    return {
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+    }
+
+
+class StubExpoServer:
+    """Accepts every Expo push request on localhost, in its own thread."""
+
+    def __init__(self):
+        self.received = 0
+        self.url = ""
+
+    async def app(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        while (await receive()).get("more_body"):
+            pass
+        self.received += 1
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"data":{"status":"ok","id":"stub"}}'})
+
+    def __enter__(self) -> "StubExpoServer":
+        import uvicorn
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}/--/api/v2/push/send"
+        self._server = uvicorn.Server(uvicorn.Config(self.app, interface="asgi3", lifespan="off", log_level="warning"))
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self._server.serve(sockets=[sock])), name="stub-expo", daemon=True
+        )
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def configure_environment(mongo_url: str, db_name: str, expo_url: str) -> None:
+    """Point the app at the benchmark database and stubs. Call before importing `server`."""
+    os.environ.update({
+        "MONGO_URL": mongo_url,
+        "DB_NAME": db_name,
+        "AI_PROVIDER": "fake",
+        "EXPO_PUSH_URL": expo_url,
+        # Measure the scan itself, not quotas or the result cache.
+        "AI_RATE_PER_MINUTE": "0",
+        "AI_DAILY_QUOTA_PER_IP": "0",
+        "AI_DAILY_QUOTA_PER_USER": "0",
+        "AI_DAILY_QUOTA_PER_SHOP": "0",
+        "AI_RESULT_CACHE_SECONDS": "0",
+    })
+
+
+def _id(rng: random.Random, prefix: str) -> str:
+    return f"{prefix}_{rng.getrandbits(48):012x}"
+
+
+def _face_image(rng: random.Random) -> str:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (256, 256), tuple(rng.randrange(256) for _ in range(3))).save(buffer, format="JPEG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@dataclass
+class Fixtures:
+    shops: List[str] = field(default_factory=list)
+    staff: Dict[str, List[tuple]] = field(default_factory=dict)  # shop_id -> [(barber_id, service_id)]
+    clients: List[str] = field(default_factory=list)
+    completed: List[str] = field(default_factory=list)
+    images: List[str] = field(default_factory=list)
+
+
+async def seed(server, rng: random.Random, shops: int, clients: int, appointments: int, due_reminders: int) -> Fixtures:
+    """Insert a reproducible data set through the app's own models."""
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    fixtures = Fixtures()
+    docs: Dict[str, list] = {name: [] for name in ("users", "barbershops", "barbers", "services", "push_tokens", "appointments")}
+
+    for index in range(clients):
+        user = server.User(user_id=_id(rng, "user"), email=f"client{index}@example.com", name=f"Cliente {index}")
+        docs["users"].append(user.dict())
+        docs["push_tokens"].append(server.PushToken(
+            user_id=user.user_id, token=f"ExponentPushToken[{rng.getrandbits(64):016x}]", platform="android"
+        ).dict())
+        fixtures.clients.append(user.user_id)
+
+    for index in range(shops):
+        owner = server.User(user_id=_id(rng, "user"), email=f"owner{index}@example.com", name=f"Dueño {index}", role="barber")
+        shop = server.Barbershop(
+            shop_id=_id(rng, "shop"), owner_user_id=owner.user_id, name=f"Barbería {index}",
+            address=f"Calle {index}", phone="5550000", capacity=4,
+        )
+        docs["users"].append(owner.dict())
+        docs["barbershops"].append(shop.dict())
+        fixtures.shops.append(shop.shop_id)
+        barbers = [server.Barber(barber_id=_id(rng, "barber"), shop_id=shop.shop_id, user_id=owner.user_id) for _ in range(4)]
+        services = [
+            server.Service(service_id=_id(rng, "service"), shop_id=shop.shop_id, name=f"Servicio {n}",
+                           price=rng.choice([150, 200, 250, 300]), duration=rng.choice([30, 45, 60]))
+            for n in range(5)
+        ]
+        docs["barbers"] += [barber.dict() for barber in barbers]
+        docs["services"] += [service.dict() for service in services]
+        fixtures.staff[shop.shop_id] = [(barber.barber_id, service.service_id) for barber in barbers for service in services]
+
+    def appointment(when: datetime, status: str) -> dict:
+        shop_id = rng.choice(fixtures.shops)
+        barber_id, service_id = rng.choice(fixtures.staff[shop_id])
+        return server.Appointment(
+            appointment_id=_id(rng, "appt"), shop_id=shop_id, barber_id=barber_id,
+            client_user_id=rng.choice(fixtures.clients), service_id=service_id,
+            scheduled_time=when, status=status,
+        ).dict()
+
+    for _ in range(appointments):
+        when = now + timedelta(minutes=rng.randrange(-60 * 24 * 60, 60 * 24 * 7, 15))
+        if when < now:
+            status = rng.choices(["completed", "cancelled", "scheduled"], weights=[8, 1, 1])[0]
+        else:
+            status = rng.choice(["scheduled", "confirmed"])
+        doc = appointment(when, status)
+        docs["appointments"].append(doc)
+        if status == "completed":
+            fixtures.completed.append(doc["appointment_id"])
+    # Inside the 24h reminder window for the whole run.
+    for _ in range(due_reminders):
+        docs["appointments"].append(appointment(now + timedelta(hours=24, minutes=rng.randrange(-10, 10)), "scheduled"))
+
+    for name, items in docs.items():
+        if items:
+            await server.db[name].insert_many(items, ordered=False)
+    fixtures.images = [_face_image(rng) for _ in range(32)]
+    return fixtures
+
+
+@dataclass
+class Scenario:
+    name: str
+    request: Callable[[httpx.AsyncClient, random.Random, int], Awaitable[httpx.Response]]
+    prepare: Optional[Callable[[], Awaitable[None]]] = None  # untimed, before each request
+
+
+def build_scenarios(server, fixtures: Fixtures) -> Dict[str, Scenario]:
+    def booking_payload(rng: random.Random) -> dict:
+        shop_id = rng.choice(fixtures.shops)
+        barber_id, service_id = rng.choice(fixtures.staff[shop_id])
+        when = datetime.now(timezone.utc) + timedelta(days=rng.randint(1, 30), minutes=rng.randrange(0, 600, 15))
+        return {"shop_id": shop_id, "barber_id": barber_id, "client_user_id": rng.choice(fixtures.clients),
+                "service_id": service_id, "scheduled_time": when.isoformat()}
+
+    async def book(client, rng, index):
+        return await client.post("/api/appointments", json=booking_payload(rng))
+
+    async def list_appointments(client, rng, index):
+        return await client.get("/api/appointments", params={"shop_id": rng.choice(fixtures.shops), "limit": 50})
+
+    async def dashboard(client, rng, index):
+        return await client.get("/api/dashboard/stats", params={"shop_id": rng.choice(fixtures.shops)})
+
+    async def reset_reminders():
+        await server.db.appointments.update_many(
+            {"reminder_24h_sent": True, "status": "scheduled"},
+            {"$set": {"reminder_24h_sent": False, "reminder_sent": False}},
+        )
+
+    async def reminders(client, rng, index):
+        return await client.post("/api/appointments/reminders/run")
+
+    async def loyalty_earn(client, rng, index):
+        # Past the end of the list appointments repeat and take the "already earned" path.
+        appointment_id = fixtures.completed[index % len(fixtures.completed)]
+        return await client.post("/api/loyalty/earn/appointment", json={"appointment_id": appointment_id})
+
+    async def ai_scan(client, rng, index):
+        return await client.post("/api/ai-scan", json={
+            "image_base64": rng.choice(fixtures.images),
+            "user_id": rng.choice(fixtures.clients),
+            "shop_id": rng.choice(fixtures.shops),
+        })
+
+    return {scenario.name: scenario for scenario in (
+        Scenario("book", book),
+        Scenario("list", list_appointments),
+        Scenario("dashboard", dashboard),
+        Scenario("reminders", reminders, prepare=reset_reminders),
+        Scenario("loyalty_earn", loyalty_earn),
+        Scenario("ai_scan", ai_scan),
+    )}
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, seed: int, start: int = 0
+) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(start, start + requests))
+    lock = asyncio.Lock()
+
+    async def worker(worker_id: int):
+        nonlocal errors
+        rng = random.Random(f"{seed}-{scenario.name}-{worker_id}")
+        for index in counter:
+            if scenario.prepare is not None:
+                # Scenarios with a prepare step run one request at a time.
+                async with lock:
+                    await scenario.prepare()
+                    errors += await _timed(client, scenario, rng, index, latencies)
+            else:
+                errors += await _timed(client, scenario, rng, index, latencies)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def _timed(client, scenario: Scenario, rng: random.Random, index: int, latencies: List[float]) -> int:
+    started = time.perf_counter()
+    try:
+        response = await scenario.request(client, rng, index)
+        failed = response.status_code >= 400
+    except Exception:
+        failed = True
+    latencies.append(time.perf_counter() - started)
+    return int(failed)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict) -> List[str]:
+    lines = [f"{'scenario':<14}{'rps':>18}{'p50 ms':>20}{'p99 ms':>20}"]
+    for name, current in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ("throughput_rps", "p50_ms", "p99_ms"):
+            change = (current[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            cells.append(f"{before[key]:>8} → {current[key]:<8}{change:+.0f}%".rjust(20))
+        lines.append(f"{name:<14}" + "".join(cells))
+    return lines
+
+
+async def run(args) -> dict:
+    import server
+
+    rng = random.Random(args.seed)
+    await server.ensure_indexes()
+    fixtures = await seed(server, rng, args.shops, args.clients, args.appointments, args.due_reminders)
+    scenarios = build_scenarios(server, fixtures)
+    selected = args.scenarios or list(scenarios)
+
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            for name in selected:
+                scenario = scenarios[name]
+                await run_scenario(client, scenario, args.warmup, args.concurrency, args.seed)
+                results[name] = await run_scenario(client, scenario, args.requests, args.concurrency, args.seed, args.warmup)
+                print(f"{name}: {results[name]}", flush=True)
+    finally:
+        await server.usage_tracker.flush()
+        if not args.keep_db:
+            await server.client.drop_database(args.db_name)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("BENCH_MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=f"bench_{os.getpid()}")
+    parser.add_argument("--keep-db", action="store_true", help="don't drop the benchmark database afterwards")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--shops", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--appointments", type=int, default=5000)
+    parser.add_argument("--due-reminders", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenarios", nargs="*", choices=["book", "list", "dashboard", "reminders", "loyalty_earn", "ai_scan"])
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path, help="earlier result file to diff against")
+    args = parser.parse_args()
+
+    with StubExpoServer() as expo:
+        configure_environment(args.mongo_url, args.db_name, expo.url)
+        scenarios = asyncio.run(run(args))
+        pushes = expo.received
+
+    report = {
+        "benchmark": "api",
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "dataset": {"shops": args.shops, "clients": args.clients, "appointments": args.appointments,
+                    "due_reminders": args.due_reminders},
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "pushes_sent": pushes,
+        "scenarios": scenarios,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    print(output)
+    if args.compare:
+        print("\n".join(compare(report, json.loads(args.compare.read_text(encoding="utf-8")))))
+
+
+if __name__ == "__main__":
+    main()
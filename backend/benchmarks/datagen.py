@@ -0,0 +1,559 @@
+"""
+Synthetic data generator for production-scale datasets.
+
+Fills a MongoDB database with users, barbershops, barbers, services, push
+tokens, appointments (with deposits), client logs and loyalty wallets, shaped
+like the documents the API writes:
+
+    cd backend
+    python -m benchmarks.datagen --db-name barbershop_synthetic --shops 1000 \\
+        --clients 500000 --appointments 10000000 --processes 8
+
+Every collection is cut into chunks of `--chunk` documents and the chunks are
+spread over `--processes` worker processes, each inserting with unordered
+`insert_many` batches. Ids are a bijection of the document's index, salted
+with the seed, and each chunk draws from its own seeded RNG. So the data only
+depends on `--seed`, the scale options and `--anchor` (the "today" the time
+distributions are centred on; today UTC by default, resolved once at start
+and passed to every worker), not on the number of processes or the order the
+chunks run in.
+
+The distributions are simple but not flat:
+
+- Shop popularity is log-normal, and a tenth of the clients are regulars who
+  book a third of the appointments.
+- Days are weighted by weekday (busy Fridays and Saturdays, quiet Sundays)
+  and hours peak after work. Booking volume drops off further into the future.
+- Past appointments are mostly completed, some cancelled. Future ones are
+  scheduled or confirmed.
+
+Wallets are derived at the end from the completed appointments with one
+aggregation, using the default rules: 10 points per completed appointment,
+and 50 for the referrer when a referred client completes their first one. No other indexes are built:
+loading into unindexed collections is much faster, and the app creates its
+indexes on startup.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import json
+import multiprocessing
+import random
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import ASCENDING, MongoClient
+
+# (name, base price, minutes); service j of every shop is SERVICE_CATALOG[j]
+SERVICE_CATALOG = [
+    ("Corte clásico", 180, 30),
+    ("Fade", 220, 45),
+    ("Barba", 120, 20),
+    ("Corte y barba", 300, 60),
+    ("Diseño", 250, 45),
+    ("Corte infantil", 150, 30),
+    ("Tinte", 450, 90),
+    ("Tratamiento capilar", 350, 45),
+]
+WEEKDAY_WEIGHTS = (0.8, 0.9, 1.0, 1.1, 1.5, 1.7, 0.3)  # Monday first
+HOUR_WEIGHTS = {9: 4, 10: 6, 11: 7, 12: 6, 13: 5, 14: 5, 15: 6, 16: 8, 17: 10, 18: 10, 19: 7}
+POINTS_PER_COMPLETED_APPOINTMENT = 10
+REFERRAL_BONUS = 50
+LOG_MESSAGES = [
+    ("error", "Network request failed", "BookingScreen"),
+    ("error", "Unhandled promise rejection: timeout", "ScanScreen"),
+    ("error", "Image upload failed", "ProfileScreen"),
+    ("warn", "Slow render detected", "ScheduleScreen"),
+    ("warn", "Push token refresh failed", "HomeScreen"),
+    ("info", "Session restored", "HomeScreen"),
+]
+LOG_LEVEL_WEIGHTS = (25, 15, 10, 25, 10, 15)
+
+COLLECTIONS = ("users", "barbershops", "barbers", "services", "push_tokens", "appointments", "deposits", "client_logs")
+
+
+def scramble(index: int, salt: int, bits: int = 48) -> int:
+    """A salted bijection of [0, 2**bits): unique ids that don't look sequential."""
+    mask = (1 << bits) - 1
+    return (index * 0x9E3779B97F4B + salt) & mask
+
+
+@dataclass
+class Scale:
+    seed: int = 1234
+    anchor: str = ""  # ISO date; midnight UTC of this day is "now" (main() fills in today)
+    shops: int = 100
+    barbers_per_shop: int = 4
+    services_per_shop: int = 6
+    clients: int = 20000
+    appointments: int = 500000
+    client_logs: int = 50000
+    days_back: int = 365
+    days_ahead: int = 60
+    deposit_rate: float = 0.15
+    referral_rate: float = 0.1
+    chunk: int = 50000
+    batch: int = 5000
+
+    @property
+    def users(self) -> int:
+        return self.clients + self.shops + self.shops * self.barbers_per_shop
+
+    def salt(self, kind: str) -> int:
+        return random.Random(f"{self.seed}:{kind}").getrandbits(48)
+
+
+class Ids:
+    """Deterministic ids by entity index, matching the app's id formats."""
+
+    def __init__(self, scale: Scale):
+        self.scale = scale
+        self._salts = {kind: scale.salt(kind) for kind in ("user", "shop", "barber", "service", "appt", "dep", "token", "referral")}
+
+    def _hex(self, kind: str, index: int) -> str:
+        return f"{scramble(index, self._salts[kind]):012x}"
+
+    def client(self, index: int) -> str:
+        return f"user_{self._hex('user', index)}"
+
+    def owner(self, shop: int) -> str:
+        return f"user_{self._hex('user', self.scale.clients + shop)}"
+
+    def staff(self, shop: int, barber: int) -> str:
+        return f"user_{self._hex('user', self.scale.clients + self.scale.shops + shop * self.scale.barbers_per_shop + barber)}"
+
+    def shop(self, index: int) -> str:
+        return f"shop_{self._hex('shop', index)}"
+
+    def barber(self, shop: int, barber: int) -> str:
+        return f"barber_{self._hex('barber', shop * self.scale.barbers_per_shop + barber)}"
+
+    def service(self, shop: int, service: int) -> str:
+        return f"service_{self._hex('service', shop * self.scale.services_per_shop + service)}"
+
+    def appointment(self, index: int) -> str:
+        return f"appt_{self._hex('appt', index)}"
+
+    def deposit(self, index: int) -> str:
+        return f"dep_{self._hex('dep', index)}"
+
+    def token(self, index: int) -> str:
+        return f"token_{self._hex('token', index)}"
+
+    def referral_code(self, index: int, email: str) -> str:
+        return f"{email.split('@')[0][:4].upper()}{scramble(index, self._salts['referral'], 32):08X}"
+
+
+class Model:
+    """Per-process state shared by every chunk: ids, weights and the time axis."""
+
+    def __init__(self, scale: Scale):
+        self.scale = scale
+        self.ids = Ids(scale)
+        anchor = datetime.fromisoformat(scale.anchor) if scale.anchor else datetime.now(timezone.utc)
+        self.now = anchor.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+
+        shared = random.Random(f"{scale.seed}:shops")
+        popularity = [shared.lognormvariate(0, 0.75) for _ in range(scale.shops)]
+        self.shop_weights = list(accumulate(popularity))
+        self.price_factor = [round(shared.uniform(0.7, 1.6), 2) for _ in range(scale.shops)]
+        self.regulars = max(1, scale.clients // 10)
+
+        self.days = list(range(-scale.days_back, scale.days_ahead))
+        day_weights = []
+        for offset in self.days:
+            weekday = (self.now + timedelta(days=offset)).weekday()
+            if offset < 0:
+                trend = 0.6 + 0.4 * (1 + offset / max(scale.days_back, 1))  # the business grew
+            else:
+                trend = max(0.05, 1 - offset / max(scale.days_ahead, 1))  # fewer bookings far ahead
+            day_weights.append(WEEKDAY_WEIGHTS[weekday] * trend)
+        self.day_weights = list(accumulate(day_weights))
+        self.hours = list(HOUR_WEIGHTS)
+        self.hour_weights = list(accumulate(HOUR_WEIGHTS.values()))
+
+    def pick(self, rng: random.Random, cumulative: List[float]) -> int:
+        return bisect.bisect_right(cumulative, rng.random() * cumulative[-1])
+
+    def pick_client(self, rng: random.Random) -> int:
+        if rng.random() < 1 / 3:
+            return rng.randrange(self.regulars)
+        return rng.randrange(self.scale.clients)
+
+
+def _email(kind: str, index: int) -> str:
+    return f"{kind}{index}@example.com"
+
+
+def users(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    scale, ids = model.scale, model.ids
+    for index in range(start, end):
+        if index < scale.clients:
+            kind, user_id, role, shop_id = "cliente", ids.client(index), "client", None
+        elif index < scale.clients + scale.shops:
+            shop = index - scale.clients
+            kind, user_id, role, shop_id = "dueno", ids.owner(shop), "barber", ids.shop(shop)
+        else:
+            staff = index - scale.clients - scale.shops
+            shop = staff // scale.barbers_per_shop
+            kind, user_id, role, shop_id = "barbero", ids.staff(shop, staff % scale.barbers_per_shop), "barber", ids.shop(shop)
+        email = _email(kind, index)
+        created = model.now - timedelta(days=rng.uniform(0, scale.days_back + 180))
+        referred_by = None
+        if role == "client" and index > 0 and rng.random() < scale.referral_rate:
+            referred_by = ids.client(rng.randrange(index))
+        yield {
+            "user_id": user_id,
+            "email": email,
+            "name": f"{kind.capitalize()} {index}",
+            "picture": None,
+            "role": role,
+            "phone": f"+52155{index % 10 ** 8:08d}",
+            "barbershop_id": shop_id,
+            "referral_code": ids.referral_code(index, email),
+            "referred_by": referred_by,
+            "created_at": created,
+        }
+
+
+def barbershops(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    hours = {day: {"open": "09:00", "close": "20:00"} for day in ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday")}
+    for index in range(start, end):
+        created = model.now - timedelta(days=rng.uniform(model.scale.days_back, model.scale.days_back + 365))
+        yield {
+            "shop_id": model.ids.shop(index),
+            "owner_user_id": model.ids.owner(index),
+            "name": f"Barbería {index}",
+            "address": f"Calle {rng.randint(1, 999)} #{rng.randint(1, 200)}",
+            "phone": f"55{rng.randrange(10 ** 8):08d}",
+            "description": None,
+            "photos": [],
+            "working_hours": hours,
+            "location": {"lat": round(rng.uniform(19.2, 19.6), 6), "lng": round(rng.uniform(-99.3, -98.9), 6)},
+            "capacity": model.scale.barbers_per_shop,
+            "created_at": created,
+            "updated_at": created,
+            "version": 0,
+        }
+
+
+def barbers(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    per_shop = model.scale.barbers_per_shop
+    availability = {day: ["09:00-14:00", "15:00-20:00"] for day in ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday")}
+    for index in range(start, end):
+        shop, barber = divmod(index, per_shop)
+        created = model.now - timedelta(days=rng.uniform(0, model.scale.days_back))
+        yield {
+            "barber_id": model.ids.barber(shop, barber),
+            "shop_id": model.ids.shop(shop),
+            "user_id": model.ids.staff(shop, barber),
+            "bio": None,
+            "specialties": rng.sample(["fade", "barba", "diseño", "tijera", "color"], 2),
+            "portfolio": [],
+            "availability": availability,
+            "status": "available",
+            "rating": round(rng.uniform(3.5, 5.0), 1),
+            "total_reviews": rng.randint(0, 400),
+            "created_at": created,
+            "updated_at": created,
+            "version": 0,
+        }
+
+
+def services(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    per_shop = model.scale.services_per_shop
+    for index in range(start, end):
+        shop, service = divmod(index, per_shop)
+        name, price, duration = SERVICE_CATALOG[service % len(SERVICE_CATALOG)]
+        created = model.now - timedelta(days=rng.uniform(0, model.scale.days_back))
+        yield {
+            "service_id": model.ids.service(shop, service),
+            "shop_id": model.ids.shop(shop),
+            "name": name,
+            "description": None,
+            "price": float(round(price * model.price_factor[shop])),
+            "duration": duration,
+            "image": None,
+            "created_at": created,
+            "updated_at": created,
+            "version": 0,
+        }
+
+
+def push_tokens(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    # Indexed by client; 20% have no device registered, 15% have two.
+    for client in range(start, end):
+        count = rng.choices((0, 1, 2), weights=(20, 65, 15))[0]
+        for device in range(count):
+            platform = rng.choices(("android", "ios", "web"), weights=(55, 40, 5))[0]
+            yield {
+                "token_id": model.ids.token(client * 2 + device),
+                "user_id": model.ids.client(client),
+                "token": f"ExponentPushToken[{rng.getrandbits(88):022x}]",
+                "platform": platform,
+                "device_info": None,
+                "created_at": model.now - timedelta(days=rng.uniform(0, model.scale.days_back)),
+            }
+
+
+def _appointment_status(rng: random.Random, past: bool) -> str:
+    if past:
+        return rng.choices(("completed", "cancelled", "scheduled"), weights=(85, 12, 3))[0]
+    return rng.choices(("scheduled", "confirmed", "cancelled"), weights=(60, 35, 5))[0]
+
+
+def _deposit_status(rng: random.Random, status: str, past: bool) -> str:
+    if status == "completed":
+        return "paid"
+    if status == "cancelled":
+        return rng.choice(("refunded", "failed"))
+    return "failed" if past else rng.choices(("pending", "paid"), weights=(40, 60))[0]
+
+
+def appointments(model: Model, rng: random.Random, start: int, end: int) -> Iterator[Tuple[str, dict]]:
+    """Appointments, and the deposits of those that required one."""
+    scale, ids = model.scale, model.ids
+    for index in range(start, end):
+        shop = min(model.pick(rng, model.shop_weights), scale.shops - 1)
+        barber = rng.randrange(scale.barbers_per_shop)
+        service = rng.randrange(scale.services_per_shop)
+        _, base_price, duration = SERVICE_CATALOG[service % len(SERVICE_CATALOG)]
+        day = model.days[min(model.pick(rng, model.day_weights), len(model.days) - 1)]
+        hour = model.hours[min(model.pick(rng, model.hour_weights), len(model.hours) - 1)]
+        scheduled = model.now + timedelta(days=day, hours=hour, minutes=15 * rng.randrange(4))
+        past = day < 0
+        status = _appointment_status(rng, past)
+        created = scheduled - timedelta(hours=min(rng.expovariate(1 / 72), 24 * 60))
+        updated = scheduled + timedelta(minutes=duration) if status == "completed" else created
+        client_id = ids.client(model.pick_client(rng))
+        appointment_id = ids.appointment(index)
+
+        deposit_id, deposit_amount, deposit_status = None, None, "not_required"
+        if rng.random() < scale.deposit_rate:
+            deposit_id = ids.deposit(index)
+            deposit_amount = round(base_price * model.price_factor[shop] * 0.2, 2)
+            deposit_status = _deposit_status(rng, status, past)
+            yield "deposits", {
+                "deposit_id": deposit_id,
+                "appointment_id": appointment_id,
+                "client_user_id": client_id,
+                "amount": deposit_amount,
+                "currency": "USD",
+                "status": deposit_status,
+                "provider": rng.choices(("manual", "stripe", "mercado_pago"), weights=(30, 40, 30))[0],
+                "payment_url": None,
+                "metadata": {},
+                "created_at": created,
+                "updated_at": updated,
+                "version": 0,
+            }
+
+        reminded = past or scheduled - model.now <= timedelta(hours=24)
+        yield "appointments", {
+            "appointment_id": appointment_id,
+            "shop_id": ids.shop(shop),
+            "barber_id": ids.barber(shop, barber),
+            "client_user_id": client_id,
+            "service_id": ids.service(shop, service),
+            "scheduled_time": scheduled,
+            "status": status,
+            "notes": None,
+            "reminder_sent": reminded,
+            "reminder_24h_sent": reminded,
+            "reminder_2h_sent": past,
+            "deposit_required": deposit_id is not None,
+            "deposit_amount": deposit_amount,
+            "deposit_status": deposit_status,
+            "deposit_id": deposit_id,
+            "series_id": None,
+            "occurrence_time": None,
+            "created_at": created,
+            "updated_at": updated,
+            "version": 0,
+        }
+
+
+def client_logs(model: Model, rng: random.Random, start: int, end: int) -> Iterator[dict]:
+    for _ in range(start, end):
+        level, message, screen = rng.choices(LOG_MESSAGES, weights=LOG_LEVEL_WEIGHTS)[0]
+        created = model.now - timedelta(seconds=rng.uniform(0, model.scale.days_back * 86400))
+        yield {
+            "level": level,
+            "message": message,
+            "context": {"app_version": rng.choice(("1.4.0", "1.5.0", "1.5.1"))},
+            "user_id": model.ids.client(model.pick_client(rng)) if rng.random() < 0.8 else None,
+            "stack": None,
+            "platform": rng.choices(("android", "ios", "web"), weights=(55, 40, 5))[0],
+            "screen": screen,
+            "created_at": created,
+            "ingested_at": created + timedelta(seconds=rng.uniform(0, 5)),
+        }
+
+
+# collection name -> (generator, how many items its index range covers)
+GENERATORS = {
+    "users": (users, lambda scale: scale.users),
+    "barbershops": (barbershops, lambda scale: scale.shops),
+    "barbers": (barbers, lambda scale: scale.shops * scale.barbers_per_shop),
+    "services": (services, lambda scale: scale.shops * scale.services_per_shop),
+    "push_tokens": (push_tokens, lambda scale: scale.clients),
+    "appointments": (appointments, lambda scale: scale.appointments),
+    "client_logs": (client_logs, lambda scale: scale.client_logs),
+}
+
+_worker: Dict[str, object] = {}
+
+
+def _init_worker(mongo_url: str, db_name: str, scale: Scale) -> None:
+    _worker["db"] = MongoClient(mongo_url)[db_name]
+    _worker["model"] = Model(scale)
+
+
+def _run_chunk(task: Tuple[str, int, int, int]) -> Dict[str, int]:
+    name, chunk, start, end = task
+    db, model = _worker["db"], _worker["model"]
+    generator, _ = GENERATORS[name]
+    rng = random.Random(f"{model.scale.seed}:{name}:{chunk}")
+    batches: Dict[str, List[dict]] = {}
+    inserted: Dict[str, int] = {}
+
+    def flush(collection: str) -> None:
+        documents = batches.pop(collection, [])
+        if documents:
+            db[collection].insert_many(documents, ordered=False)
+            inserted[collection] = inserted.get(collection, 0) + len(documents)
+
+    for item in generator(model, rng, start, end):
+        collection, document = item if isinstance(item, tuple) else (name, item)
+        batch = batches.setdefault(collection, [])
+        batch.append(document)
+        if len(batch) >= model.scale.batch:
+            flush(collection)
+    for collection in list(batches):
+        flush(collection)
+    return inserted
+
+
+def plan(scale: Scale, only: Optional[List[str]] = None) -> List[Tuple[str, int, int, int]]:
+    """(collection, chunk number, first index, end index) for every chunk."""
+    tasks = []
+    for name, (_, size) in GENERATORS.items():
+        if only and name not in only:
+            continue
+        total = size(scale)
+        for chunk, start in enumerate(range(0, total, scale.chunk)):
+            tasks.append((name, chunk, start, min(start + scale.chunk, total)))
+    # Largest chunks of the biggest collections first keeps the pool busy until the end.
+    return sorted(tasks, key=lambda task: GENERATORS[task[0]][1](scale), reverse=True)
+
+
+def build_wallets(db) -> int:
+    """Loyalty wallets from completed appointments, replacing the collection.
+
+    Like /loyalty/earn/appointment, a client's first completed appointment
+    also credits their referrer, who may have no appointments of their own.
+    """
+    db.users.create_index([("user_id", ASCENDING)], unique=True)
+    db.appointments.aggregate([
+        {"$match": {"status": "completed"}},
+        {"$sort": {"scheduled_time": 1}},
+        {"$group": {
+            "_id": "$client_user_id",
+            "first_completed": {"$first": "$updated_at"},
+            "entries": {"$push": {
+                "type": "appointment",
+                "points": POINTS_PER_COMPLETED_APPOINTMENT,
+                "source_id": "$appointment_id",
+                "created_at": "$updated_at",
+            }},
+        }},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "user_id", "as": "user"}},
+        # One grant for the client and, if referred, one bonus for the referrer.
+        {"$project": {"grants": {"$concatArrays": [
+            [{"user_id": "$_id", "entries": "$entries"}],
+            {"$map": {
+                "input": {"$filter": {"input": "$user.referred_by", "cond": {"$ne": ["$$this", None]}}},
+                "as": "referrer",
+                "in": {"user_id": "$$referrer", "entries": [{
+                    "type": "referral_bonus",
+                    "points": REFERRAL_BONUS,
+                    "source_id": "$_id",
+                    "created_at": "$first_completed",
+                }]},
+            }},
+        ]}}},
+        {"$unwind": "$grants"},
+        {"$unwind": "$grants.entries"},
+        {"$sort": {"grants.entries.created_at": 1}},
+        {"$group": {
+            "_id": "$grants.user_id",
+            "points": {"$sum": "$grants.entries.points"},
+            "history": {"$push": "$grants.entries"},
+        }},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "user_id", "as": "user"}},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id",
+            "points": 1,
+            "referred_by": {"$ifNull": [{"$first": "$user.referred_by"}, None]},
+            "history": 1,
+        }},
+        {"$out": "loyalty_wallets"},
+    ], allowDiskUse=True)
+    return db.loyalty_wallets.estimated_document_count()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="barbershop_synthetic")
+    parser.add_argument("--drop", action="store_true", help="drop the target database first")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--only", nargs="*", choices=list(GENERATORS), help="generate only these collections")
+    parser.add_argument("--no-wallets", action="store_true")
+    defaults = Scale()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    scale = Scale(**{name: getattr(args, name) for name in asdict(defaults)})
+    if not scale.anchor:
+        # Once here, so workers (and a run that crosses midnight) share one "today".
+        scale.anchor = datetime.now(timezone.utc).date().isoformat()
+
+    db = MongoClient(args.mongo_url)[args.db_name]
+    if args.drop:
+        db.client.drop_database(args.db_name)
+    elif any(db[name].estimated_document_count() for name in COLLECTIONS):
+        parser.error(f"{args.db_name} already has data; pass --drop to replace it")
+
+    tasks = plan(scale, args.only)
+    totals: Dict[str, int] = {}
+    started = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.processes, initializer=_init_worker, initargs=(args.mongo_url, args.db_name, scale)) as pool:
+        for done, inserted in enumerate(pool.imap_unordered(_run_chunk, tasks), 1):
+            for collection, count in inserted.items():
+                totals[collection] = totals.get(collection, 0) + count
+            print(f"{done}/{len(tasks)} chunks, {sum(totals.values())} documents", flush=True)
+    if not args.no_wallets and (not args.only or "appointments" in args.only):
+        totals["loyalty_wallets"] = build_wallets(db)
+
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "database": args.db_name,
+        "scale": asdict(scale),
+        "anchor": Model(scale).now.isoformat(),
+        "processes": args.processes,
+        "documents": totals,
+        "seconds": round(elapsed, 1),
+        "documents_per_second": round(sum(totals.values()) / elapsed) if elapsed else None,
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
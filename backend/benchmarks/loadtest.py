@@ -0,0 +1,332 @@
+"""
+Load generator replaying user journeys against a running server, with a p99 regression gate.
+
+Journeys start as a Poisson process at `--rate` per second for `--duration`
+seconds, whether or not earlier ones have finished. A slow server therefore
+builds a backlog, as it would in production, instead of slowing the test
+down. Each journey is drawn from the `--mix` and runs its steps in order.
+It stops at the first failed step.
+
+- browse: app launch (bootstrap + wallet), open a shop, look at a barber's week
+- book: launch, open a shop, barber's week, book
+- book_and_pay: launch, book, create deposit, pay deposit
+- visit: book, barber completes the appointment, loyalty earn
+- scan: launch, AI scan
+
+Latency percentiles and error rates are reported per step. With
+`--baseline` each step's p99 is compared with the stored run. A step fails
+the gate when its p99 grows by more than `--threshold` (relative) and
+`--min-delta-ms` (absolute), or when its error rate passes `--max-error-rate`
+and the baseline's. Journeys that were dropped (over `--max-in-flight`),
+failed, or were still running at the end count as unfinished; a journey
+fails the gate when its unfinished rate passes `--max-error-rate` and the
+baseline's. A step or journey in the baseline that this run lacks fails
+too. The exit status is 1 when anything fails.
+
+The server needs data (see benchmarks.datagen). Run it with
+`AI_PROVIDER=fake AI_RATE_PER_MINUTE=0 AI_DAILY_QUOTA_PER_IP=0 AI_DAILY_QUOTA_PER_USER=0` so scans
+measure the app rather than quotas or Gemini. Point EXPO_PUSH_URL at a stub
+so no push notification reaches Expo.
+
+    cd backend
+    python -m benchmarks.loadtest --url http://localhost:8000 --rate 20 --duration 120 --output baseline.json
+    python -m benchmarks.loadtest --url http://localhost:8000 --rate 20 --duration 120 --baseline baseline.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.api_bench import _face_image, summarize
+
+DEFAULT_MIX = "browse=50,book=20,book_and_pay=10,visit=10,scan=10"
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Catalog:
+    """Shops, their barbers and services, and client ids, read from the server once."""
+
+    def __init__(self, shops: List[dict], clients: List[str], rng: random.Random):
+        self.shops = [shop for shop in shops if shop.get("barbers") and shop.get("services")]
+        self.clients = clients
+        self.images = [_face_image(rng) for _ in range(16)]
+
+    @classmethod
+    async def load(cls, client: httpx.AsyncClient, rng: random.Random, max_clients: int) -> "Catalog":
+        bootstrap = (await client.get("/api/bootstrap/booking")).raise_for_status().json()
+        users = (await client.get("/api/users", params={"role": "client", "limit": max_clients})).raise_for_status().json()
+        catalog = cls(bootstrap.get("shops", []), [user["user_id"] for user in users], rng)
+        if not catalog.shops or not catalog.clients:
+            raise SystemExit("The server has no shops with barbers and services, or no clients; seed it first (benchmarks.datagen)")
+        return catalog
+
+
+class Recorder:
+    """Per-step latencies and errors, ignoring everything before `measure_from`."""
+
+    def __init__(self, measure_from: float):
+        self.measure_from = measure_from
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.status_codes: Dict[str, Dict[str, int]] = {}
+        self.journeys: Dict[str, Dict[str, int]] = {}
+
+    def step(self, name: str, started: float, elapsed: float, status: Optional[int]) -> None:
+        if started < self.measure_from:
+            return
+        self.latencies.setdefault(name, []).append(elapsed)
+        failed = status is None or status >= 400
+        self.errors[name] = self.errors.get(name, 0) + int(failed)
+        if failed:
+            codes = self.status_codes.setdefault(name, {})
+            key = str(status or "exception")
+            codes[key] = codes.get(key, 0) + 1
+
+    def journey(self, name: str, started: float, outcome: str) -> None:
+        if started < self.measure_from:
+            return
+        counts = self.journeys.setdefault(name, {"completed": 0, "failed": 0, "dropped": 0})
+        counts[outcome] += 1
+
+
+class Journey:
+    def __init__(self, client: httpx.AsyncClient, catalog: Catalog, recorder: Recorder, rng: random.Random):
+        self.client = client
+        self.catalog = catalog
+        self.recorder = recorder
+        self.rng = rng
+        self.user_id = rng.choice(catalog.clients)
+        self.shop = rng.choice(catalog.shops)
+        self.barber_id = rng.choice(self.shop["barbers"])["barber_id"]
+        self.service = rng.choice(self.shop["services"])
+
+    async def step(self, name: str, method: str, path: str, **kwargs) -> dict:
+        started = time.perf_counter()
+        status = None
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            pass
+        finally:
+            self.recorder.step(name, started, time.perf_counter() - started, status)
+        if status is None or status >= 400:
+            raise StepFailed(name)
+        return response.json()
+
+    async def launch(self):
+        await self.step("bootstrap", "GET", "/api/bootstrap/booking", params={"user_id": self.user_id})
+        await self.step("wallet", "GET", f"/api/loyalty/wallet/{self.user_id}")
+
+    async def open_shop(self):
+        await self.step("shop", "GET", f"/api/barbershops/{self.shop['shop_id']}")
+        now = datetime.now(timezone.utc)
+        await self.step("barber_week", "GET", "/api/appointments", params={
+            "barber_id": self.barber_id, "start": now.isoformat(), "end": (now + timedelta(days=7)).isoformat(), "limit": 200,
+        })
+
+    async def book(self) -> dict:
+        when = datetime.now(timezone.utc) + timedelta(days=self.rng.randint(1, 14), minutes=self.rng.randrange(0, 600, 15))
+        return await self.step("book", "POST", "/api/appointments", json={
+            "shop_id": self.shop["shop_id"], "barber_id": self.barber_id, "client_user_id": self.user_id,
+            "service_id": self.service["service_id"], "scheduled_time": when.isoformat(),
+        })
+
+    async def browse(self):
+        await self.launch()
+        await self.open_shop()
+
+    async def book_journey(self):
+        await self.launch()
+        await self.open_shop()
+        await self.book()
+
+    async def book_and_pay(self):
+        await self.launch()
+        appointment = await self.book()
+        deposit = await self.step("deposit", "POST", "/api/payments/deposits", json={
+            "appointment_id": appointment["appointment_id"], "client_user_id": self.user_id,
+            "amount": round(self.service.get("price", 100) * 0.2, 2) or 20.0,
+        })
+        await self.step("pay_deposit", "POST", f"/api/payments/deposits/{deposit['deposit_id']}/confirm", json={"status": "paid"})
+
+    async def visit(self):
+        appointment = await self.book()
+        await self.step("complete", "PUT", f"/api/appointments/{appointment['appointment_id']}", json={"status": "completed"})
+        await self.step("loyalty_earn", "POST", "/api/loyalty/earn/appointment", json={"appointment_id": appointment["appointment_id"]})
+
+    async def scan(self):
+        await self.launch()
+        await self.step("ai_scan", "POST", "/api/ai-scan", json={
+            "image_base64": self.rng.choice(self.catalog.images), "user_id": self.user_id, "shop_id": self.shop["shop_id"],
+        })
+
+
+JOURNEYS = {
+    "browse": Journey.browse,
+    "book": Journey.book_journey,
+    "book_and_pay": Journey.book_and_pay,
+    "visit": Journey.visit,
+    "scan": Journey.scan,
+}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in JOURNEYS:
+            raise argparse.ArgumentTypeError(f"unknown journey {name!r}; choose from {', '.join(JOURNEYS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def generate(args) -> dict:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        catalog = await Catalog.load(client, rng, args.clients)
+        names, weights = list(args.mix), list(args.mix.values())
+
+        started = time.perf_counter()
+        recorder = Recorder(started + args.warmup)
+        end = started + args.warmup + args.duration
+        in_flight: set = set()
+
+        async def run_journey(name: str, journey: Journey, arrived: float):
+            try:
+                await JOURNEYS[name](journey)
+                recorder.journey(name, arrived, "completed")
+            except StepFailed:
+                recorder.journey(name, arrived, "failed")
+            except asyncio.CancelledError:
+                # Still running when the run ended.
+                recorder.journey(name, arrived, "failed")
+                raise
+
+        next_arrival = started
+        while next_arrival < end:
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+            name = rng.choices(names, weights)[0]
+            if len(in_flight) >= args.max_in_flight:
+                # Open model: shed instead of waiting, and report it.
+                recorder.journey(name, next_arrival, "dropped")
+            else:
+                journey = Journey(client, catalog, recorder, random.Random(rng.getrandbits(64)))
+                task = asyncio.create_task(run_journey(name, journey, next_arrival))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            next_arrival += rng.expovariate(args.rate)
+        if in_flight:
+            _, pending = await asyncio.wait(in_flight, timeout=args.timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    steps = {}
+    for name, latencies in recorder.latencies.items():
+        stats = summarize(latencies, recorder.errors.get(name, 0), args.duration)
+        stats["error_rate"] = round(stats["errors"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["error_codes"] = recorder.status_codes.get(name, {})
+        steps[name] = stats
+    journeys = {}
+    for name, counts in recorder.journeys.items():
+        total = sum(counts.values())
+        unfinished = counts["failed"] + counts["dropped"]
+        journeys[name] = {**counts, "unfinished_rate": round(unfinished / total, 4) if total else 0.0}
+    return {"steps": steps, "journeys": journeys}
+
+
+def gate(report: dict, baseline: dict, threshold: float, min_delta_ms: float, max_error_rate: float) -> List[str]:
+    """Failure messages for steps and journeys that regressed against `baseline`.
+
+    Latencies only cover the journeys that ran, so an overloaded server that
+    sheds or fails most of them is caught by their unfinished rate instead,
+    and a step the baseline has but this run never reached fails too.
+    """
+    failures = []
+    for name, before in sorted(baseline.get("journeys", {}).items()):
+        current = report["journeys"].get(name)
+        if current is None:
+            failures.append(f"journey {name}: missing from this run")
+            continue
+        allowed = max(max_error_rate, before.get("unfinished_rate", 0.0))
+        if current["unfinished_rate"] > allowed:
+            failures.append(
+                f"journey {name}: {current['unfinished_rate']:.2%} dropped or failed "
+                f"({current['dropped']} dropped, {current['failed']} failed; baseline {before.get('unfinished_rate', 0.0):.2%})"
+            )
+    for name in sorted(set(baseline.get("steps", {})) - set(report["steps"])):
+        failures.append(f"{name}: missing from this run")
+    for name, current in sorted(report["steps"].items()):
+        before = baseline.get("steps", {}).get(name)
+        if before is None:
+            continue
+        delta = current["p99_ms"] - before["p99_ms"]
+        if current["p99_ms"] > before["p99_ms"] * (1 + threshold) and delta > min_delta_ms:
+            failures.append(f"{name}: p99 {before['p99_ms']} → {current['p99_ms']} ms (+{delta:.1f} ms)")
+        if current["error_rate"] > max(max_error_rate, before.get("error_rate", 0.0)):
+            failures.append(f"{name}: error rate {before.get('error_rate', 0.0):.2%} → {current['error_rate']:.2%}")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--rate", type=float, default=10.0, help="journeys started per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=10.0, help="seconds of load before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--max-in-flight", type=int, default=200, help="journeys beyond this are dropped")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--clients", type=int, default=500, help="how many client ids to act as")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path, help="earlier result file to gate against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative p99 growth")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="p99 growth below this is noise")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    result = asyncio.run(generate(args))
+    report = {
+        "benchmark": "loadtest",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "url": args.url,
+        "rate": args.rate,
+        "duration": args.duration,
+        "mix": args.mix,
+        "seed": args.seed,
+        **result,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    print(output)
+
+    if args.baseline:
+        failures = gate(report, json.loads(args.baseline.read_text(encoding="utf-8")),
+                        args.threshold, args.min_delta_ms, args.max_error_rate)
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Throughput and accuracy benchmark for `scan_parser`, driven by a fuzz corpus.
+
+Seeds in `corpus/scan_responses.jsonl` are real-shaped Gemini answers with the
+expected extraction. Each seed is mutated with the variations we see from the
+model (markdown labels, missing accents, renumbered lists, CRLF, chatter,
+random streaming chunk boundaries) while keeping the expected values intact.
+
+    cd backend
+    python -m benchmarks.scan_parser_bench --variants 5000 --output parser.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from scan_parser import ScanParser, parse_scan_response
+
+CORPUS_PATH = Path(__file__).parent / "corpus" / "scan_responses.jsonl"
+
+_LABEL_LINE = re.compile(
+    r"^(FORMA_DEL_ROSTRO|RECOMENDACIONES|ANÁLISIS_DETALLADO|ANALISIS|CONSEJOS_ADICIONALES|CORTE_\d|NOMBRE|DESCRIPCION):",
+    re.MULTILINE,
+)
+_NUMBERED = re.compile(r"^(\d)\. ", re.MULTILINE)
+
+
+def _bold_labels(text: str, rng: random.Random) -> str:
+    style = rng.choice(["**{0}:**", "**{0}**:", "__{0}:__"])
+    return _LABEL_LINE.sub(lambda m: style.format(m.group(1)), text)
+
+
+def _heading_labels(text: str, rng: random.Random) -> str:
+    return re.sub(
+        r"^(RECOMENDACIONES|ANÁLISIS_DETALLADO|CONSEJOS_ADICIONALES|CORTE_\d):$",
+        lambda m: "## " + m.group(1).replace("_", " ").title(),
+        text,
+        flags=re.MULTILINE,
+    )
+
+
+def _toggle_accents(text: str, rng: random.Random) -> str:
+    return text.replace("ANÁLISIS_", "ANALISIS_").replace("DESCRIPCION:", "DESCRIPCIÓN:")
+
+
+def _spaces_for_underscores(text: str, rng: random.Random) -> str:
+    return _LABEL_LINE.sub(lambda m: m.group(1).replace("_", " ") + ":", text)
+
+
+def _lowercase_labels(text: str, rng: random.Random) -> str:
+    return _LABEL_LINE.sub(lambda m: m.group(1).capitalize() + ":", text)
+
+
+def _renumber(text: str, rng: random.Random) -> str:
+    style = rng.choice(["{0})", "({0})", "-", "•", "*", "{0} -", "{0}:"])
+    return _NUMBERED.sub(lambda m: style.format(m.group(1)) + " ", text)
+
+
+def _bold_names(text: str, rng: random.Random) -> str:
+    return re.sub(r"^(\d\. )([^-\n]+?) - ", r"\1**\2** - ", text, flags=re.MULTILINE)
+
+
+def _crlf(text: str, rng: random.Random) -> str:
+    return text.replace("\n", "\r\n")
+
+
+def _extra_whitespace(text: str, rng: random.Random) -> str:
+    return "\n".join(
+        ("  " + line + "   ") + ("\n" if rng.random() < 0.2 else "") for line in text.split("\n")
+    )
+
+
+def _chatter(text: str, rng: random.Random) -> str:
+    return "¡Con gusto! Analicé tu foto.\n\n" + text + "\n\n¿Quieres más opciones?"
+
+
+MUTATORS: Dict[str, Callable[[str, random.Random], str]] = {
+    "bold_labels": _bold_labels,
+    "heading_labels": _heading_labels,
+    "toggle_accents": _toggle_accents,
+    "spaces_for_underscores": _spaces_for_underscores,
+    "lowercase_labels": _lowercase_labels,
+    "renumber": _renumber,
+    "bold_names": _bold_names,
+    "crlf": _crlf,
+    "extra_whitespace": _extra_whitespace,
+    "chatter": _chatter,
+}
+
+
+def load_seeds(path: Path = CORPUS_PATH) -> List[dict]:
+    with path.open(encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def build_corpus(seeds: List[dict], variants: int, seed: int) -> List[dict]:
+    rng = random.Random(seed)
+    corpus = list(seeds)
+    names = list(MUTATORS)
+    while len(corpus) < variants:
+        base = rng.choice(seeds)
+        applied = rng.sample(names, rng.randint(1, 4))
+        text = base["text"]
+        # Label-rewriting mutators must run before the ones that reshape lines.
+        for name in sorted(applied, key=names.index):
+            text = MUTATORS[name](text, rng)
+        corpus.append({**base, "text": text, "mutators": applied})
+    return corpus
+
+
+def _parse_chunked(text: str, rng: random.Random):
+    parser = ScanParser()
+    position = 0
+    while position < len(text):
+        step = rng.randint(1, 64)
+        parser.feed(text[position:position + step])
+        position += step
+    return parser.close()
+
+
+def evaluate(corpus: List[dict], seed: int) -> dict:
+    rng = random.Random(seed)
+    fields = {"face_shape": 0, "names": 0, "analysis": 0, "tips": 0, "exact": 0, "chunked_equal": 0}
+    failures: Dict[str, int] = {}
+
+    for case in corpus:
+        result = parse_scan_response(case["text"])
+        ok = {
+            "face_shape": (result.face_shape or "").lower() == case["face_shape"].lower(),
+            "names": [style.name for style in result.styles] == case["names"],
+            "analysis": bool(result.detailed_analysis) == case["analysis"],
+            "tips": bool(result.tips) == case["tips"],
+        }
+        ok["exact"] = all(ok.values())
+        ok["chunked_equal"] = _parse_chunked(case["text"], rng) == result
+        for key, value in ok.items():
+            fields[key] += int(value)
+        if not ok["exact"]:
+            for mutator in case.get("mutators", ["seed"]):
+                failures[mutator] = failures.get(mutator, 0) + 1
+
+    total = len(corpus)
+    return {
+        "cases": total,
+        "accuracy": {key: round(value / total, 4) for key, value in fields.items()},
+        "failures_by_mutator": failures,
+    }
+
+
+def measure_throughput(corpus: List[dict], iterations: int) -> dict:
+    texts = [case["text"] for case in corpus]
+    total_bytes = sum(len(text.encode("utf-8")) for text in texts)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        for text in texts:
+            parse_scan_response(text)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {
+        "iterations": iterations,
+        "best_seconds": round(best, 6),
+        "responses_per_second": round(len(texts) / best, 1),
+        "mb_per_second": round(total_bytes / best / 1_000_000, 3),
+        "us_per_response": round(best / len(texts) * 1_000_000, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    corpus = build_corpus(load_seeds(), args.variants, args.seed)
+    report = {
+        "benchmark": "scan_parser",
+        "seed": args.seed,
+        **evaluate(corpus, args.seed),
+        "throughput": measure_throughput(corpus, args.iterations),
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Per-request accounting of MongoDB calls, to catch N+1 query patterns.
+
+`DbAccountingMiddleware` opens a `RequestDbCalls` for every HTTP request and
+keeps it in a context variable. Motor copies the context into the executor
+thread that runs each operation, so `DbCallListener` (a pymongo command
+listener) can attribute every command to the request that issued it. This
+covers all query paths without wrapping `db`. Calls are appended to a list,
+which is atomic under the GIL, so concurrent queries of one request need no
+lock.
+
+At the end of the request the totals go to the log, and optionally to
+`X-DB-*` response headers. Requests that cross the thresholds are logged as
+warnings, naming the command that repeats the most.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar[Optional["RequestDbCalls"]] = contextvars.ContextVar("request_db_calls", default=None)
+
+
+def command_collection(command_name: str, command: Dict[str, Any]) -> str:
+    target = command.get(command_name)
+    if not isinstance(target, str):
+        # getMore carries the cursor id here and the name in "collection".
+        target = command.get("collection", "")
+    return target if isinstance(target, str) else ""
+
+
+def _documents_returned(reply: Dict[str, Any]) -> int:
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        return len(batch) if isinstance(batch, list) else 0
+    if "value" in reply:  # findAndModify
+        return 0 if reply["value"] is None else 1
+    return 0
+
+
+@dataclass
+class DbCall:
+    collection: str
+    command: str
+    seconds: float
+    documents: int
+    ok: bool = True
+    spec: Optional[Dict[str, Any]] = None  # the command as sent, for the slow log
+
+
+@dataclass
+class RequestDbCalls:
+    calls: List[DbCall] = field(default_factory=list)
+
+    @property
+    def queries(self) -> int:
+        return len(self.calls)
+
+    @property
+    def documents(self) -> int:
+        return sum(call.documents for call in self.calls)
+
+    @property
+    def seconds(self) -> float:
+        return sum(call.seconds for call in self.calls)
+
+    def most_repeated(self) -> Tuple[str, int]:
+        """The (collection.command, count) issued most often, or ("", 0)."""
+        counts = Counter(f"{call.collection}.{call.command}" for call in self.calls)
+        return counts.most_common(1)[0] if counts else ("", 0)
+
+
+def current_calls() -> Optional[RequestDbCalls]:
+    return _current.get()
+
+
+class DbCallListener(monitoring.CommandListener):
+    """Appends each finished command to the current request's `RequestDbCalls`."""
+
+    def __init__(self):
+        self._pending: Dict[Tuple, Tuple[RequestDbCalls, str, Dict[str, Any]]] = {}
+
+    def started(self, event) -> None:
+        calls = _current.get()
+        if calls is None:
+            return
+        self._pending[(event.connection_id, event.request_id)] = (
+            calls, command_collection(event.command_name, event.command), event.command
+        )
+
+    def succeeded(self, event) -> None:
+        self._finish(event, _documents_returned(event.reply), True)
+
+    def failed(self, event) -> None:
+        self._finish(event, 0, False)
+
+    def _finish(self, event, documents: int, ok: bool) -> None:
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        calls, collection, spec = pending
+        calls.calls.append(DbCall(collection, event.command_name, event.duration_micros / 1e6, documents, ok, spec))
+
+
+class DbAccountingMiddleware:
+    """ASGI middleware that counts the MongoDB calls made by each HTTP request.
+
+    `max_queries`, `max_db_ms` and `max_repeats` (the same collection and
+    command issued again and again, the N+1 signature) are warning thresholds;
+    0 disables one. With `headers` the totals are also sent as `X-DB-Queries`,
+    `X-DB-Documents` and `X-DB-Time-Ms`. Those cover calls made before the
+    response started; the log line covers the whole request.
+    """
+
+    def __init__(self, app, max_queries: int = 0, max_db_ms: float = 0, max_repeats: int = 0, headers: bool = False):
+        self.app = app
+        self.max_queries = max_queries
+        self.max_db_ms = max_db_ms
+        self.max_repeats = max_repeats
+        self.headers = headers
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        calls = RequestDbCalls()
+        token = _current.set(calls)
+
+        async def send_with_headers(message):
+            if self.headers and message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-db-queries", str(calls.queries).encode()),
+                    (b"x-db-documents", str(calls.documents).encode()),
+                    (b"x-db-time-ms", f"{calls.seconds * 1000:.1f}".encode()),
+                ]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            _current.reset(token)
+            self._report(scope, calls, time.perf_counter() - started)
+
+    def _report(self, scope, calls: RequestDbCalls, elapsed: float) -> None:
+        if not calls.queries:
+            return
+        route = getattr(scope.get("route"), "path", None) or scope.get("path", "")
+        repeated, repeats = calls.most_repeated()
+        db_ms = calls.seconds * 1000
+        summary = (
+            f"{scope.get('method')} {route}: {calls.queries} db calls, {calls.documents} docs, "
+            f"{db_ms:.1f} ms in db of {elapsed * 1000:.1f} ms"
+        )
+        flags = []
+        if self.max_queries and calls.queries > self.max_queries:
+            flags.append(f"more than {self.max_queries} db calls")
+        if self.max_db_ms and db_ms > self.max_db_ms:
+            flags.append(f"more than {self.max_db_ms:g} ms in db")
+        if self.max_repeats and repeats > self.max_repeats:
+            flags.append(f"{repeated} issued {repeats} times (possible N+1)")
+        if flags:
+            logger.warning(f"{summary} - {'; '.join(flags)}")
+        else:
+            logger.debug(summary)
@@ -0,0 +1,109 @@
+"""
+Deterministic stand-in for `LlmChat`, selected with `AI_PROVIDER=fake`.
+
+Used by tests and benchmarks so the AI endpoints can run without network access
+or an Emergent key. Latency and failures are configured per model:
+
+    FAKE_LLM_LATENCY="gemini-2.5-flash=0.8,gemini-2.0-flash=0.3"
+    FAKE_LLM_FAILURE_RATE="gemini-2.5-flash=0.1"
+
+Whether a given call fails is derived from a hash of its session id and model,
+so the same inputs always produce the same outcome.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from emergentintegrations.llm.chat import UserMessage
+
+_SCAN_RESPONSE = """FORMA_DEL_ROSTRO: ovalada
+
+RECOMENDACIONES:
+1. Fade clásico - Equilibra las proporciones del rostro
+2. Textured crop - Añade volumen en la parte superior
+3. Pompadour - Alarga visualmente el rostro
+
+ANÁLISIS_DETALLADO:
+Rostro de proporciones equilibradas con mandíbula definida. Los cortes con volumen arriba y laterales cortos resaltan la estructura.
+
+CONSEJOS_ADICIONALES:
+Usa cera mate para dar textura."""
+
+_SCAN_RESPONSE_V2 = """FORMA_DEL_ROSTRO: ovalada
+
+CORTE_1:
+NOMBRE: fade
+DESCRIPCION: Equilibra las proporciones del rostro
+
+CORTE_2:
+NOMBRE: textured
+DESCRIPCION: Añade volumen en la parte superior
+
+CORTE_3:
+NOMBRE: pompadour
+DESCRIPCION: Alarga visualmente el rostro
+
+ANALISIS: Rostro de proporciones equilibradas con mandíbula definida."""
+
+
+def _parse_mapping(value: str) -> Dict[str, float]:
+    mapping: Dict[str, float] = {}
+    for item in value.split(","):
+        model, sep, number = item.partition("=")
+        if sep and model.strip():
+            mapping[model.strip()] = float(number)
+    return mapping
+
+
+class FakeLlmChat:
+    """Drop-in replacement for `LlmChat` with canned, reproducible responses."""
+
+    latency: Dict[str, float] = _parse_mapping(os.environ.get("FAKE_LLM_LATENCY", ""))
+    failure_rate: Dict[str, float] = _parse_mapping(os.environ.get("FAKE_LLM_FAILURE_RATE", ""))
+    default_latency: float = float(os.environ.get("FAKE_LLM_DEFAULT_LATENCY", "0.05"))
+
+    def __init__(self, api_key: str, session_id: str, system_message: Optional[str] = None):
+        self.api_key = api_key
+        self.session_id = session_id
+        self.system_message = system_message or ""
+        self.provider: Optional[str] = None
+        self.model: Optional[str] = None
+        self.params: Dict[str, Any] = {}
+
+    def with_model(self, provider: str, model: str) -> "FakeLlmChat":
+        self.provider = provider
+        self.model = model
+        return self
+
+    def with_params(self, **kwargs: Any) -> "FakeLlmChat":
+        self.params.update(kwargs)
+        return self
+
+    async def _simulate(self) -> None:
+        model = self.model or ""
+        await asyncio.sleep(self.latency.get(model, self.default_latency))
+        rate = self.failure_rate.get(model, 0.0)
+        if rate > 0:
+            digest = hashlib.sha256(f"{self.session_id}:{model}".encode()).digest()
+            if int.from_bytes(digest[:4], "big") / 2**32 < rate:
+                raise RuntimeError(f"Fake provider failure for {model}")
+
+    async def send_message(self, message: UserMessage) -> str:
+        await self._simulate()
+        if "CORTE_1" in self.system_message:
+            return _SCAN_RESPONSE_V2
+        return _SCAN_RESPONSE
+
+    async def send_message_multimodal_response(self, message: UserMessage) -> Tuple[str, List[Any]]:
+        """Echo the first input image back as the "edited" image."""
+
+        await self._simulate()
+        images = [
+            {"mime_type": "image/jpeg", "data": content.image_base64}
+            for content in message.file_contents[:1]
+        ]
+        return "Imagen editada (fake)", images
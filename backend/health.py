@@ -0,0 +1,146 @@
+"""
+Liveness and readiness checks with saturation signals.
+
+Liveness only says the process answers, plus how late its event loop is
+running. Readiness says whether this worker should get traffic. It is not
+ready when MongoDB doesn't answer a ping in time, or when one of the
+saturation signals is over its limit: recent event-loop lag, requests waiting
+for a pooled MongoDB connection, or caller-supplied gauges such as in-flight
+AI calls or pending push sends. A load balancer that drains on 503 then stops
+sending requests to an overloaded worker before they start timing out.
+
+`PoolUsage` is a pymongo connection pool listener. Pool events arrive on
+Motor's executor threads, so its counters are updated under a lock.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from loop_monitor import LoopLagMonitor
+
+
+class PoolUsage(monitoring.ConnectionPoolListener):
+    """Open, checked-out and waited-for connections across the client's pools."""
+
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def _add(self, **deltas: int) -> None:
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"max": self.max_pool_size, "open": self.open, "checked_out": self.checked_out, "waiting": self.waiting}
+
+    def connection_created(self, event) -> None:
+        self._add(open=1)
+
+    def connection_closed(self, event) -> None:
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event) -> None:
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event) -> None:
+        self._add(waiting=-1)
+
+    def connection_checked_out(self, event) -> None:
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event) -> None:
+        self._add(checked_out=-1)
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+
+class HealthCheck:
+    """Builds the /health/live and /health/ready reports.
+
+    `gauges` maps a signal name to a function returning its current value,
+    and `limits` maps signal names to the value above which the worker is not
+    ready. The built-in signals are `mongo_ping_ms`, `loop_lag_ms` (the worst
+    lag of the last `lag_window` seconds) and `mongo_pool_waiting`. A limit of
+    0 disables that check.
+    """
+
+    def __init__(
+        self,
+        db,
+        loop_monitor: LoopLagMonitor,
+        pool_usage: Optional[PoolUsage] = None,
+        gauges: Optional[Dict[str, Callable[[], float]]] = None,
+        limits: Optional[Dict[str, float]] = None,
+        ping_timeout: float = 2.0,
+        lag_window: float = 5.0,
+    ):
+        self.db = db
+        self.loop_monitor = loop_monitor
+        self.pool_usage = pool_usage
+        self.gauges = gauges or {}
+        self.limits = limits or {}
+        self.ping_timeout = ping_timeout
+        self.lag_window = lag_window
+
+    def live(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "loop_lag_ms": round(self.loop_monitor.lag * 1000, 1),
+            "loop_stalled_ms": round(self.loop_monitor.stalled_for() * 1000, 1),
+        }
+
+    async def _ping(self) -> Tuple[Optional[float], Optional[str]]:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.db.command("ping"), timeout=self.ping_timeout)
+        except asyncio.TimeoutError:
+            return None, f"no answer in {self.ping_timeout:g} s"
+        except Exception as e:
+            return None, str(e)
+        return (time.perf_counter() - started) * 1000, None
+
+    async def ready(self) -> Tuple[bool, Dict[str, Any]]:
+        ping_ms, ping_error = await self._ping()
+        signals: Dict[str, Any] = {
+            "mongo_ping_ms": round(ping_ms, 1) if ping_ms is not None else None,
+            "loop_lag_ms": round(self.loop_monitor.max_lag(self.lag_window) * 1000, 1),
+        }
+        if self.pool_usage is not None:
+            pool = self.pool_usage.snapshot()
+            signals["mongo_pool"] = pool
+            signals["mongo_pool_waiting"] = pool["waiting"]
+        for name, gauge in self.gauges.items():
+            signals[name] = gauge()
+
+        failing: List[str] = []
+        if ping_error is not None:
+            failing.append(f"mongo: {ping_error}")
+        for name, limit in self.limits.items():
+            value = signals.get(name)
+            if limit and isinstance(value, (int, float)) and value > limit:
+                failing.append(f"{name} {value:g} > {limit:g}")
+        return not failing, {"status": "ready" if not failing else "unavailable", "failing": failing, **signals}
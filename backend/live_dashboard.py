@@ -0,0 +1,299 @@
+"""
+Admin dashboard stats maintained incrementally from change events.
+
+`get_dashboard_stats` reads every appointment of a shop on each refresh. While
+someone watches `/api/dashboard/stream`, a `ShopDashboard` keeps a compact
+index of the shop's appointments (status, time, service) plus running counters
+and updates them from the change events on the shop's bus topic, so each
+change costs one in-memory update no matter how many admins are watching. The
+stream sends the full stats once and then only the keys that changed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from realtime import EventBus, Subscription
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ("scheduled", "completed", "cancelled", "in_progress")
+
+
+def _aware(value: Any) -> Optional[datetime]:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+@dataclass
+class _Appointment:
+    status: Optional[str]
+    scheduled_time: Optional[datetime]
+    service_id: Optional[str]
+
+
+@dataclass
+class ShopDashboard:
+    shop_id: str
+    capacity: Optional[int] = None
+    appointments: Dict[str, _Appointment] = field(default_factory=dict)
+    barbers: Set[str] = field(default_factory=set)
+    services: Dict[str, dict] = field(default_factory=dict)
+    total: int = 0
+    completed: int = 0
+    service_counts: Counter = field(default_factory=Counter)
+    today_start: datetime = field(default_factory=lambda: datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0))
+    today_total: int = 0
+    today_status: Counter = field(default_factory=Counter)
+    today_completed: int = 0
+    revenue_today: float = 0.0
+
+    def load(self, appointments: List[dict], barbers: List[dict], services: List[dict], capacity: Optional[int]) -> None:
+        self.capacity = capacity
+        self.barbers = {barber["barber_id"] for barber in barbers}
+        self.services = {service["service_id"]: service for service in services}
+        self.appointments = {}
+        for doc in appointments:
+            self.appointments[doc["appointment_id"]] = _Appointment(
+                doc.get("status"), _aware(doc.get("scheduled_time")), doc.get("service_id")
+            )
+        self._recount()
+
+    # -- counters ---------------------------------------------------------
+
+    def _is_today(self, appt: _Appointment) -> bool:
+        return appt.scheduled_time is not None and self.today_start <= appt.scheduled_time < self.today_start + timedelta(days=1)
+
+    def _price(self, service_id: Optional[str]) -> float:
+        service = self.services.get(service_id)
+        return float(service.get("price") or 0) if service else 0.0
+
+    def _count(self, appt: _Appointment, sign: int) -> None:
+        self.total += sign
+        if appt.status == "completed":
+            self.completed += sign
+        if appt.service_id:
+            self.service_counts[appt.service_id] += sign
+            if self.service_counts[appt.service_id] <= 0:
+                del self.service_counts[appt.service_id]
+        if self._is_today(appt):
+            self.today_total += sign
+            self.today_status[appt.status] += sign
+            if appt.status == "completed":
+                self.today_completed += sign
+                self.revenue_today += sign * self._price(appt.service_id)
+
+    def _recount(self) -> None:
+        self.total = self.completed = self.today_total = self.today_completed = 0
+        self.revenue_today = 0.0
+        self.service_counts = Counter()
+        self.today_status = Counter()
+        for appt in self.appointments.values():
+            self._count(appt, 1)
+
+    def roll_day(self, now: Optional[datetime] = None) -> bool:
+        """Recount today's figures after midnight UTC; True if the day changed."""
+
+        now = now or datetime.now(timezone.utc)
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if today_start == self.today_start:
+            return False
+        self.today_start = today_start
+        self._recount()
+        return True
+
+    # -- events -----------------------------------------------------------
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        collection, doc_id, op = event.get("collection"), event.get("id"), event.get("op")
+        data = event.get("data") or {}
+        if collection == "appointments":
+            previous = self.appointments.pop(doc_id, None)
+            if previous is not None:
+                self._count(previous, -1)
+            if op == "delete":
+                return
+            appt = _Appointment(
+                data.get("status", previous.status if previous else None),
+                _aware(data.get("scheduled_time")) or (previous.scheduled_time if previous else None),
+                data.get("service_id", previous.service_id if previous else None),
+            )
+            self.appointments[doc_id] = appt
+            self._count(appt, 1)
+        elif collection == "barbers":
+            if op == "delete":
+                self.barbers.discard(doc_id)
+            else:
+                self.barbers.add(doc_id)
+        elif collection == "services":
+            if op == "delete":
+                self.services.pop(doc_id, None)
+            else:
+                self.services[doc_id] = {**self.services.get(doc_id, {"service_id": doc_id}), **data}
+            # Prices feed today's revenue; recounting the in-memory index is cheap.
+            self._recount()
+        elif collection == "barbershops" and "capacity" in data:
+            self.capacity = data["capacity"]
+
+    # -- output -----------------------------------------------------------
+
+    def stats(self, now: Optional[datetime] = None) -> dict:
+        now = now or datetime.now(timezone.utc)
+        top_services = [
+            {
+                "service_id": service_id,
+                "name": self.services.get(service_id, {}).get("name", "Servicio"),
+                "count": count,
+                "price": self.services.get(service_id, {}).get("price"),
+            }
+            for service_id, count in self.service_counts.most_common(5)
+        ]
+        recent = heapq.nlargest(
+            5,
+            self.appointments.items(),
+            key=lambda item: item[1].scheduled_time or self.today_start,
+        )
+        occupancy_rate = None
+        if self.capacity and self.capacity > 0:
+            occupancy_rate = min(100.0, (self.today_total / self.capacity) * 100)
+        return {
+            "total_appointments": self.total,
+            "completed_appointments": self.completed,
+            "total_barbers": len(self.barbers),
+            "today_appointments": self.today_total,
+            "status_breakdown": {status: self.today_status.get(status, 0) for status in STATUSES},
+            "capacity": self.capacity,
+            "occupancy_rate": occupancy_rate,
+            "revenue_today": self.revenue_today,
+            "ticket_average": self.revenue_today / self.today_completed if self.today_completed else 0.0,
+            "top_services": top_services,
+            "recent_appointments": [
+                {"appointment_id": appointment_id, "scheduled_time": appt.scheduled_time, "status": appt.status}
+                for appointment_id, appt in recent
+            ],
+            "last_updated": now,
+        }
+
+
+def stats_delta(previous: dict, current: dict) -> dict:
+    return {
+        key: value for key, value in current.items()
+        if key != "last_updated" and previous.get(key) != value
+    }
+
+
+class _LiveShop:
+    def __init__(self, dashboard: ShopDashboard, feed: Subscription):
+        self.dashboard = dashboard
+        self.feed = feed
+        self.viewers = 0
+        self.last_stats = dashboard.stats()
+        self.task: Optional[asyncio.Task] = None
+
+
+class DashboardHub:
+    """One incrementally updated dashboard per watched shop, shared by all viewers.
+
+    `loader(shop_id)` reads the shop once into a `ShopDashboard`. Deltas are
+    published on the bus topic `dashboard:<shop_id>`. Changes to collections in
+    `reload_on` can't be applied incrementally; they reload the dashboard, as
+    does midnight when any such collection is configured.
+    """
+
+    def __init__(
+        self,
+        bus: EventBus,
+        loader: Callable[[str], Awaitable[ShopDashboard]],
+        tick_seconds: float = 60.0,
+        reload_on: Iterable[str] = (),
+    ):
+        self.bus = bus
+        self.loader = loader
+        self.tick_seconds = tick_seconds
+        self.reload_on = frozenset(reload_on)
+        self._shops: Dict[str, _LiveShop] = {}
+        # Per-shop locks so one slow load doesn't hold up viewers of other
+        # shops; dropped once nobody is joining that shop.
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._joining: Counter = Counter()
+
+    def current(self, shop_id: str) -> Optional[dict]:
+        live = self._shops.get(shop_id)
+        return live.dashboard.stats() if live else None
+
+    async def join(self, shop_id: str) -> Tuple[Subscription, dict]:
+        """Subscribe a viewer; returns its delta subscription and the full stats."""
+
+        lock = self._locks.setdefault(shop_id, asyncio.Lock())
+        self._joining[shop_id] += 1
+        try:
+            async with lock:
+                live = self._shops.get(shop_id)
+                if live is None:
+                    # Subscribe before loading so no change between the two is lost;
+                    # applying an event twice is harmless.
+                    feed = self.bus.subscribe([f"shop:{shop_id}"])
+                    try:
+                        dashboard = await self.loader(shop_id)
+                    except BaseException:
+                        # Also when the viewer disconnects (is cancelled) mid-load.
+                        feed.close()
+                        raise
+                    live = self._shops[shop_id] = _LiveShop(dashboard, feed)
+                    live.task = asyncio.create_task(self._pump(shop_id, live))
+                live.viewers += 1
+        finally:
+            self._joining[shop_id] -= 1
+            if self._joining[shop_id] <= 0:
+                del self._joining[shop_id]
+                self._locks.pop(shop_id, None)
+        viewer = self.bus.subscribe([f"dashboard:{shop_id}"])
+        return viewer, live.dashboard.stats()
+
+    def leave(self, shop_id: str, viewer: Subscription) -> None:
+        viewer.close()
+        live = self._shops.get(shop_id)
+        if live is None:
+            return
+        live.viewers -= 1
+        if live.viewers <= 0:
+            self._shops.pop(shop_id, None)
+            live.feed.close()
+            if live.task:
+                live.task.cancel()
+
+    async def _pump(self, shop_id: str, live: _LiveShop) -> None:
+        while True:
+            event = await live.feed.get(timeout=self.tick_seconds)
+            try:
+                # Midnight passes whether the shop is idle or busy.
+                if live.dashboard.roll_day() and self.reload_on:
+                    live.dashboard = await self.loader(shop_id)
+                if event is not None and (event.get("type") == "resync" or event.get("collection") in self.reload_on):
+                    live.dashboard = await self.loader(shop_id)
+                elif event is not None:
+                    live.dashboard.apply(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Could not update live dashboard for {shop_id}: {e}")
+                continue
+            stats = live.dashboard.stats()
+            delta = stats_delta(live.last_stats, stats)
+            live.last_stats = stats
+            if delta:
+                self.bus.publish({
+                    "type": "delta",
+                    "topics": [f"dashboard:{shop_id}"],
+                    "changes": delta,
+                    "last_updated": stats["last_updated"],
+                })
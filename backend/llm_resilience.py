@@ -0,0 +1,216 @@
+"""
+Resilience helpers for calls to the LLM provider.
+
+`emergentintegrations.LlmChat` has no notion of timeouts or failure isolation:
+when Gemini is degraded every request waits for the upstream error. This module
+wraps provider calls with a circuit breaker that trips on error rate or slow
+calls, and an optional hedge that fires a second attempt when the first one is
+slower than the recent p95 latency.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is rejected because the breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open; retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class LatencyWindow:
+    """Rolling window of call latencies used to derive percentiles."""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+        return ordered[index]
+
+
+@dataclass
+class CircuitBreaker:
+    """Error-rate / slow-call circuit breaker for a single upstream dependency.
+
+    The breaker keeps the outcome of the last `window_size` calls. Once at least
+    `min_calls` have been recorded and the share of failed (or slower than
+    `slow_call_seconds`) calls reaches `failure_rate`, it opens and rejects calls
+    for `open_seconds`. After that a single probe is let through (half-open);
+    its outcome closes or re-opens the circuit.
+    """
+
+    name: str
+    failure_rate: float = 0.5
+    min_calls: int = 5
+    window_size: int = 20
+    slow_call_seconds: float = 20.0
+    open_seconds: float = 30.0
+    call_timeout: Optional[float] = 45.0
+    state: str = CLOSED
+    opened_at: float = 0.0
+    latencies: LatencyWindow = field(default_factory=LatencyWindow)
+    _outcomes: Deque[bool] = field(default_factory=deque, repr=False)
+    _probe_in_flight: bool = field(default=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._outcomes = deque(self._outcomes, maxlen=self.window_size)
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.retry_after() <= 0:
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record(self, ok: bool, latency: float) -> None:
+        slow = latency >= self.slow_call_seconds
+        if ok:
+            self.latencies.add(latency)
+        healthy = ok and not slow
+
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            if healthy:
+                self._close()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(healthy)
+        if len(self._outcomes) < self.min_calls:
+            return
+        failures = self._outcomes.count(False)
+        if failures / len(self._outcomes) >= self.failure_rate:
+            self._open()
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "recent_calls": len(self._outcomes),
+            "recent_failures": self._outcomes.count(False),
+            "p95_seconds": self.latencies.percentile(95),
+            "retry_after": self.retry_after() if self.state == OPEN else 0.0,
+        }
+
+    async def call(self, factory: Callable[[], Awaitable[T]]) -> T:
+        """Run `factory()` through the breaker, recording its latency and outcome."""
+
+        if not self.allow_request():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+        started = time.monotonic()
+        try:
+            if self.call_timeout:
+                result = await asyncio.wait_for(factory(), timeout=self.call_timeout)
+            else:
+                result = await factory()
+        except asyncio.CancelledError:
+            # A cancelled hedge loser says nothing about upstream health.
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = False
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+        return result
+
+    def _open(self) -> None:
+        if self.state != OPEN:
+            logger.warning(f"Circuit '{self.name}' opened after repeated LLM failures")
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def _close(self) -> None:
+        logger.info(f"Circuit '{self.name}' closed")
+        self.state = CLOSED
+        self._outcomes.clear()
+
+
+def hedge_delay(breaker: CircuitBreaker, min_samples: int = 20, floor: float = 1.0) -> Optional[float]:
+    """Delay before hedging a call: the breaker's recent p95, or None if unknown."""
+
+    if len(breaker.latencies) < min_samples:
+        return None
+    p95 = breaker.latencies.percentile(95)
+    return max(floor, p95) if p95 is not None else None
+
+
+async def hedged_call(
+    breaker: CircuitBreaker,
+    factory: Callable[[], Awaitable[T]],
+    delay: Optional[float] = None,
+) -> Tuple[T, bool]:
+    """Call `factory` through `breaker`, starting a second attempt after `delay`.
+
+    The first attempt to succeed wins and the other one is cancelled. Returns the
+    result and whether the hedge attempt produced it. With `delay=None` this is a
+    plain breaker call.
+    """
+
+    if delay is None:
+        return await breaker.call(factory), False
+
+    primary = asyncio.ensure_future(breaker.call(factory))
+    attempts = [primary]
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), False
+
+        hedge = asyncio.ensure_future(breaker.call(factory))
+        attempts.append(hedge)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task is hedge
+    finally:
+        # Also runs when the caller is cancelled while waiting on either attempt.
+        for task in attempts:
+            if not task.done():
+                task.cancel()
+    # Both attempts failed: surface the primary's error, not the hedge's.
+    raise primary.exception()
@@ -0,0 +1,186 @@
+"""
+Latency-aware routing of LLM calls across interchangeable models.
+
+Each task (for example the face scan or the hair edit) has an ordered list of
+acceptable `(provider, model)` routes. The router keeps a circuit breaker per
+task and route, ranks the healthy routes by their recent median latency
+(inflated by their error rate) and falls over to the next route when a call is
+rejected or fails.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from llm_resilience import CLOSED, OPEN, CircuitBreaker, CircuitOpenError, hedge_delay, hedged_call
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    provider: str
+    model: str
+
+    @property
+    def key(self) -> str:
+        return f"{self.provider}/{self.model}"
+
+
+def parse_model_list(value: str, default_provider: str = "gemini") -> List[ModelRoute]:
+    """Parse `"gemini:gemini-2.5-flash, gemini-2.0-flash"` into routes."""
+
+    routes: List[ModelRoute] = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        provider, _, model = item.rpartition(":")
+        routes.append(ModelRoute(provider or default_provider, model))
+    return routes
+
+
+@dataclass
+class RouteStats:
+    calls: int = 0
+    errors: int = 0
+    rejected: int = 0
+    hedge_wins: int = 0
+
+
+class ModelRouter:
+    """Pick the fastest healthy model for a task and call it through its breaker.
+
+    `observer(task, route, outcome, seconds)` is told about every attempted
+    call, with outcome "ok" or "error".
+    """
+
+    def __init__(
+        self,
+        tasks: Dict[str, List[ModelRoute]],
+        breaker_factory: Callable[[str, ModelRoute], CircuitBreaker],
+        explore_every: int = 20,
+        observer: Optional[Callable[[str, ModelRoute, str, float], None]] = None,
+    ):
+        self.tasks = tasks
+        self.explore_every = explore_every
+        self.observer = observer
+        self._breakers: Dict[Tuple[str, ModelRoute], CircuitBreaker] = {}
+        self._stats: Dict[Tuple[str, ModelRoute], RouteStats] = {}
+        self._counters: Dict[str, int] = {}
+        for task, routes in tasks.items():
+            if not routes:
+                raise ValueError(f"No models configured for task '{task}'")
+            for route in routes:
+                self._breakers[(task, route)] = breaker_factory(task, route)
+                self._stats[(task, route)] = RouteStats()
+
+    def breaker(self, task: str, route: ModelRoute) -> CircuitBreaker:
+        return self._breakers[(task, route)]
+
+    def expected_latency(self, task: str, route: ModelRoute) -> float:
+        breaker = self._breakers[(task, route)]
+        median = breaker.latencies.percentile(50)
+        if median is None:
+            # Untried routes sort first so they get sampled; routes that have only
+            # failed (or just tripped their breaker) sort last.
+            if breaker.state != CLOSED or breaker.error_rate() > 0:
+                return float("inf")
+            return 0.0
+        return median / max(0.05, 1.0 - breaker.error_rate())
+
+    def rank(self, task: str) -> List[ModelRoute]:
+        """Routes for `task` in the order they should be tried."""
+
+        routes = self.tasks[task]
+        healthy = [
+            route for route in routes
+            if self._breakers[(task, route)].state != OPEN or self._breakers[(task, route)].retry_after() <= 0
+        ]
+        order = {route: index for index, route in enumerate(routes)}
+        healthy.sort(key=lambda route: (self.expected_latency(task, route), order[route]))
+
+        count = self._counters.get(task, 0) + 1
+        self._counters[task] = count
+        if self.explore_every and len(healthy) > 1 and count % self.explore_every == 0:
+            # Periodically let the runner-up refresh its latency samples.
+            healthy[0], healthy[1] = healthy[1], healthy[0]
+        return healthy
+
+    async def call(
+        self,
+        task: str,
+        factory: Callable[[ModelRoute], Awaitable[T]],
+        hedge: bool = False,
+    ) -> Tuple[T, ModelRoute]:
+        """Run `factory(route)` on the best route, falling over on failure.
+
+        Raises `CircuitOpenError` when every route is rejected, or the last
+        provider error when every attempted route failed.
+        """
+
+        last_error: Optional[Exception] = None
+        for route in self.rank(task):
+            breaker = self._breakers[(task, route)]
+            stats = self._stats[(task, route)]
+            delay = hedge_delay(breaker) if hedge else None
+            started = time.monotonic()
+            try:
+                result, hedged = await hedged_call(breaker, lambda: factory(route), delay)
+            except CircuitOpenError:
+                stats.rejected += 1
+                continue
+            except Exception as e:
+                stats.calls += 1
+                stats.errors += 1
+                last_error = e
+                logger.warning(f"LLM route {route.key} failed for task '{task}': {e}")
+                self._observe(task, route, "error", started)
+                continue
+            stats.calls += 1
+            self._observe(task, route, "ok", started)
+            if hedged:
+                stats.hedge_wins += 1
+            return result, route
+
+        if last_error is not None:
+            raise last_error
+        retry_after = min(
+            (self._breakers[(task, route)].retry_after() for route in self.tasks[task]),
+            default=0.0,
+        )
+        raise CircuitOpenError(task, retry_after)
+
+    def _observe(self, task: str, route: ModelRoute, outcome: str, started: float) -> None:
+        if self.observer is None:
+            return
+        try:
+            self.observer(task, route, outcome, time.monotonic() - started)
+        except Exception as e:
+            logger.warning(f"LLM call observer failed: {e}")
+
+    def snapshot(self) -> List[dict]:
+        """Per-route health and latency figures for export."""
+
+        rows = []
+        for (task, route), breaker in self._breakers.items():
+            stats = self._stats[(task, route)]
+            rows.append({
+                "task": task,
+                "provider": route.provider,
+                "model": route.model,
+                "state": breaker.state,
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "rejected": stats.rejected,
+                "hedge_wins": stats.hedge_wins,
+                "error_rate": breaker.error_rate(),
+                "p50_seconds": breaker.latencies.percentile(50),
+                "p95_seconds": breaker.latencies.percentile(95),
+            })
+        return rows
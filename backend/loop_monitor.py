@@ -0,0 +1,154 @@
+"""
+Event-loop lag measurement and blocking-call detection.
+
+`LoopLagMonitor.run()` sleeps for `interval` seconds over and over and measures
+how late it wakes up. The delay is time the loop spent running other callbacks
+before it got back to this one, so it is the lag every request sees at that
+moment. Sustained lag means the worker is saturated, or something is blocking
+the loop.
+
+With a `block_threshold`, a heartbeat callback also runs on the loop every
+`check_interval`, and a watchdog thread checks how overdue it is. A loop that
+is free runs the heartbeat on time, so once it is more than the threshold
+late the loop has been stuck in one callback at least that long, and the
+watchdog takes the loop thread's stack and the running task while it is
+still stuck. When the heartbeat finally runs, its delay is the block's
+duration (to within `check_interval`); the block is logged with that stack,
+kept in `blocks`, and passed to `on_block`. `site` names the innermost frame
+in this app's own code, which is usually the line to offload to a thread or
+process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class BlockedCall:
+    tick: float  # the heartbeat the loop was stuck after
+    task: str
+    site: str
+    stack: traceback.StackSummary
+    seconds: float = 0.0
+
+    def format(self) -> str:
+        return "".join(self.stack.format())
+
+
+def _site(stack: traceback.StackSummary) -> str:
+    """Innermost frame in the app's own files (not libraries, not this module)."""
+    for frame in reversed(stack):
+        if frame.filename.startswith(_APP_DIR) and frame.filename != __file__ and "site-packages" not in frame.filename:
+            return f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+    if stack:
+        frame = stack[-1]
+        return f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+    return "unknown"
+
+
+class LoopLagMonitor:
+    def __init__(
+        self,
+        interval: float = 0.25,
+        window: float = 10.0,
+        block_threshold: float = 0.0,
+        check_interval: float = 0.02,
+        on_lag: Optional[Callable[[float], None]] = None,
+        on_block: Optional[Callable[[BlockedCall], None]] = None,
+    ):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.check_interval = check_interval
+        self.on_lag = on_lag
+        self.on_block = on_block
+        self.lag = 0.0
+        self.last_tick = time.monotonic()
+        self.blocks: Deque[BlockedCall] = deque(maxlen=20)
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=max(1, int(window / interval)))
+        self._caught: Optional[BlockedCall] = None
+        self._beat = self._beat_due = time.monotonic()
+        self._beat_handle: Optional[asyncio.TimerHandle] = None
+
+    def max_lag(self, seconds: float = 0) -> float:
+        """Largest lag of the last `seconds` (the whole window when 0)."""
+        since = time.monotonic() - seconds if seconds else 0.0
+        return max((lag for at, lag in list(self._samples) if at >= since), default=0.0)
+
+    def stalled_for(self) -> float:
+        """Seconds since the monitor last woke up, beyond its interval."""
+        return max(0.0, time.monotonic() - self.last_tick - self.interval)
+
+    def _heartbeat(self, loop: asyncio.AbstractEventLoop) -> None:
+        now = time.monotonic()
+        self._report_block(self._beat, now - self._beat_due)
+        self._beat = now
+        self._beat_due = now + self.check_interval
+        self._beat_handle = loop.call_later(self.check_interval, self._heartbeat, loop)
+
+    def _watch(self, loop: asyncio.AbstractEventLoop, thread_id: int) -> None:
+        while not loop.is_closed():
+            time.sleep(self.check_interval / 2)
+            tick = self._beat
+            if time.monotonic() - self._beat_due < self.block_threshold or (self._caught is not None and self._caught.tick == tick):
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(loop)
+            stack = traceback.extract_stack(frame, limit=40)
+            del frame
+            self._caught = BlockedCall(
+                tick=tick,
+                task=f"{task.get_name()} {getattr(task.get_coro(), '__qualname__', '')}".strip() if task else "no task",
+                site=_site(stack),
+                stack=stack,
+            )
+
+    def _report_block(self, previous_beat: float, blocked: float) -> None:
+        caught = self._caught
+        if caught is None or caught.tick != previous_beat:
+            return
+        caught.seconds = blocked
+        self.blocks.append(caught)
+        logger.warning(
+            f"Event loop blocked for {blocked * 1000:.0f} ms at {caught.site} in task {caught.task}:\n{caught.format()}"
+        )
+        if self.on_block is not None:
+            self.on_block(caught)
+
+    async def run(self) -> None:
+        if self.block_threshold:
+            loop = asyncio.get_running_loop()
+            self._heartbeat(loop)
+            threading.Thread(
+                target=self._watch,
+                args=(loop, threading.get_ident()),
+                name="loop-watchdog",
+                daemon=True,
+            ).start()
+        try:
+            while True:
+                started = self.last_tick = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.last_tick = time.monotonic()
+                self.lag = max(0.0, self.last_tick - started - self.interval)
+                self._samples.append((self.last_tick, self.lag))
+                if self.on_lag is not None:
+                    self.on_lag(self.lag)
+        finally:
+            if self._beat_handle is not None:
+                self._beat_handle.cancel()
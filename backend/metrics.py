@@ -0,0 +1,248 @@
+"""
+In-process metrics exported in the Prometheus text format.
+
+Counters, gauges and histograms are dicts keyed by label values. Most updates
+happen on the event loop, but MongoDB command events arrive on Motor's executor
+threads, so every metric keeps one shard per thread. Writers only touch their
+own shard and never take a lock; `render()` sums the shards at scrape time. A
+scrape can miss an update that is in flight, but it never sees a torn one.
+
+`MetricsMiddleware` times every HTTP request by its route template (not the raw
+path, so ids don't explode the label space) and `MongoCommandMetrics` is a
+pymongo command listener that times each command per collection.
+"""
+
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+from db_accounting import command_collection
+
+# Seconds; covers a cached read (ms) up to a slow LLM call.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._shards: Dict[int, dict] = {}
+
+    def _shard(self) -> dict:
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            shard = self._shards.setdefault(ident, {})
+        return shard
+
+    def _check(self, values: LabelValues) -> None:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {values}")
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        self._check(values)
+        shard = self._shard()
+        shard[values] = shard.get(values, 0.0) + amount
+
+    def totals(self) -> Dict[LabelValues, float]:
+        totals: Dict[LabelValues, float] = {}
+        for shard in list(self._shards.values()):
+            for values, amount in list(shard.items()):
+                totals[values] = totals.get(values, 0.0) + amount
+        return totals
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, values)} {_format_value(amount)}"
+            for values, amount in sorted(self.totals().items())
+        ]
+
+
+class Gauge(Counter):
+    """Up/down gauge, or one computed at scrape time by `function`.
+
+    `function` returns a number, or a dict of label values to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), function: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def dec(self, *values: str, amount: float = 1.0) -> None:
+        self.inc(*values, amount=-amount)
+
+    def totals(self) -> Dict[LabelValues, float]:
+        if self.function is None:
+            return super().totals()
+        result = self.function()
+        return dict(result) if isinstance(result, dict) else {(): result}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *values: str) -> None:
+        self._check(values)
+        shard = self._shard()
+        # Per-bucket counts (made cumulative on render), then sum and count.
+        state = shard.get(values)
+        if state is None:
+            state = shard[values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def totals(self) -> Dict[LabelValues, list]:
+        totals: Dict[LabelValues, list] = {}
+        for shard in list(self._shards.values()):
+            for values, state in list(shard.items()):
+                merged = totals.get(values)
+                if merged is None:
+                    totals[values] = list(state)
+                else:
+                    for index, amount in enumerate(state):
+                        merged[index] += amount
+        return totals
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        bounds = self.buckets + (float("inf"),)
+        for values, state in sorted(self.totals().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                labels = _format_labels(self.labels, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = (), function: Optional[Callable] = None) -> Gauge:
+        return self._add(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request count, latency and in-flight requests.
+
+    Streaming responses (SSE) count until the stream closes. WebSockets are
+    not timed.
+    """
+
+    def __init__(self, app, requests: Counter, latency: Histogram, in_flight: Gauge):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        self.in_flight = in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        method = scope.get("method", "")
+        self.in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.in_flight.dec()
+            # FastAPI stores the matched route in the scope it shares with us.
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            self.requests.inc(method, route, str(status))
+            self.latency.observe(elapsed, method, route)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times MongoDB commands per collection; register it on the client."""
+
+    def __init__(self, latency: Histogram, failures: Counter):
+        self.latency = latency
+        self.failures = failures
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event) -> None:
+        self._collections[(event.connection_id, event.request_id)] = command_collection(event.command_name, event.command)
+
+    def succeeded(self, event) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        self.latency.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        self.latency.observe(event.duration_micros / 1e6, collection, event.command_name)
+        self.failures.inc(collection, event.command_name)
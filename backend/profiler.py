@@ -0,0 +1,216 @@
+"""
+On-demand sampling profiler and allocation snapshots for the running server.
+
+`Profiler.profile()` starts a thread that looks at the event loop thread's
+stack every `interval` seconds (`sys._current_frames`), so the profiled code
+runs untouched and the cost is one stack walk per sample. Two clocks:
+
+- "wall" counts one per sample, idle time in the selector included.
+- "cpu" weighs each sample by the CPU microseconds the loop thread used since
+  the previous one, so waiting on I/O costs nothing.
+
+With a `route`, only samples taken while a request for that route is the
+running asyncio task are kept, and the session ends after `requests` such
+requests (`ProfilerMiddleware` tells the profiler which task serves which
+request). Work handed to other threads (Motor, `run_in_executor`) or to child
+tasks is not on the request's task, so it is not in a route profile.
+
+The result is in the collapsed-stack format (`frame;frame;frame weight` per
+line) that flamegraph.pl, inferno and speedscope read.
+
+`Profiler.allocations()` traces allocations with tracemalloc for a while and
+returns the tracebacks holding the most memory that was allocated (and not
+freed) in that window.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, Optional
+
+MODES = ("wall", "cpu")
+_MAX_DEPTH = 128
+
+
+def _frame_label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> str:
+    labels = []
+    while frame is not None and len(labels) < _MAX_DEPTH:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+class ProfileSession:
+    def __init__(self, mode: str, interval: float, route: Optional[str], max_requests: int):
+        self.mode = mode
+        self.interval = interval
+        self.route = route
+        self.max_requests = max_requests
+        self.samples: Counter = Counter()
+        self.requests = 0
+        self.done = asyncio.Event()
+        # Samples of in-flight requests, kept until we know their route.
+        self._pending: Dict[asyncio.Task, Counter] = {}
+        self._lock = threading.Lock()
+
+    def add(self, task: Optional[asyncio.Task], stack: str, weight: int) -> None:
+        with self._lock:
+            if self.route is None:
+                self.samples[stack] += weight
+            elif task in self._pending:
+                self._pending[task][stack] += weight
+
+    def request_started(self, task: asyncio.Task) -> None:
+        with self._lock:
+            self._pending[task] = Counter()
+
+    def request_finished(self, task: asyncio.Task, route: Optional[str], path: str) -> None:
+        with self._lock:
+            samples = self._pending.pop(task, None)
+        if samples is None or self.done.is_set() or self.route not in (route, path):
+            return
+        self.samples.update(samples)
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            self.done.set()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {weight}\n" for stack, weight in self.samples.most_common())
+
+
+class Profiler:
+    """One profiling or allocation session at a time, for one event loop."""
+
+    def __init__(self):
+        self.session: Optional[ProfileSession] = None
+        self._busy = False
+
+    def _sample(self, session: ProfileSession, loop, thread_id: int, stop: threading.Event) -> None:
+        clock = time.pthread_getcpuclockid(thread_id) if session.mode == "cpu" else None
+        last_cpu = time.clock_gettime(clock) if clock is not None else 0.0
+        while not stop.wait(session.interval):
+            weight = 1
+            if clock is not None:
+                now = time.clock_gettime(clock)
+                weight, last_cpu = int((now - last_cpu) * 1e6), now
+                if weight <= 0:
+                    continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(loop) if session.route else None
+            session.add(task, _stack(frame), weight)
+
+    async def profile(
+        self,
+        seconds: float,
+        mode: str = "wall",
+        interval: float = 0.01,
+        route: Optional[str] = None,
+        requests: int = 0,
+    ) -> ProfileSession:
+        """Sample the event loop for `seconds`, or until `requests` requests for `route` finish."""
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        if self._busy:
+            raise ProfilerBusy()
+        self._busy = True
+        session = ProfileSession(mode, interval, route, requests if route else 0)
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(session, asyncio.get_running_loop(), threading.get_ident(), stop),
+            name="profiler",
+            daemon=True,
+        )
+        self.session = session
+        sampler.start()
+        try:
+            await asyncio.wait_for(session.done.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            stop.set()
+            self.session = None
+            await asyncio.to_thread(sampler.join)
+            self._busy = False
+        return session
+
+    async def allocations(self, seconds: float, top: int = 25, frames: int = 10) -> Dict[str, Any]:
+        """The `top` tracebacks by memory allocated during `seconds` and still held."""
+        if self._busy:
+            raise ProfilerBusy()
+        self._busy = True
+        # Someone may already trace (PYTHONTRACEMALLOC); then diff against now.
+        was_tracing = tracemalloc.is_tracing()
+        try:
+            if was_tracing:
+                before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            else:
+                before = None
+                tracemalloc.start(frames)
+            await asyncio.sleep(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+            self._busy = False
+
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        after = after.filter_traces(ignore)
+        if before is not None:
+            stats = after.compare_to(before.filter_traces(ignore), "traceback")
+            rows = [(stat.traceback, stat.size_diff, stat.count_diff) for stat in stats]
+        else:
+            rows = [(stat.traceback, stat.size, stat.count) for stat in after.statistics("traceback")]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return {
+            "seconds": seconds,
+            "traced_kb": round(current / 1024, 1) if not was_tracing else None,
+            "peak_kb": round(peak / 1024, 1) if not was_tracing else None,
+            "top": [
+                {
+                    "size_kb": round(size / 1024, 1),
+                    "count": count,
+                    "traceback": [f"{frame.filename}:{frame.lineno}" for frame in traceback],
+                }
+                for traceback, size, count in rows[:top]
+            ],
+        }
+
+
+class ProfilerMiddleware:
+    """Tells a route-filtered profile which asyncio task serves which request."""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        session = self.profiler.session
+        if scope["type"] != "http" or session is None or session.route is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        session.request_started(task)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session.request_finished(task, getattr(scope.get("route"), "path", None), scope.get("path", ""))
@@ -0,0 +1,161 @@
+"""
+In-process fan-out of change events to WebSocket / SSE subscribers.
+
+Every write the API makes is appended to `change_log` (see `record_changes` in
+server.py). Each worker opens a single change stream on that collection and
+publishes the inserted entries to an `EventBus`, so events written by any
+worker reach every subscriber. Change streams need a replica set; on a
+standalone MongoDB the feed stays inactive and the server publishes entries to
+the bus directly, which only reaches subscribers connected to the same worker.
+
+Subscribers listen on topics such as `shop:<shop_id>` or `barber:<barber_id>`.
+Each one has a bounded queue: when a slow client falls behind, its backlog is
+dropped and replaced by a `resync` event telling the client to refetch instead
+of replaying what it missed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, Optional, Set
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# "The $changeStream stage is only supported on replica sets"
+_CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", topics: Iterable[str], maxsize: int):
+        self.bus = bus
+        self.topics = frozenset(topics)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(2, maxsize))
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+        # The client fell behind: throw the backlog away and ask it to refetch.
+        dropped = carried = 0
+        while not self.queue.empty():
+            queued = self.queue.get_nowait()
+            if queued.get("type") == "resync":
+                carried += queued["dropped"]
+            else:
+                dropped += 1
+        self.queue.put_nowait({"type": "resync", "dropped": carried + dropped})
+        self.queue.put_nowait(event)
+        self.bus.dropped += dropped
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Next event (possibly a `resync` marker), or None on timeout."""
+
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.published = 0
+        self.dropped = 0
+        self._by_topic: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        subscription = Subscription(self, topics, self.queue_size)
+        for topic in subscription.topics:
+            self._by_topic.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        for topic in subscription.topics:
+            subscribers = self._by_topic.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._by_topic[topic]
+
+    def publish(self, event: Dict[str, Any]) -> int:
+        """Deliver `event` to every subscriber of any of its topics."""
+
+        targets: Set[Subscription] = set()
+        for topic in event.get("topics", ()):
+            targets.update(self._by_topic.get(topic, ()))
+        for subscription in targets:
+            subscription.offer(event)
+        self.published += 1
+        return len(targets)
+
+    def snapshot(self) -> dict:
+        subscriptions = set().union(*self._by_topic.values()) if self._by_topic else set()
+        return {
+            "topics": len(self._by_topic),
+            "subscribers": len(subscriptions),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+def change_event(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a change-log entry as a push event."""
+
+    return {
+        "type": "change",
+        "collection": entry.get("collection"),
+        "id": entry.get("doc_id"),
+        "op": entry.get("op"),
+        "at": entry.get("at"),
+        "data": entry.get("data") or {},
+        "topics": entry.get("topics") or [],
+    }
+
+
+class ChangeLogFeed:
+    """Publishes `change_log` inserts to the bus through one change stream."""
+
+    def __init__(self, collection, bus: EventBus, retry_seconds: float = 5.0):
+        self.collection = collection
+        self.bus = bus
+        self.retry_seconds = retry_seconds
+        self.active = False
+        self.supported = True
+        self._resume_token = None
+
+    async def run(self) -> None:
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while True:
+            try:
+                async with self.collection.watch(pipeline, resume_after=self._resume_token) as stream:
+                    self.active = True
+                    logger.info("Publishing change_log events from a MongoDB change stream")
+                    async for change in stream:
+                        self._resume_token = stream.resume_token
+                        self.bus.publish(change_event(change["fullDocument"]))
+            except asyncio.CancelledError:
+                self.active = False
+                raise
+            except OperationFailure as e:
+                self.active = False
+                if e.code == _CHANGE_STREAM_HISTORY_LOST:
+                    self._resume_token = None
+                if e.code in _CHANGE_STREAMS_UNSUPPORTED:
+                    self.supported = False
+                    logger.info("Change streams unavailable (standalone MongoDB); using the in-process event bus")
+                    return
+                logger.warning(f"Change stream failed, retrying in {self.retry_seconds}s: {e}")
+            except Exception as e:
+                self.active = False
+                logger.warning(f"Change stream failed, retrying in {self.retry_seconds}s: {e}")
+            await asyncio.sleep(self.retry_seconds)
@@ -0,0 +1,235 @@
+"""
+Recurring appointment series, expanded on read.
+
+A series is stored once: the appointment template (shop, barber, client,
+service, first start time) plus an RFC 5545 recurrence rule such as
+`FREQ=WEEKLY;INTERVAL=2` or `FREQ=WEEKLY;COUNT=10`. Reads expand it over the
+window they ask for into virtual appointments. An occurrence's id is derived
+from the series and its slot (`series_ab12cd34ef56-20250107T100000`), so it
+is the same on every read.
+
+Only occurrences that diverge from the series are written to `appointments`,
+with `series_id` and the original `occurrence_time`. These are occurrences
+that were rescheduled, cancelled, completed or given a deposit. Such a
+document replaces the virtual occurrence for its slot.
+"""
+
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
+
+from dateutil import parser as date_parser
+from dateutil.relativedelta import relativedelta
+from dateutil.rrule import rrule, rrulestr
+
+# Sub-daily frequencies would let one series flood a barber's agenda.
+ALLOWED_FREQUENCIES = {"DAILY", "WEEKLY", "MONTHLY"}
+# dateutil searches up to the year 9999 for a rule that matches no date at
+# all (BYMONTH=2;BYMONTHDAY=30, or FREQ=DAILY;INTERVAL=7;BYDAY=TU from a
+# Monday), which takes seconds. With these parts and the checks in
+# `_check_parts`, every rule matches a date within a few years of its start.
+ALLOWED_PARTS = {"FREQ", "INTERVAL", "COUNT", "UNTIL", "BYDAY", "BYMONTHDAY", "WKST"}
+_WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+_BYDAY_RE = re.compile(r"^(?P<nth>[+-]?\d+)?(?P<day>MO|TU|WE|TH|FR|SA|SU)$")
+
+_OCCURRENCE_ID_RE = re.compile(r"^(?P<series>series_[0-9a-f]+)-(?P<slot>\d{8}T\d{6})$")
+_SLOT_FORMAT = "%Y%m%dT%H%M%S"
+
+
+class RecurrenceError(ValueError):
+    pass
+
+
+def _aware(value: Any) -> Optional[datetime]:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    return value
+
+
+def _check_parts(params: Dict[str, str]) -> None:
+    unsupported = sorted(set(params) - ALLOWED_PARTS)
+    if unsupported:
+        raise RecurrenceError(f"Parte de la regla no soportada: {', '.join(unsupported)}")
+    freq = params["FREQ"]
+    days = [_BYDAY_RE.match(day) for day in params.get("BYDAY", "").split(",") if day]
+    if any(match is None for match in days):
+        raise RecurrenceError("BYDAY inválido")
+    nth = [int(match.group("nth")) for match in days if match.group("nth")]
+    if nth and (freq != "MONTHLY" or "BYMONTHDAY" in params or any(not 1 <= abs(n) <= 5 for n in nth)):
+        raise RecurrenceError("BYDAY con posición (por ejemplo 1MO) solo se admite con FREQ=MONTHLY, entre 1 y 5 y sin BYMONTHDAY")
+    if days and freq == "DAILY" and params.get("INTERVAL", "1") != "1":
+        raise RecurrenceError("BYDAY con FREQ=DAILY no admite INTERVAL")
+    if "BYMONTHDAY" in params:
+        try:
+            monthdays = [int(day) for day in params["BYMONTHDAY"].split(",")]
+        except ValueError:
+            raise RecurrenceError("BYMONTHDAY inválido")
+        # Days 29-31 are missing from some months, so e.g. INTERVAL=12 from February never matches.
+        if freq != "MONTHLY" or any(not 1 <= abs(day) <= 28 for day in monthdays):
+            raise RecurrenceError("BYMONTHDAY solo se admite con FREQ=MONTHLY y entre 1 y 28 (o -1 y -28)")
+
+
+@lru_cache(maxsize=1024)
+def _compile(rule: str, start: datetime) -> rrule:
+    return rrulestr(rule, dtstart=start)
+
+
+def parse_rule(
+    rule: str, start: datetime, max_occurrences: int = 5000, horizon: timedelta = timedelta(days=5 * 365)
+) -> Tuple[str, Optional[datetime]]:
+    """Validate `rule` for a series starting at `start`.
+
+    Returns the normalised rule text and the series' last occurrence (None
+    when the rule has neither COUNT nor UNTIL). A series may have at most
+    `max_occurrences` slots and must end within `horizon` of its start, and
+    the rule is only expanded up to that bound, so validating it stays cheap
+    whatever COUNT or UNTIL the client sends.
+    """
+    text = rule.strip()
+    if text.upper().startswith("RRULE:"):
+        text = text[len("RRULE:"):]
+    text = text.upper()
+    try:
+        params = dict(part.split("=", 1) for part in text.split(";") if part)
+    except ValueError:
+        raise RecurrenceError("Regla de recurrencia inválida")
+    if params.get("FREQ") not in ALLOWED_FREQUENCIES:
+        raise RecurrenceError("La frecuencia debe ser DAILY, WEEKLY o MONTHLY")
+    _check_parts(params)
+    start = _aware(start)
+    try:
+        compiled = _compile(text, start)
+        until = _aware(date_parser.parse(params["UNTIL"])) if "UNTIL" in params else None
+    except (ValueError, TypeError, OverflowError) as e:
+        raise RecurrenceError(f"Regla de recurrencia inválida: {e}")
+    count = int(params["COUNT"]) if "COUNT" in params else None
+    if count is not None and count > max_occurrences:
+        raise RecurrenceError(f"La serie no puede tener más de {max_occurrences} citas")
+    if until is not None and until > start + horizon:
+        raise RecurrenceError(f"La serie no puede terminar más de {horizon.days} días después de empezar")
+
+    bounded = compiled.replace(count=None, until=min(until, start + horizon) if until else start + horizon)
+    slots = list(islice(bounded, (count or max_occurrences) + 1))
+    if not slots:
+        raise RecurrenceError("La regla no genera ninguna cita")
+    if count is not None:
+        if len(slots) < count:
+            raise RecurrenceError(f"La serie no puede terminar más de {horizon.days} días después de empezar")
+        return text, slots[count - 1]
+    if until is not None:
+        if len(slots) > max_occurrences:
+            raise RecurrenceError(f"La serie no puede tener más de {max_occurrences} citas")
+        return text, slots[-1]
+    return text, None
+
+
+def _params(rule: str) -> Dict[str, str]:
+    return dict(part.split("=", 1) for part in rule.split(";") if part)
+
+
+def _seek(rule: str, dtstart: datetime, start: datetime, bounded: bool) -> rrule:
+    """A rule with the same slots as `rule` from `start` on, anchored close to it.
+
+    dateutil walks every slot from dtstart to reach `start`, which grows with
+    the series' age. The anchor is dtstart moved forward by a whole number of
+    periods (days, weeks or months times INTERVAL), ending at least one
+    period before `start`, so the slots from there on don't change. What
+    dtstart implied (the weekday of a WEEKLY rule, the day of a MONTHLY one)
+    is written into the rule. COUNT would restart from the anchor, so it is
+    dropped when the series is `bounded` by its stored `ends_at`.
+    """
+    params = _params(rule)
+    freq, interval = params["FREQ"], int(params.get("INTERVAL", "1"))
+    if "COUNT" in params and not bounded:
+        return _compile(rule, dtstart)
+    if freq == "MONTHLY":
+        months = (start.year - dtstart.year) * 12 + start.month - dtstart.month
+        periods = months // interval - 1
+        anchor = dtstart.replace(day=1) + relativedelta(months=periods * interval)
+        if "BYMONTHDAY" not in params and "BYDAY" not in params:
+            params["BYMONTHDAY"] = str(dtstart.day)
+    else:
+        days = 7 * interval if freq == "WEEKLY" else interval
+        periods = (start - dtstart).days // days - 1
+        anchor = dtstart + timedelta(days=periods * days)
+        if freq == "WEEKLY" and "BYDAY" not in params:
+            params["BYDAY"] = _WEEKDAYS[dtstart.weekday()]
+    if periods <= 0:
+        return _compile(rule, dtstart)
+    params.pop("COUNT", None)
+    return _compile(";".join(f"{key}={value}" for key, value in params.items()), anchor)
+
+
+def occurrences(series: Dict[str, Any], start: datetime, end: datetime, limit: int = 5000) -> List[datetime]:
+    """Slots of `series` in [start, end), at most `limit` of them."""
+    start = _aware(start)
+    ends_at = _aware(series.get("ends_at"))
+    if ends_at is not None:
+        end = min(end, ends_at)
+    compiled = _seek(series["rule"], _aware(series["start_time"]), start, ends_at is not None)
+    slots: List[datetime] = []
+    for when in compiled.xafter(start, inc=True):
+        if when >= end or len(slots) >= limit:
+            break
+        slots.append(when)
+    return slots
+
+
+def is_occurrence(series: Dict[str, Any], when: datetime) -> bool:
+    when = _aware(when)
+    return when in occurrences(series, when, when + timedelta(seconds=1), limit=1)
+
+
+def occurrence_id(series_id: str, when: datetime) -> str:
+    return f"{series_id}-{_aware(when).strftime(_SLOT_FORMAT)}"
+
+
+def parse_occurrence_id(appointment_id: str) -> Optional[Tuple[str, datetime]]:
+    """(series_id, slot) for an occurrence id; None for regular appointment ids."""
+    match = _OCCURRENCE_ID_RE.match(appointment_id or "")
+    if match is None:
+        return None
+    try:
+        slot = datetime.strptime(match.group("slot"), _SLOT_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return match.group("series"), slot
+
+
+def occurrence_document(series: Dict[str, Any], when: datetime) -> Dict[str, Any]:
+    """The virtual appointment for one slot, shaped like a stored appointment.
+
+    `virtual` marks it as not stored. Reminders sent for occurrences are
+    tracked on the series as watermarks, so they never force a write here.
+    """
+    reminded_24h = _aware(series.get("reminded_24h_through"))
+    reminded_2h = _aware(series.get("reminded_2h_through"))
+    return {
+        "appointment_id": occurrence_id(series["series_id"], when),
+        "series_id": series["series_id"],
+        "occurrence_time": when,
+        "shop_id": series["shop_id"],
+        "barber_id": series["barber_id"],
+        "client_user_id": series["client_user_id"],
+        "service_id": series["service_id"],
+        "scheduled_time": when,
+        "status": "scheduled",
+        "notes": series.get("notes"),
+        "reminder_sent": reminded_24h is not None and when <= reminded_24h,
+        "reminder_24h_sent": reminded_24h is not None and when <= reminded_24h,
+        "reminder_2h_sent": reminded_2h is not None and when <= reminded_2h,
+        "deposit_required": False,
+        "deposit_amount": None,
+        "deposit_status": "not_required",
+        "deposit_id": None,
+        "created_at": series.get("created_at"),
+        "updated_at": series.get("updated_at"),
+        "version": 0,
+        "virtual": True,
+    }
@@ -0,0 +1,193 @@
+"""
+Single-pass parser for the structured text returned by the AI face scan.
+
+Both scan prompts ask Gemini for labelled sections (`FORMA_DEL_ROSTRO:`,
+`RECOMENDACIONES:` / `CORTE_1:` ... `NOMBRE:` / `DESCRIPCION:`,
+`ANÁLISIS_DETALLADO:` / `ANALISIS:`, `CONSEJOS_ADICIONALES:`). Models don't
+follow the format literally, so the parser accepts markdown decoration
+(`**NOMBRE:**`, `## Recomendaciones`), missing accents, spaces instead of
+underscores and the usual list numbering styles (`1.`, `1)`, `(1)`, `-`, `•`).
+
+`ScanParser.feed()` accepts arbitrary chunks of a streamed response; each line
+is classified once, as soon as it is complete.
+"""
+
+from __future__ import annotations
+
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Section labels, matched case-insensitively with optional accents.
+_LABELS = (
+    r"FORMA[ _]DEL[ _]ROSTRO"
+    r"|RECOMENDACIONES"
+    r"|AN[AÁ]LISIS(?:[ _]DETALLADO)?"
+    r"|CONSEJOS(?:[ _]ADICIONALES)?"
+    r"|CORTE[ _#]*\d+"
+    r"|NOMBRE"
+    r"|DESCRIPCI[OÓ]N"
+)
+
+# A label line: optional markdown/numbering prefix, the label, then either a
+# colon followed by an inline value or nothing else on the line.
+_HEADER_RE = re.compile(
+    r"^[\s#>*_]*(?:\d+[.)]\s*)?[*_]*(?P<label>" + _LABELS + r")[*_]*\s*"
+    r"(?::[*_\s]*(?P<value>.*?)|[*_\s]*)$",
+    re.IGNORECASE,
+)
+
+# A list item in the recommendations section.
+_ITEM_RE = re.compile(r"^(?:[-•*+·]|\(?\d{1,2}\s*[.)\-:])\s*(?P<text>\S.*)$")
+
+# Separator between a style name and its description inside a list item.
+_NAME_SPLIT_RE = re.compile(r"\s*(?:\s[-–—]\s|:\s)\s*")
+
+_MARKDOWN_RE = re.compile(r"[*_`]{1,3}")
+_BRACKETS_RE = re.compile(r"^\[(.*)\]$")
+
+
+def _canonical_label(label: str) -> str:
+    folded = unicodedata.normalize("NFKD", label.upper())
+    folded = "".join(ch for ch in folded if not unicodedata.combining(ch))
+    folded = re.sub(r"[\s_#]+", "_", folded)
+    if folded.startswith("CORTE"):
+        return "CORTE"
+    if folded.startswith("ANALISIS"):
+        return "ANALISIS"
+    if folded.startswith("CONSEJOS"):
+        return "CONSEJOS"
+    return folded
+
+
+def _clean(text: str) -> str:
+    text = _MARKDOWN_RE.sub("", text).strip()
+    match = _BRACKETS_RE.match(text)
+    return match.group(1).strip() if match else text
+
+
+@dataclass
+class ParsedStyle:
+    name: str
+    description: str = ""
+    raw: str = ""
+
+
+@dataclass
+class ScanResult:
+    face_shape: Optional[str] = None
+    styles: List[ParsedStyle] = field(default_factory=list)
+    detailed_analysis: Optional[str] = None
+    tips: Optional[str] = None
+
+
+class ScanParser:
+    """Incremental parser; call `feed()` with chunks and `close()` at the end."""
+
+    def __init__(self):
+        self.result = ScanResult()
+        self._buffer = ""
+        self._section: Optional[str] = None
+        self._cut: Optional[ParsedStyle] = None
+        self._cut_field: Optional[str] = None
+        self._analysis: List[str] = []
+        self._tips: List[str] = []
+
+    def feed(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self._buffer += chunk
+        if "\n" not in chunk:
+            return
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._line(line)
+
+    def close(self) -> ScanResult:
+        if self._buffer:
+            self._line(self._buffer)
+            self._buffer = ""
+        self._flush_cut()
+        if self._analysis:
+            self.result.detailed_analysis = " ".join(self._analysis)
+        if self._tips:
+            self.result.tips = " ".join(self._tips)
+        return self.result
+
+    def _line(self, line: str) -> None:
+        line = line.strip()
+        if not line:
+            return
+
+        header = _HEADER_RE.match(line)
+        if header:
+            self._header(_canonical_label(header.group("label")), _clean(header.group("value") or ""))
+            return
+
+        section = self._section
+        if section == "RECOMENDACIONES":
+            item = _ITEM_RE.match(line)
+            if item:
+                self._add_item(_clean(item.group("text")))
+        elif section == "ANALISIS":
+            self._analysis.append(_clean(line))
+        elif section == "CONSEJOS":
+            self._tips.append(_clean(line))
+        elif section == "CORTE" and self._cut is not None and self._cut_field == "description":
+            # Descriptions that wrap onto several lines.
+            self._cut.description = f"{self._cut.description} {_clean(line)}".strip()
+
+    def _header(self, label: str, value: str) -> None:
+        if label == "FORMA_DEL_ROSTRO":
+            if value:
+                self.result.face_shape = value
+            self._section = None
+        elif label == "CORTE":
+            self._flush_cut()
+            self._cut = ParsedStyle(name="")
+            self._section = "CORTE"
+            self._cut_field = None
+        elif label == "NOMBRE":
+            if self._cut is None or self._cut.name:
+                self._flush_cut()
+                self._cut = ParsedStyle(name="")
+            self._cut.name = value
+            self._section = "CORTE"
+            self._cut_field = "name"
+        elif label == "DESCRIPCION":
+            if self._cut is None:
+                self._cut = ParsedStyle(name="")
+            self._cut.description = value
+            self._section = "CORTE"
+            self._cut_field = "description"
+        else:
+            self._flush_cut()
+            self._section = label
+            if value and label == "ANALISIS":
+                self._analysis.append(value)
+            elif value and label == "CONSEJOS":
+                self._tips.append(value)
+
+    def _add_item(self, text: str) -> None:
+        if not text:
+            return
+        parts = _NAME_SPLIT_RE.split(text, maxsplit=1)
+        name = parts[0].strip()
+        description = parts[1].strip() if len(parts) > 1 else ""
+        self.result.styles.append(ParsedStyle(name=name, description=description, raw=text))
+
+    def _flush_cut(self) -> None:
+        cut = self._cut
+        self._cut = None
+        self._cut_field = None
+        if cut is None or not cut.name:
+            return
+        cut.raw = f"{cut.name} - {cut.description}" if cut.description else cut.name
+        self.result.styles.append(cut)
+
+
+def parse_scan_response(text: str) -> ScanResult:
+    parser = ScanParser()
+    parser.feed(text)
+    return parser.close()
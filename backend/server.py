@@ -1,30 +1,154 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict
+from fastapi.responses import RedirectResponse, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from bson import json_util
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from PIL import Image
+from pydantic import BaseModel, Field, ValidationError, EmailStr
+from typing import Any, AsyncIterator, List, Optional, Dict, Tuple
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from pathlib import Path
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
 from emergentintegrations.llm.openai.image_generation import OpenAIImageGeneration
+from llm_resilience import CircuitBreaker, CircuitOpenError
+from llm_router import ModelRoute, ModelRouter, parse_model_list
+from fake_llm import FakeLlmChat
+from scan_parser import parse_scan_response
+from ai_usage import QuotaExceeded, UsageTracker
+from realtime import ChangeLogFeed, EventBus, change_event
+from live_dashboard import DashboardHub, ShopDashboard
+from db_accounting import DbAccountingMiddleware, DbCallListener
+from slow_log import SlowLog, SlowRequestMiddleware
+from health import HealthCheck, PoolUsage
+from loop_monitor import LoopLagMonitor
+from profiler import MODES as PROFILE_MODES, Profiler, ProfilerBusy, ProfilerMiddleware
+from tracing import MongoTracingListener, OtlpFileExporter, OtlpHttpExporter, Tracer, TracingMiddleware
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, MetricsRegistry, MongoCommandMetrics
+from recurrence import RecurrenceError, is_occurrence, occurrence_document, occurrences, parse_occurrence_id, parse_rule
+from cachetools import TTLCache
 import os
 import logging
 import uuid
 import base64
+import codecs
+import csv
+import json
 import asyncio
 import httpx
+import hashlib
+import math
+import re
+import secrets
+import time
+from collections import defaultdict
+from functools import lru_cache, wraps
 from io import BytesIO
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics exported at /metrics in the Prometheus text format
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter("http_requests_total", "HTTP requests by route and status code", ["method", "route", "status"])
+HTTP_LATENCY = metrics.histogram("http_request_duration_seconds", "HTTP request latency by route", ["method", "route"])
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "HTTP requests being served")
+MONGO_LATENCY = metrics.histogram("mongodb_command_duration_seconds", "MongoDB command latency", ["collection", "command"])
+MONGO_FAILURES = metrics.counter("mongodb_command_failures_total", "Failed MongoDB commands", ["collection", "command"])
+LLM_LATENCY = metrics.histogram("llm_request_duration_seconds", "LLM call latency per model", ["task", "model", "outcome"])
+PUSH_NOTIFICATIONS = metrics.counter("push_notifications_total", "Expo push notifications by outcome", ["outcome"])
+PUSH_BACKLOG = metrics.gauge("push_notifications_pending", "Push notifications waiting to be sent to Expo")
+AI_IN_FLIGHT = metrics.gauge("ai_requests_in_flight", "AI endpoint calls waiting on the provider")
+LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds", "Event loop lag, sampled every 250 ms",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_BLOCKS = metrics.counter("event_loop_blocks_total", "Times the event loop was blocked past LOOP_BLOCK_MS, by code site", ["site"])
+
+# Per-request MongoDB call accounting; requests above these thresholds are
+# logged as warnings (0 disables a threshold).
+DB_ACCOUNTING_ENABLED = os.environ.get('DB_ACCOUNTING_ENABLED', '1') == '1'
+DB_STATS_HEADERS = os.environ.get('DB_STATS_HEADERS', '0') == '1'
+DB_WARN_QUERIES = int(os.environ.get('DB_WARN_QUERIES', '25'))
+DB_WARN_MS = float(os.environ.get('DB_WARN_MS', '250'))
+DB_WARN_REPEATS = int(os.environ.get('DB_WARN_REPEATS', '10'))
+
+# Span tracing, exported as OTLP/JSON to TRACE_OTLP_ENDPOINT (an OTLP/HTTP
+# collector, e.g. http://localhost:4318/v1/traces) or appended to TRACE_FILE.
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', '')
+TRACE_EXPORT_SECONDS = float(os.environ.get('TRACE_EXPORT_SECONDS', '5'))
+tracer = Tracer(
+    OtlpHttpExporter(TRACE_OTLP_ENDPOINT) if TRACE_OTLP_ENDPOINT else OtlpFileExporter(os.environ.get('TRACE_FILE', 'traces.jsonl')),
+    service_name=os.environ.get('TRACE_SERVICE_NAME', 'barbershop-api'),
+    sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', '1.0')) if TRACING_ENABLED else 0.0,
+)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+pool_usage = PoolUsage(MONGO_MAX_POOL_SIZE)
+mongo_listeners = [pool_usage]
+if TRACING_ENABLED:
+    mongo_listeners.append(MongoTracingListener(tracer))
+if METRICS_ENABLED:
+    mongo_listeners.append(MongoCommandMetrics(MONGO_LATENCY, MONGO_FAILURES))
+if DB_ACCOUNTING_ENABLED:
+    mongo_listeners.append(DbCallListener())
+client = AsyncIOMotorClient(mongo_url, maxPoolSize=MONGO_MAX_POOL_SIZE, event_listeners=mongo_listeners)
 db = client[os.environ.get('DB_NAME', 'barbershop_db')]
 
+# Slow requests (or requests with a slow query) are logged as JSON and kept in
+# the capped `slow_log` collection; a sample gets the query plan attached.
+SLOW_LOG_ENABLED = os.environ.get('SLOW_LOG_ENABLED', '1') == '1'
+slow_log = SlowLog(
+    db,
+    slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS', '500')),
+    slow_query_ms=float(os.environ.get('SLOW_QUERY_MS', '100')),
+    explain_sample=float(os.environ.get('SLOW_EXPLAIN_SAMPLE', '0.1')),
+    capped_bytes=int(os.environ.get('SLOW_LOG_MB', '16')) * 1024 * 1024,
+)
+
+# /health/ready answers 503 while Mongo doesn't answer a ping or a saturation
+# signal is over its limit, so load balancers drain the worker (0 disables a limit).
+# A watchdog logs the stack of whatever keeps the loop busy past LOOP_BLOCK_MS.
+loop_monitor = LoopLagMonitor(
+    block_threshold=float(os.environ.get('LOOP_BLOCK_MS', '100')) / 1000,
+    on_lag=LOOP_LAG.observe,
+    on_block=lambda blocked: LOOP_BLOCKS.inc(blocked.site),
+)
+health = HealthCheck(
+    db,
+    loop_monitor,
+    pool_usage,
+    gauges={
+        "ai_in_flight": lambda: AI_IN_FLIGHT.totals().get((), 0.0),
+        "push_backlog": lambda: PUSH_BACKLOG.totals().get((), 0.0),
+    },
+    limits={
+        "mongo_ping_ms": float(os.environ.get('HEALTH_MAX_PING_MS', '1000')),
+        "loop_lag_ms": float(os.environ.get('HEALTH_MAX_LOOP_LAG_MS', '500')),
+        "mongo_pool_waiting": float(os.environ.get('HEALTH_MAX_POOL_WAITING', '50')),
+        "ai_in_flight": float(os.environ.get('HEALTH_MAX_AI_IN_FLIGHT', '0')),
+        "push_backlog": float(os.environ.get('HEALTH_MAX_PUSH_BACKLOG', '0')),
+    },
+)
+
+# The /api/admin endpoints (profiler, slow log, loop blocks) exist only when
+# ADMIN_TOKEN is set, and require it in the X-Admin-Token header. PROFILER_TOKEN
+# is its earlier name.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', os.environ.get('PROFILER_TOKEN', ''))
+profiler = Profiler()
+
+# Upper bound for the `limit` of list endpoints; use `cursor` to walk further
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '500'))
+
 # Create the main app
 app = FastAPI(title="BarberShop API")
 
@@ -38,7 +162,25 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Current-Version", "X-DB-Queries", "X-DB-Documents", "X-DB-Time-Ms"],
 )
+if ADMIN_TOKEN:
+    app.add_middleware(ProfilerMiddleware, profiler=profiler)
+if SLOW_LOG_ENABLED:
+    # Added first so it runs inside DbAccountingMiddleware and sees the request's queries.
+    app.add_middleware(SlowRequestMiddleware, slow_log=slow_log)
+if DB_ACCOUNTING_ENABLED:
+    app.add_middleware(
+        DbAccountingMiddleware,
+        max_queries=DB_WARN_QUERIES,
+        max_db_ms=DB_WARN_MS,
+        max_repeats=DB_WARN_REPEATS,
+        headers=DB_STATS_HEADERS,
+    )
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, requests=HTTP_REQUESTS, latency=HTTP_LATENCY, in_flight=HTTP_IN_FLIGHT)
 
 # Configure logging
 logging.basicConfig(
@@ -79,6 +221,8 @@ class Barbershop(BaseModel):
     location: Optional[dict] = None  # {"lat": float, "lng": float}
     capacity: Optional[int] = Field(default=None, ge=1, description="Cantidad de sillas o citas simultáneas")
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
 
 class BarbershopCreate(BaseModel):
     owner_user_id: str
@@ -101,6 +245,8 @@ class Barber(BaseModel):
     rating: float = 0.0
     total_reviews: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
 
 class BarberCreate(BaseModel):
     shop_id: str
@@ -118,6 +264,8 @@ class Service(BaseModel):
     duration: int  # minutes
     image: Optional[str] = None  # base64
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
 
 class ServiceCreate(BaseModel):
     shop_id: str
@@ -142,8 +290,11 @@ class Appointment(BaseModel):
     deposit_amount: Optional[float] = Field(default=None, ge=0)
     deposit_status: str = "not_required"  # not_required, pending, paid, failed, refunded
     deposit_id: Optional[str] = None
+    series_id: Optional[str] = None  # set on occurrences of a recurring series
+    occurrence_time: Optional[datetime] = None  # the series slot this occurrence fills
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
 
 class AppointmentCreate(BaseModel):
     shop_id: str
@@ -155,6 +306,51 @@ class AppointmentCreate(BaseModel):
     deposit_required: bool = False
     deposit_amount: Optional[float] = Field(default=None, ge=0)
 
+class AppointmentSeries(BaseModel):
+    series_id: str = Field(default_factory=lambda: f"series_{uuid.uuid4().hex[:12]}")
+    shop_id: str
+    barber_id: str
+    client_user_id: str
+    service_id: str
+    start_time: datetime  # first occurrence
+    rule: str  # RRULE, e.g. "FREQ=WEEKLY;INTERVAL=2"
+    notes: Optional[str] = None
+    status: str = "active"  # active, cancelled
+    ends_at: Optional[datetime] = None  # exclusive; None while the rule is open-ended
+    reminded_24h_through: Optional[datetime] = None
+    reminded_2h_through: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
+
+class AppointmentSeriesCreate(BaseModel):
+    shop_id: str
+    barber_id: str
+    client_user_id: str
+    service_id: str
+    start_time: datetime
+    rule: str
+    notes: Optional[str] = None
+
+
+class AgendaAppointment(Appointment):
+    client_name: Optional[str] = None
+    client_phone: Optional[str] = None
+    service_name: Optional[str] = None
+    service_duration: Optional[int] = None
+    service_price: Optional[float] = None
+
+class BarberAgenda(BaseModel):
+    barber: Barber
+    appointments: List[AgendaAppointment]
+
+class CatalogShop(Barbershop):
+    services: List[Service] = Field(default_factory=list)
+    barbers: List[Barber] = Field(default_factory=list)
+
+class BookingBootstrap(BaseModel):
+    shops: List[CatalogShop]
+    upcoming_appointments: List[Appointment] = Field(default_factory=list)
 
 class RescheduleRequest(BaseModel):
     new_time: datetime
@@ -173,6 +369,7 @@ class Deposit(BaseModel):
     metadata: Dict[str, str] = Field(default_factory=dict)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 0
 
 
 class DepositCreate(BaseModel):
@@ -273,16 +470,93 @@ def validate_working_hours(working_hours: dict):
             raise HTTPException(status_code=400, detail=f"La hora de apertura debe ser menor a cierre para {day}")
 
 
-def generate_referral_code(email: str) -> str:
+def generate_referral_code(email: str, random_chars: int = 4) -> str:
+    """Email prefix plus random hex; callers retry with more random chars on collision."""
     prefix = email.split("@")[0][:4].upper()
-    return f"{prefix}{uuid.uuid4().hex[:4].upper()}"
+    return f"{prefix}{secrets.token_hex(8)[:random_chars].upper()}"
+
+
+REFERRAL_CODE_ATTEMPTS = 5
+
+
+def _referral_code_length(attempt: int) -> int:
+    # 4 chars normally; widen after repeated collisions so retries converge fast
+    return 4 if attempt < 2 else 8
+
+
+async def backfill_referral_codes(batch_size: int = 500):
+    """One-shot migration: index referral codes as unique and fill in missing ones.
+
+    Runs in the background at startup. Duplicated codes are reassigned first so
+    the unique index can be built; the conditional filters make concurrent runs
+    from several workers safe.
+    """
+    if await db.migrations.find_one({"_id": "referral_codes_v1"}):
+        return
+    try:
+        duplicates = await db.users.aggregate([
+            {"$match": {"referral_code": {"$gt": ""}}},
+            {"$group": {"_id": "$referral_code", "user_ids": {"$push": "$user_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]).to_list(None)
+        for dup in duplicates:
+            await db.users.update_many(
+                {"user_id": {"$in": dup["user_ids"][1:]}, "referral_code": dup["_id"]},
+                {"$set": {"referral_code": None}}
+            )
+
+        await db.users.create_index(
+            "referral_code",
+            unique=True,
+            partialFilterExpression={"referral_code": {"$gt": ""}}
+        )
+
+        updated = 0
+        for attempt in range(REFERRAL_CODE_ATTEMPTS):
+            collided = False
+            while not collided:
+                users = await db.users.find(
+                    {"referral_code": {"$in": [None, ""]}},
+                    {"_id": 0, "user_id": 1, "email": 1}
+                ).limit(batch_size).to_list(batch_size)
+                if not users:
+                    break
+                operations = [
+                    UpdateOne(
+                        {"user_id": user["user_id"], "referral_code": {"$in": [None, ""]}},
+                        {"$set": {"referral_code": generate_referral_code(user.get("email") or "user", _referral_code_length(attempt))}}
+                    )
+                    for user in users
+                ]
+                try:
+                    result = await db.users.bulk_write(operations, ordered=False)
+                    updated += result.modified_count
+                except BulkWriteError as e:
+                    # Collisions with existing codes: retry those users with longer codes
+                    updated += e.details.get("nModified", 0)
+                    collided = True
+            if not collided:
+                break
+        if collided:
+            logger.warning("Referral code backfill stopped after repeated collisions; will retry on next start")
+            return
+
+        await db.migrations.update_one(
+            {"_id": "referral_codes_v1"},
+            {"$set": {"completed_at": datetime.now(timezone.utc), "updated": updated}},
+            upsert=True
+        )
+        logger.info(f"Referral code backfill finished: {updated} users updated")
+    except Exception as e:
+        logger.error(f"Referral code backfill failed: {e}")
 
 
 async def ensure_loyalty_rules():
     rules = await db.loyalty_rules.find_one({"rule_id": "default"}, {"_id": 0})
     if not rules:
         default_rules = LoyaltyRules().dict()
-        await db.loyalty_rules.insert_one(default_rules)
+        # insert_one adds an ObjectId `_id` to the dict it is given
+        await db.loyalty_rules.insert_one(dict(default_rules))
         return default_rules
     return rules
 
@@ -291,16 +565,24 @@ async def ensure_wallet(user_id: str) -> dict:
     wallet = await db.loyalty_wallets.find_one({"user_id": user_id}, {"_id": 0})
     if not wallet:
         wallet = LoyaltyWallet(user_id=user_id).dict()
-        await db.loyalty_wallets.insert_one(wallet)
+        await db.loyalty_wallets.insert_one(dict(wallet))
     return wallet
 
 
+# Overridable so benchmarks and staging can point pushes at a stub server.
+EXPO_PUSH_URL = os.environ.get('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+
+
 async def send_push_notification(user_id: str, title: str, body: str):
+    pending = 0
     try:
         tokens = await db.push_tokens.find({"user_id": user_id}, {"_id": 0, "token": 1}).to_list(10)
         if not tokens:
+            PUSH_NOTIFICATIONS.inc("no_tokens")
             return
 
+        pending = len(tokens)
+        PUSH_BACKLOG.inc(amount=pending)
         async with httpx.AsyncClient(timeout=5) as client_httpx:
             for item in tokens:
                 payload = {
@@ -309,9 +591,17 @@ async def send_push_notification(user_id: str, title: str, body: str):
                     "title": title,
                     "body": body,
                 }
-                await client_httpx.post("https://exp.host/--/api/v2/push/send", json=payload)
+                with tracer.span("push.send", "client", {"http.url": EXPO_PUSH_URL, "user_id": user_id}) as span:
+                    response = await client_httpx.post(EXPO_PUSH_URL, json=payload)
+                    span.set("http.status_code", response.status_code)
+                PUSH_NOTIFICATIONS.inc("sent" if response.is_success else "rejected")
+                PUSH_BACKLOG.dec()
+                pending -= 1
     except Exception as e:
+        PUSH_NOTIFICATIONS.inc("error")
         logger.warning(f"No se pudo enviar push: {e}")
+    finally:
+        PUSH_BACKLOG.dec(amount=pending)
 
 
 def to_aware_datetime(value: datetime) -> datetime:
@@ -330,6 +620,403 @@ def to_aware_datetime(value: datetime) -> datetime:
     return parsed.astimezone(timezone.utc)
 
 
+# Keyset pagination: pages are fetched with a range filter on the sort key
+# (plus _id as tie-breaker), so page N costs the same as page 1.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+
+def _keyset_filter(sort: List[tuple], values: list) -> dict:
+    clauses = []
+    for index, (field, direction) in enumerate(sort):
+        clause = {prev_field: values[prev] for prev, (prev_field, _) in enumerate(sort[:index])}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[index]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+async def paginate(collection, query: dict, sort: List[tuple], limit: int, cursor: Optional[str], response: Response) -> List[dict]:
+    """Fetch one page ordered by `sort` + `_id` and set the next cursor header."""
+    sort = list(sort) + [("_id", sort[-1][1] if sort else 1)]
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(sort):
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        query = {"$and": [query, _keyset_filter(sort, values)]} if query else _keyset_filter(sort, values)
+
+    docs = await collection.find(query).sort(sort).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([docs[-1].get(field) for field, _ in sort])
+    for doc in docs:
+        doc.pop("_id", None)
+    return docs
+
+
+# Fields a client can never $set directly.
+_PROTECTED_FIELDS = {"_id", "version"}
+
+
+async def update_document(
+    collection,
+    query: dict,
+    updates: dict,
+    not_found: str,
+    expected_version: Optional[int] = None,
+    projection: Optional[dict] = None,
+) -> dict:
+    """Atomically `$set` `updates`, bump `version` and return the post-image.
+
+    With `expected_version` the write only applies if the stored version still
+    matches (documents written before versioning count as 0); otherwise a 409
+    is raised with the current version in `X-Current-Version`. Raises a 404 with `not_found` when
+    nothing matches `query`.
+    """
+    changes = {key: value for key, value in updates.items() if key not in _PROTECTED_FIELDS}
+    changes["updated_at"] = datetime.now(timezone.utc)
+    guarded = dict(query)
+    if expected_version is not None:
+        guarded["version"] = expected_version if expected_version else {"$in": [0, None]}
+
+    doc = await collection.find_one_and_update(
+        guarded,
+        {"$set": changes, "$inc": {"version": 1}},
+        projection=projection or {"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is not None:
+        return doc
+    if expected_version is not None:
+        current = await collection.find_one(query, {"_id": 0, "version": 1})
+        if current is not None:
+            raise HTTPException(
+                status_code=409,
+                detail="El documento cambió, recarga e inténtalo de nuevo",
+                headers={"X-Current-Version": str(current.get("version", 0))}
+            )
+    raise HTTPException(status_code=404, detail=not_found)
+
+
+def expected_version(updates: dict) -> Optional[int]:
+    """Optimistic-concurrency token sent by the client alongside its changes."""
+    version = updates.get("version")
+    if version is None:
+        return None
+    if isinstance(version, bool) or not isinstance(version, int):
+        raise HTTPException(status_code=400, detail="version debe ser un entero")
+    return version
+
+
+# Shops with their services and barbers, minus base64 blobs. Shared by the
+# bootstrap endpoint; catalog writes invalidate it and the TTL bounds how stale
+# other workers can be. Shops are loaded CATALOG_PAGE_SIZE at a time. Each
+# invalidation bumps the generation, and a load that overlapped one is
+# returned but not cached.
+CATALOG_CACHE_SECONDS = int(os.environ.get('CATALOG_CACHE_SECONDS', '30'))
+CATALOG_PAGE_SIZE = int(os.environ.get('CATALOG_PAGE_SIZE', str(MAX_PAGE_SIZE)))
+_catalog_cache = TTLCache(maxsize=1, ttl=CATALOG_CACHE_SECONDS)
+_catalog_lock = asyncio.Lock()
+_catalog_generation = 0
+
+REALTIME_QUEUE_SIZE = int(os.environ.get('REALTIME_QUEUE_SIZE', '100'))
+event_bus = EventBus(queue_size=REALTIME_QUEUE_SIZE)
+change_feed = ChangeLogFeed(db.change_log, event_bus)
+metrics.gauge("realtime_subscribers", "Open WebSocket/SSE subscriptions", function=lambda: event_bus.snapshot()["subscribers"])
+metrics.gauge("realtime_events_published", "Push events published since start", function=lambda: event_bus.published)
+metrics.gauge("realtime_events_dropped", "Push events dropped for slow subscribers since start", function=lambda: event_bus.dropped)
+
+
+def invalidate_catalog():
+    global _catalog_generation
+    _catalog_generation += 1
+    _catalog_cache.clear()
+
+
+# Every write to a synced collection appends to `change_log`; `/api/sync` reads
+# it to return only what changed since the client's token. Appointment entries
+# carry an `audience` (client user_id and barber_id) so each caller only sees
+# their own.
+SYNC_ID_FIELDS = {
+    "barbershops": "shop_id",
+    "barbers": "barber_id",
+    "services": "service_id",
+    "appointments": "appointment_id",
+    "appointment_series": "series_id",
+}
+CATALOG_COLLECTIONS = ("barbershops", "barbers", "services")
+SYNC_RETENTION_DAYS = int(os.environ.get('SYNC_RETENTION_DAYS', '30'))
+
+
+def change_entry(
+    collection: str,
+    doc_id: str,
+    op: str = "upsert",
+    audience: Optional[List[str]] = None,
+    topics: Optional[List[str]] = None,
+    data: Optional[dict] = None,
+    at: Optional[datetime] = None,
+) -> dict:
+    entry = {"collection": collection, "doc_id": doc_id, "op": op, "at": at or datetime.now(timezone.utc)}
+    if audience:
+        entry["audience"] = [member for member in audience if member]
+    if topics:
+        entry["topics"] = topics
+    if data:
+        entry["data"] = data
+    return entry
+
+
+async def write_change_entries(entries: List[dict]):
+    """Persist change-log entries in one insert and push them if no change stream does."""
+    if any(entry["collection"] in CATALOG_COLLECTIONS for entry in entries):
+        invalidate_catalog()
+    if not entries:
+        return
+    try:
+        await db.change_log.insert_many(entries, ordered=False)
+    except Exception as e:
+        logger.warning(f"Could not record {len(entries)} changes in change log: {e}")
+    if not change_feed.active:
+        for entry in entries:
+            if entry.get("topics"):
+                event_bus.publish(change_event(entry))
+
+
+async def record_changes(
+    collection: str,
+    doc_ids: List[str],
+    op: str = "upsert",
+    audience: Optional[List[str]] = None,
+    topics: Optional[List[str]] = None,
+    data: Optional[dict] = None,
+):
+    """Append change-log entries (op is "upsert" or "delete").
+
+    `topics` route the entry to push subscribers and `data` is a small summary
+    sent along with it.
+    """
+    if collection in CATALOG_COLLECTIONS:
+        invalidate_catalog()
+    now = datetime.now(timezone.utc)
+    await write_change_entries([
+        change_entry(collection, doc_id, op, audience, topics, data, now) for doc_id in doc_ids
+    ])
+
+
+def push_topics(shop_id: Optional[str] = None, barber_id: Optional[str] = None) -> List[str]:
+    topics = []
+    if shop_id:
+        topics.append(f"shop:{shop_id}")
+    if barber_id:
+        topics.append(f"barber:{barber_id}")
+    return topics
+
+
+def appointment_change_entry(appt: dict, op: str = "upsert", at: Optional[datetime] = None) -> dict:
+    return change_entry(
+        "appointments",
+        appt["appointment_id"],
+        op,
+        audience=[appt.get("client_user_id"), appt.get("barber_id")],
+        topics=push_topics(appt.get("shop_id"), appt.get("barber_id")),
+        data={key: appt[key] for key in ("status", "scheduled_time", "service_id") if key in appt},
+        at=at,
+    )
+
+
+def service_change_entry(service: dict, op: str = "upsert", at: Optional[datetime] = None) -> dict:
+    return change_entry(
+        "services",
+        service["service_id"],
+        op,
+        topics=push_topics(service.get("shop_id")),
+        data={key: service[key] for key in ("name", "price") if key in service},
+        at=at,
+    )
+
+
+def barber_change_entry(barber: dict, op: str = "upsert", at: Optional[datetime] = None) -> dict:
+    return change_entry(
+        "barbers",
+        barber["barber_id"],
+        op,
+        topics=push_topics(barber.get("shop_id"), barber["barber_id"]),
+        data={"status": barber.get("status")},
+        at=at,
+    )
+
+
+def barbershop_change_entry(shop: dict, op: str = "upsert", at: Optional[datetime] = None) -> dict:
+    return change_entry(
+        "barbershops",
+        shop["shop_id"],
+        op,
+        topics=push_topics(shop["shop_id"]),
+        data={"capacity": shop.get("capacity")},
+        at=at,
+    )
+
+
+def series_change_entry(series: dict, op: str = "upsert", at: Optional[datetime] = None) -> dict:
+    return change_entry(
+        "appointment_series",
+        series["series_id"],
+        op,
+        audience=[series.get("client_user_id"), series.get("barber_id")],
+        topics=push_topics(series.get("shop_id"), series.get("barber_id")),
+        data={key: series[key] for key in ("rule", "status", "ends_at") if key in series},
+        at=at,
+    )
+
+
+# Fields appointment_change_entry reads, for writes that don't return the full document.
+APPOINTMENT_CHANGE_PROJECTION = {
+    "_id": 0, "client_user_id": 1, "barber_id": 1, "shop_id": 1, "status": 1, "scheduled_time": 1, "service_id": 1,
+}
+
+
+async def record_appointment_change(appointment_id: str, op: str = "upsert", appt: Optional[dict] = None):
+    if appt is None:
+        appt = await db.appointments.find_one({"appointment_id": appointment_id}, APPOINTMENT_CHANGE_PROJECTION) or {}
+    await write_change_entries([appointment_change_entry({**appt, "appointment_id": appointment_id}, op)])
+
+
+async def record_service_change(service: dict, op: str = "upsert"):
+    await write_change_entries([service_change_entry(service, op)])
+
+
+async def record_barber_change(barber: dict, op: str = "upsert"):
+    await write_change_entries([barber_change_entry(barber, op)])
+
+
+async def load_catalog() -> List[dict]:
+    catalog = _catalog_cache.get("shops")
+    if catalog is not None:
+        return catalog
+    async with _catalog_lock:
+        catalog = _catalog_cache.get("shops")
+        if catalog is not None:
+            return catalog
+
+        generation = _catalog_generation
+        catalog = []
+        last_id = None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            shops = await db.barbershops.find(query, {"photos": 0}).sort("_id", 1).to_list(CATALOG_PAGE_SIZE)
+            if not shops:
+                break
+            last_id = shops[-1]["_id"]
+            shop_ids = [shop["shop_id"] for shop in shops]
+            services, barbers = await asyncio.gather(
+                db.services.find({"shop_id": {"$in": shop_ids}}, {"_id": 0, "image": 0}).to_list(None),
+                db.barbers.find({"shop_id": {"$in": shop_ids}}, {"_id": 0, "portfolio": 0}).to_list(None),
+            )
+            by_shop = {shop_id: {"services": [], "barbers": []} for shop_id in shop_ids}
+            for service in services:
+                by_shop[service["shop_id"]]["services"].append(service)
+            for barber in barbers:
+                by_shop[barber["shop_id"]]["barbers"].append(barber)
+            for shop in shops:
+                shop.pop("_id")
+                catalog.append({**shop, **by_shop[shop["shop_id"]]})
+            if len(shops) < CATALOG_PAGE_SIZE:
+                break
+        if generation == _catalog_generation:
+            _catalog_cache["shops"] = catalog
+        return catalog
+
+
+# Recurring series are expanded per read (see recurrence.py). Windows without
+# a lower bound start at SERIES_EPOCH; SERIES_MAX_EXPANSION caps the
+# occurrences one series contributes to a single read and, with
+# SERIES_MAX_DAYS, bounds how long a series with COUNT or UNTIL may run.
+SERIES_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+SERIES_MAX_EXPANSION = int(os.environ.get('SERIES_MAX_EXPANSION', '5000'))
+SERIES_MAX_DAYS = int(os.environ.get('SERIES_MAX_DAYS', '1825'))
+
+
+async def series_occurrences(query: dict, start: datetime, end: datetime) -> List[dict]:
+    """Virtual appointments of the active series matching `query` in [start, end).
+
+    Slots that already have a stored exception are left out; the stored
+    document is returned by the regular appointment query instead (or not at
+    all if it was moved out of the window).
+    """
+    start, end = to_aware_datetime(start), to_aware_datetime(end)
+    series_list = await db.appointment_series.find({
+        **query,
+        "status": "active",
+        "start_time": {"$lt": end},
+        "$or": [{"ends_at": None}, {"ends_at": {"$gt": start}}],
+    }, {"_id": 0}).to_list(None)
+    if not series_list:
+        return []
+    exceptions = {
+        doc["appointment_id"]
+        async for doc in db.appointments.find(
+            {"series_id": {"$in": [series["series_id"] for series in series_list]},
+             "occurrence_time": {"$gte": start, "$lt": end}},
+            {"_id": 0, "appointment_id": 1}
+        )
+    }
+    virtual = []
+    for series in series_list:
+        for when in occurrences(series, start, end, SERIES_MAX_EXPANSION):
+            doc = occurrence_document(series, when)
+            if doc["appointment_id"] not in exceptions:
+                virtual.append(doc)
+    return virtual
+
+
+async def load_occurrence(appointment_id: str) -> Optional[dict]:
+    """The virtual appointment behind an occurrence id, or None."""
+    parsed = parse_occurrence_id(appointment_id)
+    if parsed is None:
+        return None
+    series_id, when = parsed
+    series = await db.appointment_series.find_one({"series_id": series_id, "status": "active"}, {"_id": 0})
+    if series is None or not is_occurrence(series, when):
+        return None
+    return occurrence_document(series, when)
+
+
+async def materialize_occurrence(appointment_id: str) -> Optional[dict]:
+    """Store an occurrence as an exception so it can diverge from its series.
+
+    A no-op for regular ids and for occurrences that are already stored.
+    """
+    virtual = await load_occurrence(appointment_id)
+    if virtual is None:
+        return None
+    virtual.pop("virtual")
+    try:
+        await db.appointments.update_one({"appointment_id": appointment_id}, {"$setOnInsert": virtual}, upsert=True)
+    except DuplicateKeyError:
+        pass  # stored concurrently by another request
+    return virtual
+
+
+def merge_occurrences(appointments: List[dict], virtual: List[dict]) -> List[dict]:
+    return sorted(
+        appointments + virtual,
+        key=lambda appt: (to_aware_datetime(appt.get("scheduled_time")), appt["appointment_id"])
+    )
+
+
 async def send_sms_placeholder(phone: Optional[str], message: str):
     if not phone:
         return
@@ -348,10 +1035,18 @@ async def root():
 async def create_user(user_data: UserCreate):
     try:
         payload = user_data.dict()
-        payload["referral_code"] = generate_referral_code(user_data.email)
-        user = User(**payload)
-        result = await db.users.insert_one(user.dict())
-        return user
+        for attempt in range(REFERRAL_CODE_ATTEMPTS):
+            payload["referral_code"] = generate_referral_code(user_data.email, _referral_code_length(attempt))
+            user = User(**payload)
+            try:
+                await db.users.insert_one(user.dict())
+                return user
+            except DuplicateKeyError as e:
+                if "referral_code" not in str(e.details):
+                    raise
+        raise HTTPException(status_code=500, detail="No se pudo generar un código de referido único")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating user: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -361,35 +1056,36 @@ async def get_user(user_id: str):
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if not user.get("referral_code"):
-        referral_code = generate_referral_code(user.get("email", "user"))
-        await db.users.update_one({"user_id": user_id}, {"$set": {"referral_code": referral_code}})
-        user["referral_code"] = referral_code
     return user
 
 @api_router.get("/users", response_model=List[User])
-async def list_users(role: Optional[str] = None, email: Optional[str] = None, limit: int = 100):
+async def list_users(
+    response: Response,
+    role: Optional[str] = None,
+    email: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
     query = {}
     if role:
         query["role"] = role
     if email:
         query["email"] = email
-    users = await db.users.find(query, {"_id": 0}).limit(limit).to_list(limit)
-    for user in users:
-        if not user.get("referral_code"):
-            referral_code = generate_referral_code(user.get("email", "user"))
-            await db.users.update_one({"user_id": user.get("user_id")}, {"$set": {"referral_code": referral_code}})
-            user["referral_code"] = referral_code
+    users = await paginate(db.users, query, [], limit, cursor, response)
     return users
 
 # ==================== BARBERSHOPS ====================
 
+def build_barbershop(shop_data: BarbershopCreate) -> Barbershop:
+    validate_working_hours(shop_data.working_hours)
+    return Barbershop(**shop_data.dict())
+
 @api_router.post("/barbershops", response_model=Barbershop)
 async def create_barbershop(shop_data: BarbershopCreate):
     try:
-        validate_working_hours(shop_data.working_hours)
-        shop = Barbershop(**shop_data.dict())
+        shop = build_barbershop(shop_data)
         await db.barbershops.insert_one(shop.dict())
+        await write_change_entries([barbershop_change_entry(shop.dict())])
         return shop
     except Exception as e:
         logger.error(f"Error creating barbershop: {e}")
@@ -403,8 +1099,8 @@ async def get_barbershop(shop_id: str):
     return shop
 
 @api_router.get("/barbershops", response_model=List[Barbershop])
-async def list_barbershops(limit: int = 100):
-    shops = await db.barbershops.find({}, {"_id": 0}).limit(limit).to_list(limit)
+async def list_barbershops(response: Response, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None):
+    shops = await paginate(db.barbershops, {}, [], limit, cursor, response)
     return shops
 
 @api_router.put("/barbershops/{shop_id}", response_model=Barbershop)
@@ -415,13 +1111,10 @@ async def update_barbershop(shop_id: str, updates: dict):
     if "capacity" in updates and updates.get("capacity") is not None and updates.get("capacity") < 1:
         raise HTTPException(status_code=400, detail="La capacidad debe ser mayor a 0")
 
-    result = await db.barbershops.update_one(
-        {"shop_id": shop_id},
-        {"$set": updates}
+    shop = await update_document(
+        db.barbershops, {"shop_id": shop_id}, updates, "Barbershop not found", expected_version(updates)
     )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Barbershop not found")
-    shop = await db.barbershops.find_one({"shop_id": shop_id}, {"_id": 0})
+    await write_change_entries([barbershop_change_entry(shop)])
     return shop
 
 
@@ -431,8 +1124,13 @@ async def delete_barbershop(shop_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Barbershop not found")
 
+    barber_ids = [doc["barber_id"] async for doc in db.barbers.find({"shop_id": shop_id}, {"_id": 0, "barber_id": 1})]
+    service_ids = [doc["service_id"] async for doc in db.services.find({"shop_id": shop_id}, {"_id": 0, "service_id": 1})]
     await db.barbers.delete_many({"shop_id": shop_id})
     await db.services.delete_many({"shop_id": shop_id})
+    await record_changes("barbershops", [shop_id], "delete", topics=push_topics(shop_id))
+    await record_changes("barbers", barber_ids, "delete")
+    await record_changes("services", service_ids, "delete")
 
     return {"message": "Barbershop deleted successfully"}
 
@@ -443,6 +1141,7 @@ async def create_barber(barber_data: BarberCreate):
     try:
         barber = Barber(**barber_data.dict())
         await db.barbers.insert_one(barber.dict())
+        await record_barber_change(barber.dict())
         return barber
     except Exception as e:
         logger.error(f"Error creating barber: {e}")
@@ -456,28 +1155,134 @@ async def get_barber(barber_id: str):
     return barber
 
 @api_router.get("/barbers", response_model=List[Barber])
-async def list_barbers(shop_id: Optional[str] = None, limit: int = 100):
-    query = {"shop_id": shop_id} if shop_id else {}
-    barbers = await db.barbers.find(query, {"_id": 0}).limit(limit).to_list(limit)
+async def list_barbers(
+    response: Response,
+    shop_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    query = {}
+    if shop_id:
+        query["shop_id"] = shop_id
+    if user_id:
+        query["user_id"] = user_id
+    barbers = await paginate(db.barbers, query, [], limit, cursor, response)
     return barbers
 
+AGENDA_DEFAULT_DAYS = int(os.environ.get('AGENDA_DEFAULT_DAYS', '30'))
+
+@api_router.get("/barbers/me/agenda", response_model=BarberAgenda)
+async def get_barber_agenda(
+    user_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Barber profile plus their appointments in [start, end), in one round trip.
+
+    `start` defaults to today (UTC) and `end` to AGENDA_DEFAULT_DAYS later;
+    `status` accepts a comma-separated list.
+    """
+    if start is None:
+        start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if end is None:
+        end = start + timedelta(days=AGENDA_DEFAULT_DAYS)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="El rango de fechas es inválido")
+
+    appointment_match = {"scheduled_time": {"$gte": start, "$lt": end}}
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    if statuses:
+        appointment_match["status"] = {"$in": statuses}
+
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$limit": 1},
+        # Portfolio images are base64 blobs the agenda never shows.
+        {"$project": {"_id": 0, "portfolio": 0}},
+        {"$lookup": {
+            "from": "appointments",
+            "localField": "barber_id",
+            "foreignField": "barber_id",
+            "as": "appointments",
+            "pipeline": [
+                {"$match": appointment_match},
+                {"$sort": {"scheduled_time": 1}},
+                {"$limit": limit},
+                {"$lookup": {
+                    "from": "users",
+                    "localField": "client_user_id",
+                    "foreignField": "user_id",
+                    "as": "client",
+                    "pipeline": [{"$project": {"_id": 0, "name": 1, "phone": 1}}],
+                }},
+                {"$lookup": {
+                    "from": "services",
+                    "localField": "service_id",
+                    "foreignField": "service_id",
+                    "as": "service",
+                    "pipeline": [{"$project": {"_id": 0, "name": 1, "duration": 1, "price": 1}}],
+                }},
+                {"$addFields": {
+                    "client_name": {"$first": "$client.name"},
+                    "client_phone": {"$first": "$client.phone"},
+                    "service_name": {"$first": "$service.name"},
+                    "service_duration": {"$first": "$service.duration"},
+                    "service_price": {"$first": "$service.price"},
+                }},
+                {"$project": {"_id": 0, "client": 0, "service": 0}},
+            ],
+        }},
+    ]
+    docs = await db.barbers.aggregate(pipeline).to_list(1)
+    if not docs:
+        raise HTTPException(status_code=404, detail="Barber not found")
+    barber = docs[0]
+    appointments = barber.pop("appointments", [])
+
+    # Occurrences of recurring series are always "scheduled" until stored.
+    virtual = []
+    if not statuses or "scheduled" in statuses:
+        virtual = await series_occurrences({"barber_id": barber["barber_id"]}, start, end)
+    if virtual:
+        client_ids = list({appt["client_user_id"] for appt in virtual})
+        service_ids = list({appt["service_id"] for appt in virtual})
+        clients, services = await asyncio.gather(
+            db.users.find({"user_id": {"$in": client_ids}}, {"_id": 0, "user_id": 1, "name": 1, "phone": 1}).to_list(None),
+            db.services.find({"service_id": {"$in": service_ids}}, {"_id": 0, "service_id": 1, "name": 1, "duration": 1, "price": 1}).to_list(None),
+        )
+        clients_by_id = {doc["user_id"]: doc for doc in clients}
+        services_by_id = {doc["service_id"]: doc for doc in services}
+        for appt in virtual:
+            client = clients_by_id.get(appt["client_user_id"], {})
+            service = services_by_id.get(appt["service_id"], {})
+            appt.update(
+                client_name=client.get("name"),
+                client_phone=client.get("phone"),
+                service_name=service.get("name"),
+                service_duration=service.get("duration"),
+                service_price=service.get("price"),
+            )
+        appointments = merge_occurrences(appointments, virtual)[:limit]
+    return {"barber": barber, "appointments": appointments}
+
 @api_router.put("/barbers/{barber_id}", response_model=Barber)
 async def update_barber(barber_id: str, updates: dict):
-    result = await db.barbers.update_one(
-        {"barber_id": barber_id},
-        {"$set": updates}
+    barber = await update_document(
+        db.barbers, {"barber_id": barber_id}, updates, "Barber not found", expected_version(updates)
     )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Barber not found")
-    barber = await db.barbers.find_one({"barber_id": barber_id}, {"_id": 0})
+    await record_barber_change(barber)
     return barber
 
 
 @api_router.delete("/barbers/{barber_id}")
 async def delete_barber(barber_id: str):
-    result = await db.barbers.delete_one({"barber_id": barber_id})
-    if result.deleted_count == 0:
+    barber = await db.barbers.find_one_and_delete({"barber_id": barber_id}, {"_id": 0, "barber_id": 1, "shop_id": 1})
+    if barber is None:
         raise HTTPException(status_code=404, detail="Barber not found")
+    await record_barber_change(barber, "delete")
     return {"message": "Barber deleted successfully"}
 
 # ==================== SERVICES ====================
@@ -487,6 +1292,7 @@ async def create_service(service_data: ServiceCreate):
     try:
         service = Service(**service_data.dict())
         await db.services.insert_one(service.dict())
+        await record_service_change(service.dict())
         return service
     except Exception as e:
         logger.error(f"Error creating service: {e}")
@@ -500,49 +1306,56 @@ async def get_service(service_id: str):
     return service
 
 @api_router.get("/services", response_model=List[Service])
-async def list_services(shop_id: Optional[str] = None, limit: int = 100):
+async def list_services(
+    response: Response,
+    shop_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
     query = {"shop_id": shop_id} if shop_id else {}
-    services = await db.services.find(query, {"_id": 0}).limit(limit).to_list(limit)
+    services = await paginate(db.services, query, [], limit, cursor, response)
     return services
 
 
 @api_router.put("/services/{service_id}", response_model=Service)
 async def update_service(service_id: str, updates: dict):
-    result = await db.services.update_one(
-        {"service_id": service_id},
-        {"$set": updates}
+    service = await update_document(
+        db.services, {"service_id": service_id}, updates, "Service not found", expected_version(updates)
     )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Service not found")
-    service = await db.services.find_one({"service_id": service_id}, {"_id": 0})
+    await record_service_change(service)
     return service
 
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str):
-    result = await db.services.delete_one({"service_id": service_id})
-    if result.deleted_count == 0:
+    service = await db.services.find_one_and_delete({"service_id": service_id}, {"_id": 0, "service_id": 1, "shop_id": 1})
+    if service is None:
         raise HTTPException(status_code=404, detail="Service not found")
+    await record_service_change(service, "delete")
     return {"message": "Service deleted successfully"}
 
 # ==================== APPOINTMENTS ====================
 
+def build_appointment(appt_data: AppointmentCreate) -> Appointment:
+    payload = appt_data.dict()
+    deposit_required = payload.get("deposit_required", False)
+    deposit_amount = payload.get("deposit_amount")
+
+    if deposit_required:
+        if deposit_amount is None or deposit_amount <= 0:
+            raise HTTPException(status_code=400, detail="El anticipo debe ser mayor a 0 si es requerido")
+        payload["deposit_status"] = "pending"
+    else:
+        payload["deposit_status"] = "not_required"
+
+    return Appointment(**payload)
+
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(appt_data: AppointmentCreate):
     try:
-        payload = appt_data.dict()
-        deposit_required = payload.get("deposit_required", False)
-        deposit_amount = payload.get("deposit_amount")
-
-        if deposit_required:
-            if deposit_amount is None or deposit_amount <= 0:
-                raise HTTPException(status_code=400, detail="El anticipo debe ser mayor a 0 si es requerido")
-            payload["deposit_status"] = "pending"
-        else:
-            payload["deposit_status"] = "not_required"
-
-        appointment = Appointment(**payload)
+        appointment = build_appointment(appt_data)
         await db.appointments.insert_one(appointment.dict())
+        await record_appointment_change(appointment.appointment_id, appt=appointment.dict())
         return appointment
     except Exception as e:
         logger.error(f"Error creating appointment: {e}")
@@ -551,18 +1364,29 @@ async def create_appointment(appt_data: AppointmentCreate):
 @api_router.get("/appointments/{appointment_id}", response_model=Appointment)
 async def get_appointment(appointment_id: str):
     appt = await db.appointments.find_one({"appointment_id": appointment_id}, {"_id": 0})
+    if not appt:
+        appt = await load_occurrence(appointment_id)
     if not appt:
         raise HTTPException(status_code=404, detail="Appointment not found")
     return appt
 
 @api_router.get("/appointments", response_model=List[Appointment])
 async def list_appointments(
+    response: Response,
     client_user_id: Optional[str] = None,
     barber_id: Optional[str] = None,
     shop_id: Optional[str] = None,
     status: Optional[str] = None,
-    limit: int = 100
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
 ):
+    """Appointments ordered by time.
+
+    With a `start`/`end` window the occurrences of recurring series in it are
+    included too; without one only stored appointments are listed.
+    """
     query = {}
     if client_user_id:
         query["client_user_id"] = client_user_id
@@ -572,24 +1396,52 @@ async def list_appointments(
         query["shop_id"] = shop_id
     if status:
         query["status"] = status
-    
-    appointments = await db.appointments.find(query, {"_id": 0}).limit(limit).to_list(limit)
+
+    if start is None and end is None:
+        appointments = await paginate(db.appointments, query, [("scheduled_time", 1)], limit, cursor, response)
+        return appointments
+    if start is None or end is None or end <= start:
+        raise HTTPException(status_code=400, detail="El rango de fechas es inválido")
+
+    # Stored and virtual appointments share one order, so the cursor is
+    # (scheduled_time, appointment_id) rather than the usual _id tie-breaker.
+    sort = [("scheduled_time", 1), ("appointment_id", 1)]
+    window = {**query, "scheduled_time": {"$gte": start, "$lt": end}}
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if len(after) != len(sort) or not isinstance(after[0], datetime):
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        after = (to_aware_datetime(after[0]), after[1])
+        window = {"$and": [window, _keyset_filter(sort, list(after))]}
+
+    stored = await db.appointments.find(window, {"_id": 0}).sort(sort).limit(limit + 1).to_list(limit + 1)
+    virtual = []
+    if not status or status == "scheduled":
+        series_query = {key: value for key, value in query.items() if key != "status"}
+        virtual = [
+            appt for appt in await series_occurrences(series_query, start, end)
+            if after is None or (appt["scheduled_time"], appt["appointment_id"]) > after
+        ]
+    appointments = merge_occurrences(stored, virtual)
+    if len(appointments) > limit:
+        appointments = appointments[:limit]
+        last = appointments[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([last["scheduled_time"], last["appointment_id"]])
     return appointments
 
 @api_router.put("/appointments/{appointment_id}", response_model=Appointment)
 async def update_appointment(appointment_id: str, updates: dict):
-    updates["updated_at"] = datetime.now(timezone.utc)
-    result = await db.appointments.update_one(
-        {"appointment_id": appointment_id},
-        {"$set": updates}
+    await materialize_occurrence(appointment_id)
+    appt = await update_document(
+        db.appointments, {"appointment_id": appointment_id}, updates, "Appointment not found", expected_version(updates)
     )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Appointment not found")
-    appt = await db.appointments.find_one({"appointment_id": appointment_id}, {"_id": 0})
+    await record_appointment_change(appointment_id, appt=appt)
     return appt
 
 @api_router.post("/appointments/{appointment_id}/reschedule", response_model=Appointment)
 async def reschedule_appointment(appointment_id: str, request: RescheduleRequest):
+    await materialize_occurrence(appointment_id)
     appt = await db.appointments.find_one({"appointment_id": appointment_id})
     if not appt:
         raise HTTPException(status_code=404, detail="Appointment not found")
@@ -613,14 +1465,16 @@ async def reschedule_appointment(appointment_id: str, request: RescheduleRequest
         "reminder_24h_sent": False,
         "reminder_2h_sent": False,
         "reminder_sent": False,
-        "updated_at": datetime.now(timezone.utc),
     }
 
     if request.reason:
         updates["notes"] = f"[Reprogramada] {request.reason}"
 
-    await db.appointments.update_one({"appointment_id": appointment_id}, {"$set": updates})
-    appt = await db.appointments.find_one({"appointment_id": appointment_id}, {"_id": 0})
+    # The checks above ran against this version; a concurrent change yields a 409.
+    appt = await update_document(
+        db.appointments, {"appointment_id": appointment_id}, updates, "Appointment not found", appt.get("version", 0)
+    )
+    await record_appointment_change(appointment_id, appt=appt)
     return appt
 
 
@@ -633,6 +1487,22 @@ async def run_appointment_reminders():
         "status": {"$in": ["scheduled", "confirmed"]},
         "scheduled_time": {"$lte": horizon}
     }).to_list(length=500)
+    appointments += await series_occurrences({}, now, horizon)
+
+    async def mark_sent(appt: dict, kind: str, updates: dict):
+        if appt.get("virtual"):
+            # Occurrences stay virtual: the series remembers up to which slot it reminded.
+            watermark = f"reminded_{kind}_through"
+            await db.appointment_series.update_one(
+                {"series_id": appt["series_id"],
+                 "$or": [{watermark: None}, {watermark: {"$lt": appt["occurrence_time"]}}]},
+                {"$set": {watermark: appt["occurrence_time"]}}
+            )
+            return
+        await db.appointments.update_one(
+            {"appointment_id": appt.get("appointment_id")},
+            {"$set": {**updates, "updated_at": datetime.now(timezone.utc)}}
+        )
 
     reminders_sent = []
 
@@ -653,10 +1523,7 @@ async def run_appointment_reminders():
             body = "Te esperamos en 24h. Si necesitas reprogramar, hazlo con más de 2h de anticipación."
             await send_push_notification(client_id, title, body)
             await send_sms_placeholder(client_phone, body)
-            await db.appointments.update_one(
-                {"appointment_id": appt.get("appointment_id")},
-                {"$set": {"reminder_24h_sent": True, "reminder_sent": True, "updated_at": datetime.now(timezone.utc)}}
-            )
+            await mark_sent(appt, "24h", {"reminder_24h_sent": True, "reminder_sent": True})
             reminders_sent.append({"appointment_id": appt.get("appointment_id"), "type": "24h"})
 
         # 2h reminder window: 90m to 150m
@@ -668,10 +1535,7 @@ async def run_appointment_reminders():
             body = "Confirma tu llegada o reprograma si es necesario."
             await send_push_notification(client_id, title, body)
             await send_sms_placeholder(client_phone, body)
-            await db.appointments.update_one(
-                {"appointment_id": appt.get("appointment_id")},
-                {"$set": {"reminder_2h_sent": True, "updated_at": datetime.now(timezone.utc)}}
-            )
+            await mark_sent(appt, "2h", {"reminder_2h_sent": True})
             reminders_sent.append({"appointment_id": appt.get("appointment_id"), "type": "2h"})
 
     return {"sent": reminders_sent, "count": len(reminders_sent)}
@@ -679,45 +1543,698 @@ async def run_appointment_reminders():
 
 @api_router.delete("/appointments/{appointment_id}")
 async def delete_appointment(appointment_id: str):
-    result = await db.appointments.delete_one({"appointment_id": appointment_id})
-    if result.deleted_count == 0:
+    if parse_occurrence_id(appointment_id):
+        # Removing a series occurrence would bring the virtual one back; cancel it instead.
+        await materialize_occurrence(appointment_id)
+        appt = await update_document(
+            db.appointments, {"appointment_id": appointment_id}, {"status": "cancelled"}, "Appointment not found"
+        )
+        await record_appointment_change(appointment_id, appt=appt)
+        return {"message": "Appointment deleted successfully"}
+
+    appt = await db.appointments.find_one_and_delete({"appointment_id": appointment_id}, APPOINTMENT_CHANGE_PROJECTION)
+    if appt is None:
         raise HTTPException(status_code=404, detail="Appointment not found")
+    await record_appointment_change(appointment_id, "delete", appt)
     return {"message": "Appointment deleted successfully"}
 
+# ==================== APPOINTMENT SERIES ====================
+
+# Fields derived by the server; clients change them through the endpoints below.
+_SERIES_DERIVED_FIELDS = {"series_id", "status", "ends_at", "reminded_24h_through", "reminded_2h_through", "created_at"}
+
+
+def _series_rule(rule: str, start_time: datetime) -> Tuple[str, Optional[datetime]]:
+    """Normalised rule and exclusive end (None if open-ended), or a 400."""
+    try:
+        rule, last = parse_rule(rule, start_time, SERIES_MAX_EXPANSION, timedelta(days=SERIES_MAX_DAYS))
+    except RecurrenceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return rule, last + timedelta(seconds=1) if last else None
+
+
+@api_router.post("/appointment-series", response_model=AppointmentSeries)
+async def create_appointment_series(series_data: AppointmentSeriesCreate):
+    payload = series_data.dict()
+    payload["start_time"] = to_aware_datetime(payload["start_time"])
+    payload["rule"], payload["ends_at"] = _series_rule(payload["rule"], payload["start_time"])
+    series = AppointmentSeries(**payload)
+    await db.appointment_series.insert_one(series.dict())
+    await write_change_entries([series_change_entry(series.dict())])
+    return series
+
+@api_router.get("/appointment-series/{series_id}", response_model=AppointmentSeries)
+async def get_appointment_series(series_id: str):
+    series = await db.appointment_series.find_one({"series_id": series_id}, {"_id": 0})
+    if not series:
+        raise HTTPException(status_code=404, detail="Series not found")
+    return series
+
+@api_router.get("/appointment-series", response_model=List[AppointmentSeries])
+async def list_appointment_series(
+    response: Response,
+    client_user_id: Optional[str] = None,
+    barber_id: Optional[str] = None,
+    shop_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    query = {}
+    if client_user_id:
+        query["client_user_id"] = client_user_id
+    if barber_id:
+        query["barber_id"] = barber_id
+    if shop_id:
+        query["shop_id"] = shop_id
+    if status:
+        query["status"] = status
+    return await paginate(db.appointment_series, query, [], limit, cursor, response)
+
+@api_router.get("/appointment-series/{series_id}/occurrences", response_model=List[Appointment])
+async def list_series_occurrences(series_id: str, start: datetime, end: datetime):
+    """Every occurrence of the series in [start, end), stored exceptions included."""
+    if end <= start:
+        raise HTTPException(status_code=400, detail="El rango de fechas es inválido")
+    if not await db.appointment_series.count_documents({"series_id": series_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Series not found")
+    stored, virtual = await asyncio.gather(
+        db.appointments.find(
+            {"series_id": series_id, "occurrence_time": {"$gte": start, "$lt": end}}, {"_id": 0}
+        ).to_list(None),
+        series_occurrences({"series_id": series_id}, start, end),
+    )
+    return merge_occurrences(stored, virtual)
+
+@api_router.put("/appointment-series/{series_id}", response_model=AppointmentSeries)
+async def update_appointment_series(series_id: str, updates: dict):
+    """Change the template of every occurrence that is not stored as an exception."""
+    changes = {key: value for key, value in updates.items() if key not in _SERIES_DERIVED_FIELDS}
+    if "rule" in changes or "start_time" in changes:
+        current = await db.appointment_series.find_one({"series_id": series_id}, {"_id": 0, "rule": 1, "start_time": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Series not found")
+        start_time = to_aware_datetime(changes.get("start_time", current["start_time"]))
+        changes["start_time"] = start_time
+        changes["rule"], changes["ends_at"] = _series_rule(changes.get("rule", current["rule"]), start_time)
+    series = await update_document(
+        db.appointment_series, {"series_id": series_id}, changes, "Series not found", expected_version(updates)
+    )
+    await write_change_entries([series_change_entry(series)])
+    return series
+
+@api_router.delete("/appointment-series/{series_id}")
+async def end_appointment_series(series_id: str, from_time: Optional[datetime] = None):
+    """Cancel the series, or only its occurrences from `from_time` on.
+
+    Exceptions already stored in that range are cancelled as well; earlier
+    occurrences keep showing up in history.
+    """
+    series = await db.appointment_series.find_one({"series_id": series_id}, {"_id": 0})
+    if not series:
+        raise HTTPException(status_code=404, detail="Series not found")
+
+    if from_time is None:
+        cutoff = to_aware_datetime(series["start_time"])
+        changes = {"status": "cancelled"}
+    else:
+        cutoff = to_aware_datetime(from_time)
+        ends_at = series.get("ends_at")
+        changes = {"ends_at": min(to_aware_datetime(ends_at), cutoff) if ends_at else cutoff}
+    series = await update_document(db.appointment_series, {"series_id": series_id}, changes, "Series not found")
+
+    exceptions = await db.appointments.find(
+        {"series_id": series_id, "occurrence_time": {"$gte": cutoff}, "status": {"$nin": ["completed", "cancelled"]}},
+        {"_id": 0}
+    ).to_list(None)
+    if exceptions:
+        now = datetime.now(timezone.utc)
+        await db.appointments.update_many(
+            {"appointment_id": {"$in": [appt["appointment_id"] for appt in exceptions]}},
+            {"$set": {"status": "cancelled", "updated_at": now}, "$inc": {"version": 1}}
+        )
+    await write_change_entries(
+        [series_change_entry(series)]
+        + [appointment_change_entry({**appt, "status": "cancelled"}) for appt in exceptions]
+    )
+    return {"message": "Series ended successfully", "cancelled_exceptions": len(exceptions)}
+
+# ==================== BOOTSTRAP ====================
+
+BOOTSTRAP_UPCOMING_LIMIT = int(os.environ.get('BOOTSTRAP_UPCOMING_LIMIT', '20'))
+BOOTSTRAP_SERIES_DAYS = int(os.environ.get('BOOTSTRAP_SERIES_DAYS', '60'))
+
+@api_router.get("/bootstrap/booking", response_model=BookingBootstrap)
+async def bootstrap_booking(user_id: Optional[str] = None):
+    """Everything the client home and booking screens need in one response."""
+    async def upcoming_appointments():
+        if not user_id:
+            return []
+        now = datetime.now(timezone.utc)
+        query = {
+            "client_user_id": user_id,
+            "status": {"$in": ["scheduled", "confirmed"]},
+            "scheduled_time": {"$gte": now},
+        }
+        stored, virtual = await asyncio.gather(
+            db.appointments.find(query, {"_id": 0}).sort("scheduled_time", 1).to_list(BOOTSTRAP_UPCOMING_LIMIT),
+            series_occurrences({"client_user_id": user_id}, now, now + timedelta(days=BOOTSTRAP_SERIES_DAYS)),
+        )
+        return merge_occurrences(stored, virtual)[:BOOTSTRAP_UPCOMING_LIMIT]
+
+    shops, appointments = await asyncio.gather(load_catalog(), upcoming_appointments())
+    return {"shops": shops, "upcoming_appointments": appointments}
+
+# ==================== SYNC ====================
+
+SYNC_MAX_CHANGES = int(os.environ.get('SYNC_MAX_CHANGES', '1000'))
+# Writes from other workers can commit slightly after their `at`; the token
+# overlaps this window so they are never skipped (clients upsert by id).
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '2'))
+SYNC_PROJECTIONS = {
+    "barbershops": {"_id": 0, "photos": 0},
+    "barbers": {"_id": 0, "portfolio": 0},
+    "services": {"_id": 0, "image": 0},
+    "appointments": {"_id": 0},
+    "appointment_series": {"_id": 0},
+}
+_CHANGE_LOG_SORT = [("at", 1), ("_id", 1)]
+
+
+def _sync_token(at: datetime, last_id=None) -> str:
+    return encode_cursor([at, last_id])
+
+
+# A snapshot walks the collections in SYNC_ID_FIELDS order, each in keyset
+# order (indexed for the caller's appointments and series), at most
+# SYNC_MAX_CHANGES documents per response.
+_SNAPSHOT_SORTS = {
+    "barbershops": [("_id", 1)],
+    "barbers": [("_id", 1)],
+    "services": [("_id", 1)],
+    "appointments": [("scheduled_time", 1), ("_id", 1)],
+    "appointment_series": [("_id", 1)],
+}
+
+
+async def _sync_snapshot(
+    user_id: str, barber_ids: List[str], collection: Optional[str] = None, after: Optional[list] = None
+) -> Tuple[dict, Optional[list]]:
+    """One snapshot page starting in `collection` after the keyset values `after`.
+
+    Returns the documents by collection and where the next page starts
+    (`[collection, after]`), or None when the snapshot is complete.
+    """
+    scoped = {"$or": [{"client_user_id": user_id}, {"barber_id": {"$in": barber_ids}}]}
+    names = list(SYNC_ID_FIELDS)
+    changes: Dict[str, List[dict]] = {name: [] for name in names}
+    remaining = SYNC_MAX_CHANGES
+    for name in names[names.index(collection) if collection else 0:]:
+        if remaining == 0:
+            return changes, [name, None]
+        sort = _SNAPSHOT_SORTS[name]
+        query = {} if name in CATALOG_COLLECTIONS else scoped
+        if name == collection and after:
+            query = {"$and": [query, _keyset_filter(sort, after)]} if query else _keyset_filter(sort, after)
+        # Keep _id for the keyset; it is dropped below.
+        projection = {field: 0 for field in SYNC_PROJECTIONS[name] if field != "_id"} or None
+        docs = await db[name].find(query, projection).sort(sort).limit(remaining + 1).to_list(remaining + 1)
+        position = None
+        if len(docs) > remaining:
+            docs = docs[:remaining]
+            position = [name, [docs[-1].get(field) for field, _ in sort]]
+        for doc in docs:
+            doc.pop("_id", None)
+        changes[name] = docs
+        if position is not None:
+            return changes, position
+        remaining -= len(docs)
+    return changes, None
+
+
+@api_router.get("/sync")
+async def sync(user_id: str, since: Optional[str] = None):
+    """Documents changed since `since` plus tombstones for deleted ones.
+
+    Without a token (or with one older than the change-log retention) the
+    response starts a full snapshot with `reset: true`. Keep calling with the
+    returned `token` while `has_more` is true; snapshot pages are followed by
+    the changes made since the snapshot started.
+    """
+    started = datetime.now(timezone.utc)
+    barber_ids = [doc["barber_id"] async for doc in db.barbers.find({"user_id": user_id}, {"_id": 0, "barber_id": 1})]
+    expired = started - timedelta(days=SYNC_RETENTION_DAYS)
+
+    since_at, since_id = None, None
+    snapshot: Optional[tuple] = None
+    if since:
+        values = decode_cursor(since)
+        if len(values) == 4 and values[0] == "snapshot" and isinstance(values[1], datetime) and values[2] in SYNC_ID_FIELDS:
+            snapshot = (to_aware_datetime(values[1]), values[2], values[3])
+        elif len(values) == 2 and isinstance(values[0], datetime):
+            since_at, since_id = to_aware_datetime(values[0]), values[1]
+        else:
+            raise HTTPException(status_code=400, detail="Token de sincronización inválido")
+
+    if snapshot is not None and snapshot[0] < expired:
+        snapshot = None
+    if snapshot is not None or since_at is None or since_at < expired:
+        begun, collection, after = snapshot or (started, None, None)
+        changes, position = await _sync_snapshot(user_id, barber_ids, collection, after)
+        if position is not None:
+            token = encode_cursor(["snapshot", begun, *position])
+        else:
+            token = _sync_token(begun - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+        return {
+            "token": token,
+            "reset": snapshot is None,
+            "has_more": position is not None,
+            "changes": changes,
+            "deleted": {name: [] for name in SYNC_ID_FIELDS},
+        }
+
+    visibility = {"$or": [
+        {"collection": {"$in": list(CATALOG_COLLECTIONS)}},
+        {"audience": {"$in": [user_id, *barber_ids]}},
+    ]}
+    position = _keyset_filter(_CHANGE_LOG_SORT, [since_at, since_id]) if since_id else {"at": {"$gte": since_at}}
+    entries = await db.change_log.find({"$and": [visibility, position]}) \
+        .sort(_CHANGE_LOG_SORT).limit(SYNC_MAX_CHANGES + 1).to_list(SYNC_MAX_CHANGES + 1)
+    has_more = len(entries) > SYNC_MAX_CHANGES
+    entries = entries[:SYNC_MAX_CHANGES]
+
+    # Only the latest operation per document matters.
+    latest: Dict[tuple, str] = {}
+    for entry in entries:
+        latest[(entry["collection"], entry["doc_id"])] = entry["op"]
+    upserts: Dict[str, List[str]] = {name: [] for name in SYNC_ID_FIELDS}
+    deleted: Dict[str, List[str]] = {name: [] for name in SYNC_ID_FIELDS}
+    for (collection, doc_id), op in latest.items():
+        (deleted if op == "delete" else upserts)[collection].append(doc_id)
+
+    names = [name for name, ids in upserts.items() if ids]
+    results = await asyncio.gather(*[
+        db[name].find({SYNC_ID_FIELDS[name]: {"$in": upserts[name]}}, SYNC_PROJECTIONS[name]).to_list(None)
+        for name in names
+    ])
+    changes = {name: [] for name in SYNC_ID_FIELDS}
+    for name, docs in zip(names, results):
+        changes[name] = docs
+        # Deleted after this page's entries were read; the tombstone is on a later page.
+        found = {doc[SYNC_ID_FIELDS[name]] for doc in docs}
+        deleted[name].extend(doc_id for doc_id in upserts[name] if doc_id not in found)
+
+    if has_more:
+        token = _sync_token(entries[-1]["at"], entries[-1]["_id"])
+    else:
+        resume_at = started - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        token = _sync_token(max(since_at, resume_at))
+    return {"token": token, "reset": False, "has_more": has_more, "changes": changes, "deleted": deleted}
+
+# ==================== BULK IMPORT ====================
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '1000'))
+BULK_MAX_ERRORS = int(os.environ.get('BULK_MAX_ERRORS', '1000'))
+# Conditional (versioned) bulk updates are written one by one, this many at a time.
+BULK_VERSIONED_CONCURRENCY = int(os.environ.get('BULK_VERSIONED_CONCURRENCY', '16'))
+BULK_KINDS = {
+    "barbershops": (BarbershopCreate, build_barbershop, barbershop_change_entry),
+    "barbers": (BarberCreate, lambda data: Barber(**data.dict()), barber_change_entry),
+    "services": (ServiceCreate, lambda data: Service(**data.dict()), service_change_entry),
+    "appointments": (AppointmentCreate, build_appointment, appointment_change_entry),
+}
+_NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+
+
+async def _body_lines(request: Request) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def _csv_records(request: Request) -> AsyncIterator[List[str]]:
+    record = ""
+    async for line in _body_lines(request):
+        record = f"{record}\n{line}" if record else line
+        # An odd number of quotes means a quoted field continues on the next line.
+        if record.count('"') % 2:
+            continue
+        yield next(csv.reader([record]), [])
+        record = ""
+    if record:
+        yield next(csv.reader([record]), [])
+
+
+def _csv_value(value: str) -> Any:
+    value = value.strip()
+    if value[:1] in ("[", "{"):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+async def bulk_rows(request: Request) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield (row number, row) from a JSON array, NDJSON or CSV body.
+
+    NDJSON and CSV are parsed as the body streams in. Unparseable rows are
+    yielded as a ValueError so the caller can report them per row. CSV cells
+    holding JSON objects or arrays (`availability`, `specialties`) are decoded;
+    empty cells are left out so model defaults apply.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in _NDJSON_TYPES:
+        row = 0
+        async for line in _body_lines(request):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                yield row, json.loads(line)
+            except ValueError as e:
+                yield row, ValueError(f"JSON inválido: {e}")
+    elif content_type == "text/csv":
+        header = None
+        row = 0
+        async for values in _csv_records(request):
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            if not any(value.strip() for value in values):
+                continue
+            row += 1
+            if len(values) > len(header):
+                yield row, ValueError(f"La fila tiene {len(values)} columnas y el encabezado {len(header)}")
+                continue
+            yield row, {name: _csv_value(value) for name, value in zip(header, values) if value.strip()}
+    else:
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="El cuerpo debe ser un arreglo JSON, NDJSON o CSV")
+        if not isinstance(payload, list):
+            raise HTTPException(status_code=400, detail="El cuerpo debe ser un arreglo JSON")
+        for row, item in enumerate(payload, start=1):
+            yield row, item
+
+
+class BulkReport:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.received = 0
+        self.succeeded = 0
+        self.errors: List[dict] = []
+        self.failed = 0
+
+    def fail(self, row: int, error: Any):
+        self.failed += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    def as_dict(self, verb: str) -> dict:
+        return {
+            "kind": self.kind,
+            "received": self.received,
+            verb: self.succeeded,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors()
+    )
+
+
+def _bulk_kind(kind: str) -> tuple:
+    if kind not in BULK_KINDS:
+        raise HTTPException(status_code=404, detail=f"Tipo de importación desconocido: {kind}")
+    return BULK_KINDS[kind]
+
+
+@api_router.post("/bulk/{kind}")
+async def bulk_create(kind: str, request: Request):
+    """Create many barbershops, barbers, services or appointments.
+
+    Accepts a JSON array, NDJSON (`application/x-ndjson`) or CSV (`text/csv`)
+    body. Rows are validated one by one and inserted `BULK_BATCH_SIZE` at a time
+    with an unordered `insert_many`; invalid rows are reported by row number.
+    """
+    create_model, build, entry_for = _bulk_kind(kind)
+    collection = db[kind]
+    report = BulkReport(kind)
+    batch: List[Tuple[int, dict]] = []
+
+    async def flush():
+        if not batch:
+            return
+        failed: Dict[int, str] = {}
+        try:
+            await collection.insert_many([doc for _, doc in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"]: error.get("errmsg", "Error de escritura") for error in e.details.get("writeErrors", [])}
+        now = datetime.now(timezone.utc)
+        entries = []
+        for index, (row, doc) in enumerate(batch):
+            if index in failed:
+                report.fail(row, failed[index])
+            else:
+                report.succeeded += 1
+                entries.append(entry_for(doc, "upsert", now))
+        await write_change_entries(entries)
+        batch.clear()
+
+    async for row, item in bulk_rows(request):
+        report.received += 1
+        if isinstance(item, Exception):
+            report.fail(row, str(item))
+            continue
+        if not isinstance(item, dict):
+            report.fail(row, "Cada fila debe ser un objeto")
+            continue
+        try:
+            document = build(create_model(**item)).dict()
+        except ValidationError as e:
+            report.fail(row, _validation_message(e))
+            continue
+        except HTTPException as e:
+            report.fail(row, e.detail)
+            continue
+        batch.append((row, document))
+        if len(batch) >= BULK_BATCH_SIZE:
+            await flush()
+    await flush()
+
+    logger.info(f"Bulk import of {kind}: {report.succeeded} inserted, {report.failed} failed")
+    return report.as_dict("inserted")
+
+
+@api_router.patch("/bulk/{kind}")
+async def bulk_update(kind: str, request: Request):
+    """Apply many partial updates; each row names the document by its id field.
+
+    A `version` in a row makes that update conditional, as in the single PUT.
+    An id may appear only once per batch of `BULK_BATCH_SIZE` rows.
+    """
+    _, _, entry_for = _bulk_kind(kind)
+    collection = db[kind]
+    id_field = SYNC_ID_FIELDS[kind]
+    projection = SYNC_PROJECTIONS[kind]
+    report = BulkReport(kind)
+    batch: Dict[str, Tuple[int, Optional[int], dict, dict]] = {}
+    versioned_slots = asyncio.Semaphore(BULK_VERSIONED_CONCURRENCY)
+
+    async def apply_versioned(query: dict, update: dict):
+        # bulk_write only reports totals, so a conditional row's own outcome
+        # needs its own write, as in update_document.
+        async with versioned_slots:
+            return await collection.find_one_and_update(
+                query, update, projection=projection, return_document=ReturnDocument.AFTER
+            )
+
+    async def flush():
+        if not batch:
+            return
+        rows = list(batch.items())
+        plain = [(doc_id, query, update) for doc_id, (_, version, query, update) in rows if version is None]
+        versioned = [(doc_id, query, update) for doc_id, (_, version, query, update) in rows if version is not None]
+
+        failed: Dict[str, str] = {}
+        if plain:
+            try:
+                await collection.bulk_write([UpdateOne(query, update) for _, query, update in plain], ordered=False)
+            except BulkWriteError as e:
+                failed = {
+                    plain[error["index"]][0]: error.get("errmsg", "Error de escritura")
+                    for error in e.details.get("writeErrors", [])
+                }
+        results = await asyncio.gather(
+            *(apply_versioned(query, update) for _, query, update in versioned), return_exceptions=True
+        )
+        updated: Dict[str, dict] = {}
+        for (doc_id, _, _), result in zip(versioned, results):
+            if isinstance(result, Exception):
+                failed[doc_id] = str(result)
+            elif result is not None:
+                updated[doc_id] = result
+        # Unconditional rows match whenever the document exists; read those
+        # back, and the current version of conditional rows that didn't apply.
+        unknown = [doc_id for doc_id, _ in rows if doc_id not in updated and doc_id not in failed]
+        current = {
+            doc[id_field]: doc
+            async for doc in collection.find({id_field: {"$in": unknown}}, projection)
+        } if unknown else {}
+
+        now = datetime.now(timezone.utc)
+        entries = []
+        for doc_id, (row, version, _, _) in rows:
+            doc = updated.get(doc_id) or (current.get(doc_id) if version is None else None)
+            if doc_id in failed:
+                report.fail(row, failed[doc_id])
+            elif doc is not None:
+                report.succeeded += 1
+                entries.append(entry_for(doc, "upsert", now))
+            elif doc_id in current:
+                report.fail(row, f"Conflicto de versión (actual {current[doc_id].get('version', 0)})")
+            else:
+                report.fail(row, f"{id_field} {doc_id} no existe")
+        await write_change_entries(entries)
+        batch.clear()
+
+    async for row, item in bulk_rows(request):
+        report.received += 1
+        if isinstance(item, Exception):
+            report.fail(row, str(item))
+            continue
+        if not isinstance(item, dict) or not item.get(id_field):
+            report.fail(row, f"Cada fila debe ser un objeto con {id_field}")
+            continue
+        try:
+            version = expected_version(item)
+            if kind == "barbershops" and "working_hours" in item:
+                validate_working_hours(item.get("working_hours") or {})
+        except HTTPException as e:
+            report.fail(row, e.detail)
+            continue
+        doc_id = str(item[id_field])
+        if doc_id in batch:
+            report.fail(row, f"{id_field} {doc_id} aparece más de una vez en el mismo lote (fila {batch[doc_id][0]})")
+            continue
+        changes = {key: value for key, value in item.items() if key not in _PROTECTED_FIELDS and key != id_field}
+        changes["updated_at"] = datetime.now(timezone.utc)
+        query = {id_field: doc_id}
+        if version is not None:
+            query["version"] = version if version else {"$in": [0, None]}
+        batch[doc_id] = (row, version, query, {"$set": changes, "$inc": {"version": 1}})
+        if len(batch) >= BULK_BATCH_SIZE:
+            await flush()
+    await flush()
+
+    logger.info(f"Bulk update of {kind}: {report.succeeded} updated, {report.failed} failed")
+    return report.as_dict("updated")
+
+# ==================== REAL-TIME UPDATES ====================
+
+REALTIME_HEARTBEAT_SECONDS = float(os.environ.get('REALTIME_HEARTBEAT_SECONDS', '15'))
+
+
+def encode_push_event(event: dict) -> str:
+    return json.dumps(jsonable_encoder({key: value for key, value in event.items() if key != "topics"}))
+
+
+@api_router.websocket("/ws/schedule")
+async def schedule_updates_ws(websocket: WebSocket, shop_id: Optional[str] = None, barber_id: Optional[str] = None):
+    topics = push_topics(shop_id, barber_id)
+    if not topics:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = event_bus.subscribe(topics)
+    try:
+        while True:
+            event = await subscription.get(timeout=REALTIME_HEARTBEAT_SECONDS)
+            await websocket.send_text(encode_push_event(event or {"type": "ping"}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        subscription.close()
+
+
+@api_router.get("/events/schedule")
+async def schedule_updates_sse(request: Request, shop_id: Optional[str] = None, barber_id: Optional[str] = None):
+    """Server-sent events variant of /ws/schedule for clients without WebSockets."""
+    topics = push_topics(shop_id, barber_id)
+    if not topics:
+        raise HTTPException(status_code=400, detail="Indica shop_id o barber_id")
+
+    async def stream():
+        # Subscribed only once the response streams: a client that leaves
+        # before that never runs this body, and nothing is left to close.
+        subscription = event_bus.subscribe(topics)
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(timeout=REALTIME_HEARTBEAT_SECONDS)
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {encode_push_event(event)}\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api_router.get("/realtime/status")
+async def realtime_status():
+    return {"change_stream": change_feed.active, **event_bus.snapshot()}
+
 # ==================== PAYMENTS / DEPOSITS ====================
 
 
 @api_router.post("/payments/deposits", response_model=Deposit)
 async def create_deposit(deposit_data: DepositCreate):
-    if deposit_data.appointment_id:
-        appt = await db.appointments.find_one({"appointment_id": deposit_data.appointment_id})
-        if not appt:
-            raise HTTPException(status_code=404, detail="Appointment not found")
-
-        if appt.get("deposit_status") == "paid":
-            raise HTTPException(status_code=400, detail="La cita ya tiene un anticipo pagado")
-
     deposit = Deposit(**deposit_data.dict())
 
     # Placeholder de integración de pago: genera una URL simulada
     payment_url = f"https://payments.example.com/pay/{deposit.deposit_id}"
     deposit.payment_url = payment_url
 
-    await db.deposits.insert_one(deposit.dict())
-
     if deposit.appointment_id:
-        await db.appointments.update_one(
-            {"appointment_id": deposit.appointment_id},
-            {
-                "$set": {
+        await materialize_occurrence(deposit.appointment_id)
+        # The paid check is part of the filter so a concurrent confirm can't be overwritten.
+        try:
+            appt = await update_document(
+                db.appointments,
+                {"appointment_id": deposit.appointment_id, "deposit_status": {"$ne": "paid"}},
+                {
                     "deposit_status": "pending",
                     "deposit_id": deposit.deposit_id,
                     "deposit_amount": deposit.amount,
-                    "updated_at": datetime.now(timezone.utc),
-                }
-            },
-        )
+                },
+                "Appointment not found",
+            )
+        except HTTPException:
+            if await db.appointments.find_one({"appointment_id": deposit.appointment_id}, {"_id": 1}):
+                raise HTTPException(status_code=400, detail="La cita ya tiene un anticipo pagado")
+            raise
+        await record_appointment_change(deposit.appointment_id, appt=appt)
 
+    await db.deposits.insert_one(deposit.dict())
     return deposit
 
 
@@ -734,27 +2251,24 @@ async def confirm_deposit(deposit_id: str, body: DepositStatusUpdate):
     if body.status not in {"paid", "failed", "cancelled", "refunded"}:
         raise HTTPException(status_code=400, detail="Estado de depósito inválido")
 
-    update_data = {"status": body.status, "updated_at": datetime.now(timezone.utc)}
+    update_data = {"status": body.status}
     if body.payment_url:
         update_data["payment_url"] = body.payment_url
 
-    result = await db.deposits.update_one({"deposit_id": deposit_id}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Deposit not found")
-
-    deposit = await db.deposits.find_one({"deposit_id": deposit_id}, {"_id": 0})
+    deposit = await update_document(db.deposits, {"deposit_id": deposit_id}, update_data, "Deposit not found")
 
-    if deposit and deposit.get("appointment_id"):
-        await db.appointments.update_one(
-            {"appointment_id": deposit.get("appointment_id")},
-            {
-                "$set": {
-                    "deposit_status": body.status,
-                    "deposit_id": deposit_id,
-                    "updated_at": datetime.now(timezone.utc),
-                }
-            },
-        )
+    if deposit.get("appointment_id"):
+        try:
+            appt = await update_document(
+                db.appointments,
+                {"appointment_id": deposit["appointment_id"]},
+                {"deposit_status": body.status, "deposit_id": deposit_id},
+                "Appointment not found",
+            )
+        except HTTPException:
+            logger.warning(f"Deposit {deposit_id} references missing appointment {deposit['appointment_id']}")
+        else:
+            await record_appointment_change(appt["appointment_id"], appt=appt)
 
     return deposit
 
@@ -770,11 +2284,20 @@ async def create_client_history(history: ClientHistory):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/client-history/{client_user_id}")
-async def get_client_history(client_user_id: str, limit: int = 50):
-    history = await db.client_history.find(
+async def get_client_history(
+    client_user_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    history = await paginate(
+        db.client_history,
         {"client_user_id": client_user_id},
-        {"_id": 0}
-    ).limit(limit).to_list(limit)
+        [("created_at", -1)],
+        limit,
+        cursor,
+        response
+    )
     return history
 
 # ==================== PUSH TOKENS ====================
@@ -966,21 +2489,28 @@ async def ingest_client_log(entry: ClientLog):
 
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(shop_id: str):
+    live = dashboard_hub.current(shop_id)
+    if live is not None:
+        return live
     try:
         shop = await db.barbershops.find_one({"shop_id": shop_id}, {"_id": 0, "capacity": 1})
         capacity = shop.get("capacity") if shop else None
 
-        # Get all appointments for the shop
+        now = datetime.now(timezone.utc)
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        today_end = today_start + timedelta(days=1)
+
+        # Get all appointments for the shop, plus series occurrences up to today
         appointments = await db.appointments.find({"shop_id": shop_id}).to_list(length=None)
+        appointments += await series_occurrences({"shop_id": shop_id}, SERIES_EPOCH, today_end)
+        for appt in appointments:
+            if appt.get("scheduled_time") is not None:
+                appt["scheduled_time"] = to_aware_datetime(appt["scheduled_time"])
 
         total_appointments = len(appointments)
         completed_appointments = len([a for a in appointments if a.get("status") == "completed"])
         total_barbers = await db.barbers.count_documents({"shop_id": shop_id})
 
-        now = datetime.now(timezone.utc)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = today_start + timedelta(days=1)
-
         today_appointments = [
             a for a in appointments
             if today_start <= a.get("scheduled_time", today_start) < today_end
@@ -1065,27 +2595,293 @@ async def get_dashboard_stats(shop_id: str):
         logger.error(f"Error getting dashboard stats: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def load_shop_dashboard(shop_id: str) -> ShopDashboard:
+    today_end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    shop, appointments, series_appointments, barbers, services = await asyncio.gather(
+        db.barbershops.find_one({"shop_id": shop_id}, {"_id": 0, "capacity": 1}),
+        db.appointments.find(
+            {"shop_id": shop_id},
+            {"_id": 0, "appointment_id": 1, "status": 1, "scheduled_time": 1, "service_id": 1}
+        ).to_list(length=None),
+        series_occurrences({"shop_id": shop_id}, SERIES_EPOCH, today_end),
+        db.barbers.find({"shop_id": shop_id}, {"_id": 0, "barber_id": 1}).to_list(length=None),
+        db.services.find({"shop_id": shop_id}, {"_id": 0, "service_id": 1, "name": 1, "price": 1}).to_list(length=None),
+    )
+    if shop is None:
+        raise HTTPException(status_code=404, detail="Barbershop not found")
+    dashboard = ShopDashboard(shop_id)
+    dashboard.load(appointments + series_appointments, barbers, services, shop.get("capacity"))
+    return dashboard
+
+
+# Series changes move many occurrences at once, so they reload the dashboard.
+dashboard_hub = DashboardHub(event_bus, load_shop_dashboard, reload_on=("appointment_series",))
+
+
+@api_router.get("/dashboard/stream")
+async def stream_dashboard_stats(request: Request, shop_id: str):
+    """SSE: a `stats` event with the full payload, then `delta` events with changed keys."""
+
+    async def stream():
+        # Joined only once the response streams, as in /events/schedule.
+        viewer, stats = await dashboard_hub.join(shop_id)
+        try:
+            yield "retry: 3000\n\n"
+            yield f"event: stats\ndata: {json.dumps(jsonable_encoder(stats))}\n\n"
+            while not await request.is_disconnected():
+                event = await viewer.get(timeout=REALTIME_HEARTBEAT_SECONDS)
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                if event["type"] == "resync":
+                    event = {"type": "stats", **(dashboard_hub.current(shop_id) or {})}
+                yield f"event: {event['type']}\ndata: {encode_push_event(event)}\n\n"
+        finally:
+            dashboard_hub.leave(shop_id, viewer)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ==================== AI SCAN (GEMINI) ====================
 
+# Circuit breakers around the LLM provider: when Gemini is degraded we stop
+# waiting for timeouts and serve the default recommendations instead.
+AI_HEDGE_ENABLED = os.environ.get('AI_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# AI_PROVIDER=fake swaps in a deterministic client for tests and benchmarks.
+AI_PROVIDER = os.environ.get('AI_PROVIDER', 'emergent').lower()
+ChatClient = FakeLlmChat if AI_PROVIDER == 'fake' else LlmChat
+
+# Candidate models per task; the router picks the fastest healthy one.
+AI_MODEL_ROUTES = {
+    "scan": parse_model_list(os.environ.get('AI_SCAN_MODELS', 'gemini:gemini-2.5-flash')),
+    "image_edit": parse_model_list(os.environ.get('AI_IMAGE_MODELS', 'gemini:gemini-2.5-flash-image-preview')),
+}
+_AI_TASK_LIMITS = {
+    # task: (slow call seconds, call timeout seconds)
+    "scan": (20.0, 45.0),
+    "image_edit": (60.0, 90.0),
+}
+
+
+def get_llm_api_key() -> Optional[str]:
+    api_key = os.environ.get('EMERGENT_LLM_KEY')
+    if not api_key and AI_PROVIDER == 'fake':
+        return 'fake'
+    return api_key
+
+
+def _breaker_from_env(task: str, route: ModelRoute) -> CircuitBreaker:
+    slow_call_seconds, call_timeout = _AI_TASK_LIMITS[task]
+    return CircuitBreaker(
+        name=f"{task}:{route.key}",
+        failure_rate=float(os.environ.get('AI_BREAKER_FAILURE_RATE', '0.5')),
+        min_calls=int(os.environ.get('AI_BREAKER_MIN_CALLS', '5')),
+        open_seconds=float(os.environ.get('AI_BREAKER_OPEN_SECONDS', '30')),
+        slow_call_seconds=float(os.environ.get('AI_SLOW_CALL_SECONDS', str(slow_call_seconds))),
+        call_timeout=float(os.environ.get('AI_CALL_TIMEOUT_SECONDS', str(call_timeout))),
+    )
+
+
+def _observe_llm_call(task: str, route: ModelRoute, outcome: str, seconds: float):
+    LLM_LATENCY.observe(seconds, task, route.key, outcome)
+    tracer.record(
+        f"llm.{task}", seconds, "client",
+        {"llm.provider": route.provider, "llm.model": route.model},
+        error="" if outcome == "ok" else outcome,
+    )
+
+
+model_router = ModelRouter(AI_MODEL_ROUTES, _breaker_from_env, observer=_observe_llm_call)
+
+
+async def send_scan_message(api_key: str, session_id: str, system_message: str, user_message: UserMessage) -> str:
+    """Send a text scan prompt to the best available model, hedging slow calls if enabled."""
+    attempts = 0
+
+    def attempt(route: ModelRoute):
+        nonlocal attempts
+        attempts += 1
+        chat = ChatClient(
+            api_key=api_key,
+            session_id=session_id if attempts == 1 else f"{session_id}_{attempts}",
+            system_message=system_message
+        ).with_model(route.provider, route.model)
+        return chat.send_message(user_message)
+
+    with tracer.span("ai.scan.route", attributes={"session_id": session_id}) as span:
+        response, route = await model_router.call("scan", attempt, hedge=AI_HEDGE_ENABLED)
+        span.set("llm.model", route.key)
+    logger.info(f"AI scan {session_id} answered by {route.key}")
+    return response
+
+
+@api_router.get("/ai/models")
+async def get_ai_model_stats():
+    """Rolling latency, error rate and breaker state per (task, provider, model)."""
+    return {"provider": AI_PROVIDER, "routes": model_router.snapshot()}
+
+
+# ==================== AI USAGE & QUOTAS ====================
+
+# Daily limits count calls that reach the provider (cache hits are free); 0 disables a limit.
+usage_tracker = UsageTracker(
+    db.ai_usage,
+    daily_limits={
+        "ip": int(os.environ.get('AI_DAILY_QUOTA_PER_IP', '200')),
+        "user": int(os.environ.get('AI_DAILY_QUOTA_PER_USER', '50')),
+        "shop": int(os.environ.get('AI_DAILY_QUOTA_PER_SHOP', '1000')),
+    },
+    rate_per_minute=float(os.environ.get('AI_RATE_PER_MINUTE', '10')),
+    burst=int(os.environ.get('AI_RATE_BURST', '5')),
+)
+AI_USAGE_FLUSH_SECONDS = float(os.environ.get('AI_USAGE_FLUSH_SECONDS', '10'))
+AI_RESULT_CACHE_SECONDS = int(os.environ.get('AI_RESULT_CACHE_SECONDS', '600'))
+# Number of reverse proxies in front of the app that append to X-Forwarded-For;
+# 0 bills AI calls to the connecting address, which is then the proxy's.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+
+
+def client_ip(http_request: Request) -> str:
+    """The caller's address, taken from X-Forwarded-For behind TRUSTED_PROXY_COUNT proxies.
+
+    Each trusted proxy appends the address it received the request from, so the
+    client is that many entries from the right; anything further left was sent
+    by the client and can't be trusted.
+    """
+    peer = http_request.client.host if http_request.client else "unknown"
+    if TRUSTED_PROXY_COUNT:
+        forwarded = [part.strip() for part in http_request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_COUNT:
+            return forwarded[-TRUSTED_PROXY_COUNT]
+    return peer
+
+
+def ai_usage_subjects(body: BaseModel, http_request: Request) -> Dict[str, str]:
+    """Who an AI call is billed to: always the client IP, plus the user and shop when given.
+
+    The IP comes first so the rate limit applies to it; `user_id` and `shop_id`
+    come from the request body, so a client can make up new ones on every call.
+    """
+    subjects = {"ip": client_ip(http_request)}
+    user_id = getattr(body, "user_id", None)
+    if user_id:
+        subjects["user"] = user_id
+    shop_id = getattr(body, "shop_id", None)
+    if shop_id:
+        subjects["shop"] = shop_id
+    return subjects
+
+
+def track_ai_usage(endpoint: str, cache_key=None, cache_size: int = 256, on_cache_hit=None):
+    """Enforce AI quotas, account usage and serve repeated requests from a short-lived cache.
+
+    `cache_key(body)` returns the key for identical requests (e.g. the same photo
+    submitted twice); successful, non-fallback responses are reused for
+    AI_RESULT_CACHE_SECONDS without calling the provider again. The endpoint's
+    own side effects don't run then, so `await on_cache_hit(body, response)`
+    repeats the ones the caller should still see (e.g. the scan history).
+    """
+    result_cache = TTLCache(maxsize=cache_size, ttl=AI_RESULT_CACHE_SECONDS) if cache_key else None
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            body = kwargs["request"]
+            subjects = ai_usage_subjects(body, kwargs["http_request"])
+            image = getattr(body, "image_base64", None) or getattr(body, "user_image_base64", None) or ""
+            started = time.perf_counter()
+
+            key = cache_key(body) if result_cache is not None else None
+            cached = result_cache.get(key) if key is not None else None
+            if cached is not None:
+                if on_cache_hit is not None:
+                    await on_cache_hit(body, cached)
+                usage_tracker.record(subjects, endpoint, ok=True, latency=time.perf_counter() - started,
+                                     bytes_in=len(image), cache_hit=True)
+                return cached
+
+            try:
+                await usage_tracker.check(subjects)
+            except QuotaExceeded as e:
+                logger.warning(f"AI quota exceeded ({e.reason}) for {subjects} on {endpoint}")
+                detail = ("Demasiadas solicitudes de IA, espera unos segundos" if e.reason == "rate"
+                          else "Alcanzaste el límite diario de análisis con IA")
+                raise HTTPException(status_code=429, detail=detail,
+                                    headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+            # Errors and fallbacks (provider unavailable) give the daily quota back.
+            ok = False
+            AI_IN_FLIGHT.inc()
+            try:
+                response = await func(*args, **kwargs)
+                ok = getattr(response, "success", True) and not getattr(response, "fallback", False)
+            finally:
+                AI_IN_FLIGHT.dec()
+                usage_tracker.record(subjects, endpoint, ok=ok, latency=time.perf_counter() - started, bytes_in=len(image))
+                if not ok:
+                    usage_tracker.release(subjects)
+            if key is not None and ok:
+                result_cache[key] = response
+            return response
+        return wrapper
+    return decorator
+
+
+def _image_digest(*parts: Optional[str]) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@api_router.get("/ai/usage")
+async def get_ai_usage(scope: str = "user", scope_id: str = "", day: Optional[str] = None):
+    """AI usage for a user/shop/ip on a UTC day (YYYY-MM-DD, defaults to today)."""
+    if scope not in ("user", "shop", "ip") or not scope_id:
+        raise HTTPException(status_code=400, detail="Indica scope (user, shop o ip) y scope_id")
+    return await usage_tracker.usage(scope, scope_id, day)
+
+
 class AIScanRequest(BaseModel):
     image_base64: str  # Base64 encoded image
     user_id: Optional[str] = None
+    shop_id: Optional[str] = None
 
 class AIScanResponse(BaseModel):
     success: bool
     face_shape: Optional[str] = None
     recommendations: List[str] = Field(default_factory=list)
     detailed_analysis: Optional[str] = None
+    fallback: bool = False  # True when served from defaults because the AI provider is unavailable
     error: Optional[str] = None
 
+async def save_scan_history(request: AIScanRequest, result: AIScanResponse) -> None:
+    """Store a scan result in the user's history"""
+    if not request.user_id:
+        return
+    await db.ai_scans.insert_one({
+        "scan_id": f"scan_{uuid.uuid4().hex[:12]}",
+        "user_id": request.user_id,
+        "face_shape": result.face_shape,
+        "recommendations": result.recommendations,
+        "detailed_analysis": result.detailed_analysis,
+        "created_at": datetime.now(timezone.utc)
+    })
+
 @api_router.post("/ai-scan", response_model=AIScanResponse)
-async def analyze_face_for_haircut(request: AIScanRequest):
+@track_ai_usage("ai-scan", cache_key=lambda body: _image_digest(body.image_base64), on_cache_hit=save_scan_history)
+async def analyze_face_for_haircut(request: AIScanRequest, http_request: Request):
     """
     Analyzes a face image using Gemini 2.5 Flash to recommend haircut styles.
     """
     try:
         # Get Emergent LLM key
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        api_key = get_llm_api_key()
         if not api_key:
             logger.error("EMERGENT_LLM_KEY not found in environment")
             return AIScanResponse(
@@ -1117,83 +2913,54 @@ ANÁLISIS_DETALLADO:
 CONSEJOS_ADICIONALES:
 [1-2 tips de styling o mantenimiento]"""
 
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=system_message
-        ).with_model("gemini", "gemini-2.5-flash")
-        
         # Create image content
         image_content = ImageContent(image_base64=image_data)
-        
+
         # Create user message with image
         user_message = UserMessage(
             text="Analiza esta foto de mi rostro y recomiéndame los mejores estilos de corte de cabello que complementen mis rasgos faciales. Proporciona al menos 3 recomendaciones específicas.",
             file_contents=[image_content]
         )
-        
+
         # Send message to Gemini
-        response = await chat.send_message(user_message)
+        response = await send_scan_message(api_key, session_id, system_message, user_message)
         
         # Parse the response
         face_shape = None
         recommendations = []
         detailed_analysis = None
-        
+
         if response:
-            lines = response.split('\n')
-            current_section = None
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                if line.startswith('FORMA_DEL_ROSTRO:'):
-                    face_shape = line.replace('FORMA_DEL_ROSTRO:', '').strip()
-                elif line.startswith('RECOMENDACIONES:'):
-                    current_section = 'recommendations'
-                elif line.startswith('ANÁLISIS_DETALLADO:'):
-                    current_section = 'analysis'
-                    detailed_analysis = ''
-                elif line.startswith('CONSEJOS_ADICIONALES:'):
-                    current_section = 'tips'
-                elif current_section == 'recommendations' and (line.startswith(('1.', '2.', '3.', '4.', '5.', '-', '•'))):
-                    # Clean the recommendation
-                    rec = line.lstrip('0123456789.-•) ').strip()
-                    if rec:
-                        recommendations.append(rec)
-                elif current_section == 'analysis':
-                    detailed_analysis = (detailed_analysis or '') + line + ' '
-            
+            with tracer.span("ai.scan.parse"):
+                parsed = parse_scan_response(response)
+            face_shape = parsed.face_shape
+            recommendations = [style.raw for style in parsed.styles]
+            detailed_analysis = parsed.detailed_analysis
+
             # If parsing didn't work well, use the full response
             if not recommendations:
                 recommendations = [response[:500] if len(response) > 500 else response]
-            
-            if detailed_analysis:
-                detailed_analysis = detailed_analysis.strip()
-        
+
         logger.info(f"AI Scan completed successfully for session {session_id}")
         
-        # Store the scan result in database for history
-        if request.user_id:
-            scan_record = {
-                "scan_id": f"scan_{uuid.uuid4().hex[:12]}",
-                "user_id": request.user_id,
-                "face_shape": face_shape,
-                "recommendations": recommendations,
-                "detailed_analysis": detailed_analysis,
-                "created_at": datetime.now(timezone.utc)
-            }
-            await db.ai_scans.insert_one(scan_record)
-        
-        return AIScanResponse(
+        result = AIScanResponse(
             success=True,
             face_shape=face_shape,
             recommendations=recommendations,
             detailed_analysis=detailed_analysis
         )
-        
+
+        # Store the scan result in database for history
+        await save_scan_history(request, result)
+        return result
+
+    except CircuitOpenError as e:
+        logger.warning(f"AI scan served from defaults: {e}")
+        return AIScanResponse(
+            success=True,
+            recommendations=[f"{style.name} - {style.description}" for style in default_haircut_styles()],
+            fallback=True
+        )
     except Exception as e:
         logger.error(f"Error in AI scan: {str(e)}")
         return AIScanResponse(
@@ -1225,33 +2992,166 @@ HAIRCUT_REFERENCE_IMAGES = {
     "default": "https://images.unsplash.com/photo-1622286342621-4bd786c2447c?w=400"
 }
 
-def get_reference_image_for_style(style_name: str) -> str:
+# Style keywords compiled once; on multiple hits the first key in the dict wins.
+_REFERENCE_STYLE_PRIORITY = {key: index for index, key in enumerate(HAIRCUT_REFERENCE_IMAGES) if key != "default"}
+_REFERENCE_STYLE_RE = re.compile("|".join(re.escape(key) for key in _REFERENCE_STYLE_PRIORITY))
+
+# Reference images are prefetched into GridFS at startup and served from
+# /api/reference-images so clients don't hit Unsplash on every scan result.
+# URLs carry the stored original's GridFS id as `v`, so a replaced image gets
+# a new URL; only requests for the current version are cached as immutable.
+REFERENCE_IMAGE_WIDTHS = (96, 200, 400)
+REFERENCE_IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REFERENCE_IMAGE_REVALIDATE_CACHE_CONTROL = "public, max-age=300"
+reference_images_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="reference_images")
+_reference_image_cache: Dict[tuple, tuple] = {}  # (style, width, version) -> (bytes, etag)
+_reference_image_locks: Dict[tuple, asyncio.Lock] = defaultdict(asyncio.Lock)
+_reference_versions: Dict[str, str] = {}  # style -> GridFS id of its full-size image
+
+
+@lru_cache(maxsize=512)
+def match_reference_style(style_name: str) -> str:
+    """Map a free-form haircut name to a HAIRCUT_REFERENCE_IMAGES key."""
+    matches = _REFERENCE_STYLE_RE.findall(style_name.lower())
+    if not matches:
+        return "default"
+    return min(matches, key=_REFERENCE_STYLE_PRIORITY.__getitem__)
+
+def get_reference_image_for_style(style_name: str, base_url: Optional[str] = None) -> str:
     """Get reference image URL based on haircut style name"""
-    style_lower = style_name.lower()
-    for key, url in HAIRCUT_REFERENCE_IMAGES.items():
-        if key in style_lower:
-            return url
-    return HAIRCUT_REFERENCE_IMAGES["default"]
+    key = match_reference_style(style_name)
+    if base_url is not None and key in _reference_versions:
+        return f"{base_url.rstrip('/')}/api/reference-images/{key}?v={_reference_versions[key]}"
+    return HAIRCUT_REFERENCE_IMAGES[key]
+
+
+def _resize_reference_image(data: bytes, width: int) -> bytes:
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("RGB")
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=85, optimize=True)
+        return output.getvalue()
+
+
+async def _reference_version(style: str) -> Optional[str]:
+    """GridFS id of the latest full-size image stored for `style`."""
+    version = _reference_versions.get(style)
+    if version is None:
+        files = await reference_images_bucket.find(
+            {"filename": f"{style}/{REFERENCE_IMAGE_WIDTHS[-1]}"}, sort=[("uploadDate", -1)], limit=1
+        ).to_list(1)
+        if files:
+            version = _reference_versions[style] = str(files[0]["_id"])
+    return version
+
+
+async def _read_reference_blob(filename: str) -> Optional[bytes]:
+    try:
+        stream = await reference_images_bucket.open_download_stream_by_name(filename)
+    except NoFile:
+        return None
+    return await stream.read()
+
+
+async def prefetch_reference_images():
+    """Download every reference image once and store the full-size copy in GridFS."""
+    downloaded: Dict[str, bytes] = {}
+    async with httpx.AsyncClient(timeout=15, follow_redirects=True) as client_httpx:
+        for key, url in HAIRCUT_REFERENCE_IMAGES.items():
+            filename = f"{key}/{REFERENCE_IMAGE_WIDTHS[-1]}"
+            try:
+                if await _reference_version(key) is None:
+                    if url not in downloaded:
+                        response = await client_httpx.get(url)
+                        response.raise_for_status()
+                        downloaded[url] = await asyncio.to_thread(
+                            _resize_reference_image, response.content, REFERENCE_IMAGE_WIDTHS[-1]
+                        )
+                    file_id = await reference_images_bucket.upload_from_stream(
+                        filename, downloaded[url], metadata={"style": key, "source_url": url}
+                    )
+                    _reference_versions[key] = str(file_id)
+            except Exception as e:
+                logger.warning(f"Could not prefetch reference image '{key}': {e}")
+    logger.info(f"Reference images cached: {len(_reference_versions)}/{len(HAIRCUT_REFERENCE_IMAGES)}")
+
+
+@api_router.get("/reference-images/{style}")
+async def get_reference_image(
+    style: str,
+    w: int = REFERENCE_IMAGE_WIDTHS[-1],
+    v: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    """Serve a cached (and optionally resized) reference image for a haircut style."""
+    if style not in HAIRCUT_REFERENCE_IMAGES:
+        raise HTTPException(status_code=404, detail="Estilo no encontrado")
+    # Snap to a known width so the number of variants stays bounded
+    width = next((size for size in REFERENCE_IMAGE_WIDTHS if size >= w), REFERENCE_IMAGE_WIDTHS[-1])
+    version = await _reference_version(style)
+    if version is None:
+        # Not prefetched (yet): let the client go to the source
+        return RedirectResponse(HAIRCUT_REFERENCE_IMAGES[style], status_code=307)
+
+    key = (style, width, version)
+    cached = _reference_image_cache.get(key)
+    if cached is None:
+        # One resize and upload per variant, however many requests arrive first.
+        async with _reference_image_locks[key]:
+            cached = _reference_image_cache.get(key)
+            if cached is None:
+                original_name = f"{style}/{REFERENCE_IMAGE_WIDTHS[-1]}"
+                variant_name = original_name if width == REFERENCE_IMAGE_WIDTHS[-1] else f"{style}/{width}@{version}"
+                data = await _read_reference_blob(variant_name)
+                if data is None:
+                    original = await _read_reference_blob(original_name)
+                    if original is None:
+                        return RedirectResponse(HAIRCUT_REFERENCE_IMAGES[style], status_code=307)
+                    data = await asyncio.to_thread(_resize_reference_image, original, width)
+                    await reference_images_bucket.upload_from_stream(
+                        variant_name, data, metadata={"style": style, "version": version}
+                    )
+                cached = _reference_image_cache[key] = (data, f'"{hashlib.md5(data).hexdigest()}"')
+
+    data, etag = cached
+    cache_control = REFERENCE_IMAGE_CACHE_CONTROL if v == version else REFERENCE_IMAGE_REVALIDATE_CACHE_CONTROL
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="image/jpeg", headers=headers)
 
 class HaircutStyle(BaseModel):
     name: str
     description: str
     reference_image: Optional[str] = None
 
+def default_haircut_styles(base_url: Optional[str] = None) -> List[HaircutStyle]:
+    """Generic recommendations used when the AI response can't be parsed or the provider is down."""
+    return [
+        HaircutStyle(name="Fade Clásico", description="Un corte versátil que funciona con la mayoría de formas de rostro", reference_image=get_reference_image_for_style("fade", base_url)),
+        HaircutStyle(name="Undercut Moderno", description="Estilo contemporáneo que añade estructura", reference_image=get_reference_image_for_style("undercut", base_url)),
+        HaircutStyle(name="Texturizado", description="Añade volumen y movimiento natural", reference_image=get_reference_image_for_style("textured", base_url))
+    ]
+
 class AIScanResponseV2(BaseModel):
     success: bool
     face_shape: Optional[str] = None
     recommendations: List[HaircutStyle] = Field(default_factory=list)
     detailed_analysis: Optional[str] = None
+    fallback: bool = False
     error: Optional[str] = None
 
 @api_router.post("/ai-scan-v2", response_model=AIScanResponseV2)
-async def analyze_face_for_haircut_v2(request: AIScanRequest):
+@track_ai_usage("ai-scan-v2", cache_key=lambda body: _image_digest(body.image_base64))
+async def analyze_face_for_haircut_v2(request: AIScanRequest, http_request: Request):
     """
     Enhanced AI scan that includes reference images for each recommendation.
     """
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        api_key = get_llm_api_key()
         if not api_key:
             return AIScanResponseV2(success=False, error="Configuración de IA no disponible")
         
@@ -1259,6 +3159,7 @@ async def analyze_face_for_haircut_v2(request: AIScanRequest):
         if 'base64,' in image_data:
             image_data = image_data.split('base64,')[1]
         
+        base_url = str(http_request.base_url)
         session_id = f"ai_scan_v2_{uuid.uuid4().hex[:8]}"
         system_message = """Eres un experto estilista especializado en cortes de cabello para hombres.
 Analiza el rostro y proporciona recomendaciones en este formato EXACTO:
@@ -1279,75 +3180,46 @@ DESCRIPCION: [por qué funciona]
 
 ANALISIS: [análisis detallado de las características faciales]"""
 
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=system_message
-        ).with_model("gemini", "gemini-2.5-flash")
-        
         image_content = ImageContent(image_base64=image_data)
         user_message = UserMessage(
             text="Analiza mi rostro y recomiéndame 3 cortes de cabello ideales.",
             file_contents=[image_content]
         )
-        
-        response = await chat.send_message(user_message)
+
+        response = await send_scan_message(api_key, session_id, system_message, user_message)
         
         face_shape = None
         recommendations = []
         detailed_analysis = None
-        
+
         if response:
-            lines = response.split('\n')
-            current_cut = {}
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                if line.startswith('FORMA_DEL_ROSTRO:'):
-                    face_shape = line.replace('FORMA_DEL_ROSTRO:', '').strip()
-                elif line.startswith('CORTE_'):
-                    if current_cut.get('name'):
-                        ref_img = get_reference_image_for_style(current_cut['name'])
-                        recommendations.append(HaircutStyle(
-                            name=current_cut['name'],
-                            description=current_cut.get('description', ''),
-                            reference_image=ref_img
-                        ))
-                    current_cut = {}
-                elif line.startswith('NOMBRE:'):
-                    current_cut['name'] = line.replace('NOMBRE:', '').strip()
-                elif line.startswith('DESCRIPCION:'):
-                    current_cut['description'] = line.replace('DESCRIPCION:', '').strip()
-                elif line.startswith('ANALISIS:'):
-                    detailed_analysis = line.replace('ANALISIS:', '').strip()
-            
-            # Add last cut
-            if current_cut.get('name'):
-                ref_img = get_reference_image_for_style(current_cut['name'])
-                recommendations.append(HaircutStyle(
-                    name=current_cut['name'],
-                    description=current_cut.get('description', ''),
-                    reference_image=ref_img
-                ))
-        
-        # If parsing failed, create default recommendations
-        if not recommendations:
+            with tracer.span("ai.scan.parse"):
+                parsed = parse_scan_response(response)
+            face_shape = parsed.face_shape
+            detailed_analysis = parsed.detailed_analysis
             recommendations = [
-                HaircutStyle(name="Fade Clásico", description="Un corte versátil que funciona con la mayoría de formas de rostro", reference_image=HAIRCUT_REFERENCE_IMAGES["fade"]),
-                HaircutStyle(name="Undercut Moderno", description="Estilo contemporáneo que añade estructura", reference_image=HAIRCUT_REFERENCE_IMAGES["undercut"]),
-                HaircutStyle(name="Texturizado", description="Añade volumen y movimiento natural", reference_image=HAIRCUT_REFERENCE_IMAGES["textured"])
+                HaircutStyle(
+                    name=style.name,
+                    description=style.description,
+                    reference_image=get_reference_image_for_style(style.name, base_url)
+                )
+                for style in parsed.styles
             ]
-        
+
+        # If parsing failed, create default recommendations
+        if not recommendations:
+            recommendations = default_haircut_styles(base_url)
+
         return AIScanResponseV2(
             success=True,
             face_shape=face_shape,
             recommendations=recommendations,
             detailed_analysis=detailed_analysis
         )
-        
+
+    except CircuitOpenError as e:
+        logger.warning(f"AI scan v2 served from defaults: {e}")
+        return AIScanResponseV2(success=True, recommendations=default_haircut_styles(base_url), fallback=True)
     except Exception as e:
         logger.error(f"Error in AI scan v2: {str(e)}")
         return AIScanResponseV2(success=False, error=str(e))
@@ -1356,6 +3228,8 @@ class GenerateHaircutImageRequest(BaseModel):
     user_image_base64: str
     haircut_style: str
     additional_details: Optional[str] = None
+    user_id: Optional[str] = None
+    shop_id: Optional[str] = None
 
 class GenerateHaircutImageResponse(BaseModel):
     success: bool
@@ -1386,12 +3260,6 @@ CRITICAL RULES:
 - The result must look like the EXACT same person with a new haircut
 - Keep the same lighting, background, and photo quality"""
 
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=system_message
-        ).with_model("gemini", "gemini-2.5-flash-image-preview").with_params(modalities=["image", "text"])
-        
         # Create image content from base64
         image_content = ImageContent(image_base64=image_base64)
         
@@ -1417,7 +3285,18 @@ Output the edited image."""
         logger.info(f"Calling Gemini Nano Banana for haircut style: {haircut_style}")
         
         # Get response with image
-        text_response, images = await chat.send_message_multimodal_response(user_message)
+        def attempt(route: ModelRoute):
+            chat = ChatClient(
+                api_key=api_key,
+                session_id=session_id,
+                system_message=system_message
+            ).with_model(route.provider, route.model).with_params(modalities=["image", "text"])
+            return chat.send_message_multimodal_response(user_message)
+
+        with tracer.span("ai.image_edit.route", attributes={"session_id": session_id, "style": haircut_style}) as span:
+            (text_response, images), route = await model_router.call("image_edit", attempt)
+            span.set("llm.model", route.key)
+        logger.info(f"Hair edit {session_id} answered by {route.key}")
         
         logger.info(f"Gemini response - Text: {text_response[:100] if text_response else 'None'}...")
         logger.info(f"Gemini response - Images: {len(images) if images else 0}")
@@ -1433,7 +3312,9 @@ Output the edited image."""
                 
         logger.warning("No image returned from Gemini")
         return None
-        
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Error in edit_image_with_haircut_gemini: {str(e)}")
         import traceback
@@ -1441,13 +3322,18 @@ Output the edited image."""
         return None
 
 @api_router.post("/generate-haircut-image", response_model=GenerateHaircutImageResponse)
-async def generate_haircut_image(request: GenerateHaircutImageRequest):
+@track_ai_usage(
+    "generate-haircut-image",
+    cache_key=lambda body: _image_digest(body.user_image_base64, body.haircut_style, body.additional_details),
+    cache_size=16,
+)
+async def generate_haircut_image(request: GenerateHaircutImageRequest, http_request: Request):
     """
     Edit the user's photo to show them with a specific haircut style.
     Uses Gemini Nano Banana to preserve facial features and only change the hair.
     """
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        api_key = get_llm_api_key()
         if not api_key:
             return GenerateHaircutImageResponse(
                 success=False,
@@ -1480,7 +3366,13 @@ async def generate_haircut_image(request: GenerateHaircutImageRequest):
                 success=False,
                 error="No se pudo editar la imagen. Intenta con otra foto."
             )
-            
+
+    except CircuitOpenError as e:
+        logger.warning(f"Haircut image generation rejected: {e}")
+        return GenerateHaircutImageResponse(
+            success=False,
+            error="El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos."
+        )
     except Exception as e:
         logger.error(f"Error in generate_haircut_image: {str(e)}")
         return GenerateHaircutImageResponse(
@@ -1488,11 +3380,163 @@ async def generate_haircut_image(request: GenerateHaircutImageRequest):
             error=f"Error al procesar imagen: {str(e)}"
         )
 
+# ==================== METRICS & SLOW LOG ====================
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="No autorizado")
+
+# Slow log entries carry path and query parameters (user and shop ids, search terms).
+@api_router.get("/admin/slow-requests", dependencies=[Depends(require_admin_token)])
+async def list_slow_requests(
+    route: Optional[str] = None,
+    min_ms: float = 0,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Most recent slow requests with their slowest queries (and sampled plans)."""
+    return await slow_log.recent(route, min_ms, limit)
+
+@api_router.get("/admin/loop-blocks", dependencies=[Depends(require_admin_token)])
+async def list_loop_blocks():
+    """Most recent event-loop blocks with the stack that was running."""
+    return [
+        {
+            "site": blocked.site,
+            "task": blocked.task,
+            "ms": round(blocked.seconds * 1000, 1),
+            "stack": [f"{frame.filename}:{frame.lineno} {frame.name}" for frame in blocked.stack],
+        }
+        for blocked in reversed(loop_monitor.blocks)
+    ]
+
+@api_router.post("/admin/profile", dependencies=[Depends(require_admin_token)])
+async def run_profile(
+    seconds: float = Query(10, gt=0, le=300),
+    mode: str = "wall",
+    interval_ms: float = Query(10, ge=1, le=1000),
+    route: Optional[str] = None,
+    requests: int = Query(1, ge=1, le=1000)
+):
+    """Sample the event loop and return a collapsed-stack (flamegraph) profile.
+
+    Without `route` it samples for `seconds`. With `route` (a template such as
+    `/api/dashboard/stats`, or a literal path) it keeps only that route's
+    samples and stops after `requests` requests or `seconds`, whichever comes first.
+    """
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode debe ser uno de: {', '.join(PROFILE_MODES)}")
+    try:
+        session = await profiler.profile(seconds, mode, interval_ms / 1000, route, requests)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="Ya hay un perfilado en curso")
+    logger.info(f"Profiled {route or 'all requests'} ({mode}): {sum(session.samples.values())} weight, {session.requests} requests")
+    return Response(
+        session.collapsed(),
+        media_type="text/plain",
+        headers={"X-Profile-Mode": mode, "X-Profile-Requests": str(session.requests)},
+    )
+
+@api_router.post("/admin/profile/memory", dependencies=[Depends(require_admin_token)])
+async def run_memory_profile(
+    seconds: float = Query(10, gt=0, le=300),
+    top: int = Query(25, ge=1, le=200),
+    frames: int = Query(10, ge=1, le=50)
+):
+    """Biggest allocators (by traceback) of memory allocated and still held during `seconds`."""
+    try:
+        return await profiler.allocations(seconds, top, frames)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="Ya hay un perfilado en curso")
+
+@app.get("/health/live", include_in_schema=False)
+async def health_live():
+    """The process answers; also reports how late the event loop is running."""
+    return health.live()
+
+@app.get("/health/ready", include_in_schema=False)
+async def health_ready(response: Response):
+    """Mongo ping latency and saturation signals; 503 when this worker should be drained."""
+    ready, report = await health.ready()
+    if not ready:
+        response.status_code = 503
+    return report
+
+@app.get("/metrics", include_in_schema=False)
+async def export_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
 # Include router in app
 app.include_router(api_router)
 
+@app.on_event("startup")
+async def ensure_indexes():
+    indexes = [
+        # Keyset pagination: equality filters first, then the sort key and _id
+        (db.users, [("user_id", 1)], {"unique": True}),
+        (db.users, [("role", 1), ("_id", 1)], {}),
+        (db.users, [("email", 1)], {}),
+        (db.barbers, [("shop_id", 1), ("_id", 1)], {}),
+        (db.barbers, [("user_id", 1)], {}),
+        (db.services, [("shop_id", 1), ("_id", 1)], {}),
+        (db.appointments, [("scheduled_time", 1), ("_id", 1)], {}),
+        (db.appointments, [("client_user_id", 1), ("scheduled_time", 1), ("_id", 1)], {}),
+        (db.appointments, [("barber_id", 1), ("scheduled_time", 1), ("_id", 1)], {}),
+        (db.appointments, [("shop_id", 1), ("scheduled_time", 1), ("_id", 1)], {}),
+        (db.appointments, [("appointment_id", 1)], {"unique": True}),
+        # Recurring series: exceptions found by slot, series by their owners
+        (db.appointments, [("series_id", 1), ("occurrence_time", 1)], {"sparse": True}),
+        (db.appointment_series, [("series_id", 1)], {"unique": True}),
+        (db.appointment_series, [("client_user_id", 1), ("_id", 1)], {}),
+        (db.appointment_series, [("barber_id", 1), ("_id", 1)], {}),
+        (db.appointment_series, [("shop_id", 1), ("_id", 1)], {}),
+        (db.client_history, [("client_user_id", 1), ("created_at", -1), ("_id", -1)], {}),
+        (db.ai_usage, [("scope", 1), ("scope_id", 1), ("day", 1), ("endpoint", 1)], {"unique": True}),
+        # Delta sync: change log scanned by time, expired after the retention window
+        (db.change_log, [("at", 1), ("_id", 1)], {}),
+        (db.change_log, [("audience", 1), ("at", 1)], {}),
+        (db.change_log, [("at", 1)], {"expireAfterSeconds": SYNC_RETENTION_DAYS * 86400, "name": "change_log_ttl"}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Could not create index {keys} on {collection.name}: {e}")
+
+@app.on_event("startup")
+async def ensure_slow_log():
+    if SLOW_LOG_ENABLED:
+        await slow_log.ensure_collection()
+
+# The event loop only keeps weak references to tasks; these keep them alive.
+_background_tasks: set = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Runs in the background so a slow image host never delays startup
+    start_background_task(prefetch_reference_images())
+    start_background_task(backfill_referral_codes())
+    start_background_task(usage_tracker.run(AI_USAGE_FLUSH_SECONDS))
+    start_background_task(change_feed.run())
+    start_background_task(loop_monitor.run())
+    if TRACING_ENABLED:
+        start_background_task(tracer.run(TRACE_EXPORT_SECONDS))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await usage_tracker.flush()
+    await tracer.flush()
     client.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+"""
+Structured log of slow requests and the MongoDB queries they ran.
+
+`SlowRequestMiddleware` runs inside `DbAccountingMiddleware`, so it sees the
+per-request call log (see db_accounting.py). A request is recorded when it
+takes longer than `slow_request_ms`, or when any of its queries takes longer
+than `slow_query_ms`. The record holds the route, its parameters, the status,
+and the slowest queries with their filter *shape*: values are replaced by
+their type, so the log carries no client data and similar queries look alike.
+
+For a sample of records, the slowest query is re-run through `explain`
+(queryPlanner verbosity, so it is planned but not executed). The winning plan
+is summarised as its stages and index, which shows at a glance whether an
+index was used. Records are written off the request path, as one JSON log
+line and as a document in a capped collection that the admin endpoint reads.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from db_accounting import DbCall, current_calls
+from tracing import current_span
+
+logger = logging.getLogger(__name__)
+
+# Commands that `explain` accepts, and the fields the driver adds that it doesn't.
+EXPLAINABLE = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+_DRIVER_FIELDS = {"$db", "lsid", "$clusterTime", "$readPreference", "txnNumber", "readConcern", "writeConcern", "cursor"}
+_SHAPE_DEPTH = 6
+
+
+def value_shape(value: Any, depth: int = 0) -> Any:
+    """`value` with every scalar replaced by its type name."""
+    if depth > _SHAPE_DEPTH:
+        return "..."
+    if isinstance(value, dict):
+        return {key: value_shape(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Lists of scalars ($in, $nin) collapse to one element.
+        shapes = []
+        for item in value:
+            shape = value_shape(item, depth + 1)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return type(value).__name__
+
+
+def command_shape(command_name: str, spec: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """The parts of a command that decide its plan, with values elided."""
+    if not spec:
+        return {}
+    if command_name == "find":
+        return {key: value_shape(spec[key]) for key in ("filter", "sort", "limit") if key in spec}
+    if command_name == "aggregate":
+        stages = []
+        for stage in spec.get("pipeline", []):
+            name = next(iter(stage), "")
+            stages.append({name: value_shape(stage[name])} if name in ("$match", "$sort") else name)
+        return {"pipeline": stages}
+    if command_name in ("count", "distinct"):
+        return {"query": value_shape(spec.get("query", {}))}
+    if command_name == "findAndModify":
+        return {"query": value_shape(spec.get("query", {}))}
+    if command_name in ("update", "delete"):
+        key = "updates" if command_name == "update" else "deletes"
+        statements = spec.get(key) or [{}]
+        return {"q": value_shape(statements[0].get("q", {})), "statements": len(statements)}
+    if command_name == "insert":
+        return {"documents": len(spec.get("documents", []))}
+    return {}
+
+
+def plan_summary(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Stages and index names of the winning plan; `collscan` when no index was used."""
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        # Aggregations report the planner per stage.
+        for stage in explain.get("stages", []):
+            cursor = stage.get("$cursor")
+            if cursor:
+                planner = cursor.get("queryPlanner")
+                break
+    plan = (planner or {}).get("winningPlan", {})
+    stages: List[str] = []
+    indexes: List[str] = []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if not isinstance(node, dict):
+            continue
+        if "stage" in node:
+            stages.append(node["stage"])
+        if node.get("indexName"):
+            indexes.append(node["indexName"])
+        pending.extend(node.get(key) for key in ("inputStage", "queryPlan") if key in node)
+        pending.extend(node.get("inputStages", []))
+    return {"stages": stages, "indexes": indexes, "collscan": "COLLSCAN" in stages}
+
+
+def explain_command(call: DbCall) -> Optional[Dict[str, Any]]:
+    if call.command not in EXPLAINABLE or not call.spec:
+        return None
+    command = {key: value for key, value in call.spec.items() if key not in _DRIVER_FIELDS}
+    if call.command == "aggregate":
+        command["cursor"] = {}
+    return {"explain": command, "verbosity": "queryPlanner"}
+
+
+class SlowLog:
+    """Decides what is slow, shapes the record and stores it."""
+
+    def __init__(
+        self,
+        db,
+        collection_name: str = "slow_log",
+        slow_request_ms: float = 500,
+        slow_query_ms: float = 100,
+        explain_sample: float = 0.1,
+        max_queries: int = 20,
+        capped_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.db = db
+        self.collection_name = collection_name
+        self.slow_request_ms = slow_request_ms
+        self.slow_query_ms = slow_query_ms
+        self.explain_sample = explain_sample
+        self.max_queries = max_queries
+        self.capped_bytes = capped_bytes
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    async def ensure_collection(self) -> None:
+        """Create the capped collection once; an existing one is left as is."""
+        try:
+            if self.collection_name not in await self.db.list_collection_names():
+                await self.db.create_collection(self.collection_name, capped=True, size=self.capped_bytes)
+        except Exception as e:
+            logger.warning(f"Could not create capped collection {self.collection_name}: {e}")
+
+    def is_slow(self, duration_ms: float, calls: List[DbCall]) -> bool:
+        if self.slow_request_ms and duration_ms >= self.slow_request_ms:
+            return True
+        return bool(self.slow_query_ms) and any(call.seconds * 1000 >= self.slow_query_ms for call in calls)
+
+    def build(self, scope, status: int, duration_ms: float, calls: List[DbCall]) -> Dict[str, Any]:
+        slowest = sorted(calls, key=lambda call: call.seconds, reverse=True)[: self.max_queries]
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        span = current_span()
+        return {
+            "at": datetime.now(timezone.utc),
+            "trace_id": span.trace_id if span is not None and span.recording else None,
+            "method": scope.get("method"),
+            "route": getattr(scope.get("route"), "path", None) or "unmatched",
+            "path": scope.get("path"),
+            "path_params": {key: str(value) for key, value in (scope.get("path_params") or {}).items()},
+            "query_params": params,
+            "status": status,
+            "duration_ms": round(duration_ms, 1),
+            "db_calls": len(calls),
+            "db_ms": round(sum(call.seconds for call in calls) * 1000, 1),
+            "db_documents": sum(call.documents for call in calls),
+            "queries": [
+                {
+                    "collection": call.collection,
+                    "command": call.command,
+                    "ms": round(call.seconds * 1000, 2),
+                    "documents": call.documents,
+                    "ok": call.ok,
+                    "shape": command_shape(call.command, call.spec),
+                    "slow": bool(self.slow_query_ms) and call.seconds * 1000 >= self.slow_query_ms,
+                }
+                for call in slowest
+            ],
+        }
+
+    async def write(self, entry: Dict[str, Any], slowest: Optional[DbCall] = None) -> None:
+        """Log and store `entry`, adding the plan of `slowest` when sampled."""
+        if slowest is not None and entry["queries"] and random.random() < self.explain_sample:
+            command = explain_command(slowest)
+            if command is not None:
+                try:
+                    entry["queries"][0]["plan"] = plan_summary(await self.db.command(command))
+                except Exception as e:
+                    entry["queries"][0]["plan"] = {"error": str(e)}
+        logger.warning(f"Slow request {json.dumps(entry, default=str)}")
+        try:
+            await self.collection.insert_one(dict(entry))
+        except Exception as e:
+            logger.warning(f"Could not store slow request: {e}")
+
+    async def recent(self, route: Optional[str] = None, min_ms: float = 0, limit: int = 50) -> List[dict]:
+        query: Dict[str, Any] = {}
+        if route:
+            query["route"] = route
+        if min_ms:
+            query["duration_ms"] = {"$gte": min_ms}
+        return await self.collection.find(query, {"_id": 0}).sort("at", -1).to_list(limit)
+
+
+class SlowRequestMiddleware:
+    """ASGI middleware feeding slow HTTP requests to a `SlowLog`.
+
+    Add it before `DbAccountingMiddleware` so it runs inside it and sees the
+    request's database calls.
+    """
+
+    def __init__(self, app, slow_log: SlowLog):
+        self.app = app
+        self.slow_log = slow_log
+        self._writes = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        streaming = False
+
+        async def send_with_status(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = any(
+                    name.lower() == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", [])
+                )
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            calls = list(current_calls().calls) if current_calls() else []
+            # Event streams stay open by design; they are not slow requests.
+            if not streaming and self.slow_log.is_slow(duration_ms, calls):
+                entry = self.slow_log.build(scope, status, duration_ms, calls)
+                slowest = max(calls, key=lambda call: call.seconds) if calls else None
+                # A fresh context keeps the explain out of this request's accounting.
+                task = asyncio.create_task(self.slow_log.write(entry, slowest), context=contextvars.Context())
+                self._writes.add(task)
+                task.add_done_callback(self._writes.discard)
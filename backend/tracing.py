@@ -0,0 +1,310 @@
+"""
+Lightweight span tracing with an OTLP/JSON exporter.
+
+The current span lives in a context variable. asyncio tasks copy the context
+when they are created, and so does Motor when it hands an operation to its
+executor thread, so spans nest across `await`, `asyncio.gather` and database
+calls without passing anything around.
+
+- `TracingMiddleware` opens one server span per HTTP request. It continues an
+  incoming W3C `traceparent` and echoes it back on the response.
+- `Tracer.span()` wraps any block in a child span.
+- `Tracer.record()` adds an already-finished span. The MongoDB command
+  listener and the LLM router observer use it because they only learn the
+  duration once the call is over.
+
+Finished spans are buffered and exported in batches by `Tracer.run()`.
+`OtlpFileExporter` appends one OTLP/JSON `TracesData` object per line, the
+format the OpenTelemetry Collector's file exporter writes and its
+`otlpjsonfile` receiver reads. `OtlpHttpExporter` POSTs the same payload to an
+OTLP/HTTP endpoint (`.../v1/traces`). The sampling decision is taken once per
+trace; spans under an unsampled root are created but never recorded.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from pymongo import monitoring
+
+from db_accounting import command_collection
+
+logger = logging.getLogger(__name__)
+
+# OTLP SpanKind values
+KINDS = {"internal": 1, "server": 2, "client": 3}
+# OTLP status codes
+STATUS_OK, STATUS_ERROR = 1, 2
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str] = None
+    kind: str = "internal"
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    status: int = 0
+    status_message: str = ""
+    recording: bool = True
+
+    def set(self, key: str, value: Any) -> None:
+        if self.recording and value is not None:
+            self.attributes[key] = value
+
+    def fail(self, error: BaseException) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.recording else '00'}"
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """(trace_id, parent_span_id, sampled) from a W3C `traceparent` header."""
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], sampled
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _attributes(values: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _attribute_value(value)} for key, value in values.items()]
+
+
+def otlp_payload(spans: List[Span], service_name: str) -> Dict[str, Any]:
+    """OTLP/JSON `TracesData` for a batch of finished spans."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": _attributes({"service.name": service_name})},
+        "scopeSpans": [{
+            "scope": {"name": "barbershop.tracing"},
+            "spans": [
+                {
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    **({"parentSpanId": span.parent_span_id} if span.parent_span_id else {}),
+                    "name": span.name,
+                    "kind": KINDS.get(span.kind, 1),
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                    "attributes": _attributes(span.attributes),
+                    "status": {"code": span.status, **({"message": span.status_message} if span.status_message else {})},
+                }
+                for span in spans
+            ],
+        }],
+    }]}
+
+
+class OtlpFileExporter:
+    def __init__(self, path: str):
+        self.path = path
+
+    def _append(self, line: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(line + "\n")
+
+    async def export(self, payload: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._append, json.dumps(payload, separators=(",", ":")))
+
+
+class OtlpHttpExporter:
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    async def export(self, payload: Dict[str, Any]) -> None:
+        # The export itself must not be traced.
+        token = _current.set(None)
+        try:
+            async with httpx.AsyncClient(timeout=self.timeout) as client:
+                response = await client.post(self.endpoint, json=payload)
+                response.raise_for_status()
+        finally:
+            _current.reset(token)
+
+
+class Tracer:
+    def __init__(self, exporter, service_name: str, sample_rate: float = 1.0, max_buffer: int = 10000):
+        self.exporter = exporter
+        self.service_name = service_name
+        self.sample_rate = sample_rate
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._finished: List[Span] = []
+
+    def _new_span(self, name: str, kind: str, parent: Optional[Span], attributes: Optional[Dict[str, Any]]) -> Span:
+        if parent is not None:
+            trace_id, parent_id, recording = parent.trace_id, parent.span_id, parent.recording
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+            recording = random.random() < self.sample_rate
+        span = Span(name, trace_id, secrets.token_hex(8), parent_id, kind, recording=recording)
+        if recording and attributes:
+            span.attributes.update({key: value for key, value in attributes.items() if value is not None})
+        return span
+
+    def _finish(self, span: Span) -> None:
+        if not span.recording:
+            return
+        if len(self._finished) >= self.max_buffer:
+            self.dropped += 1
+            return
+        # list.append is atomic, so spans may finish on executor threads.
+        self._finished.append(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None, parent: Optional[Span] = None) -> Iterator[Span]:
+        """Run a block inside a child of the current span (or a new trace)."""
+        span = self._new_span(name, kind, parent or _current.get(), attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span)
+
+    def remote_parent(self, traceparent: Optional[str]) -> Optional[Span]:
+        """A stand-in parent for a span continued from another service."""
+        parsed = parse_traceparent(traceparent)
+        if parsed is None:
+            return None
+        trace_id, span_id, sampled = parsed
+        return Span("remote", trace_id, span_id, recording=sampled)
+
+    def record(self, name: str, seconds: float, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None, error: str = "") -> None:
+        """Add a finished child of the current span that took `seconds`.
+
+        Does nothing outside a trace, so background work doesn't start traces.
+        """
+        parent = _current.get()
+        if parent is None or not parent.recording:
+            return
+        span = self._new_span(name, kind, parent, attributes)
+        span.end_ns = time.time_ns()
+        span.start_ns = span.end_ns - int(seconds * 1e9)
+        if error:
+            span.status, span.status_message = STATUS_ERROR, error
+        self._finish(span)
+
+    async def flush(self) -> int:
+        if not self._finished:
+            return 0
+        batch, self._finished = self._finished, []
+        try:
+            await self.exporter.export(otlp_payload(batch, self.service_name))
+        except Exception as e:
+            logger.warning(f"Could not export {len(batch)} spans: {e}")
+            return 0
+        return len(batch)
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a server span per HTTP request."""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        parent = self.tracer.remote_parent(headers.get(b"traceparent", b"").decode("latin-1"))
+        method = scope.get("method", "")
+        with self.tracer.span(method, "server", {"http.method": method, "http.target": scope.get("path")}, parent) as span:
+
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    span.set("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.status = STATUS_ERROR
+                    message["headers"] = list(message.get("headers", [])) + [(b"traceparent", span.traceparent.encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    span.name = f"{method} {route}"
+                    span.set("http.route", route)
+
+
+class MongoTracingListener(monitoring.CommandListener):
+    """Adds a client span per MongoDB command issued inside a trace."""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event) -> None:
+        span = _current.get()
+        if span is not None and span.recording:
+            self._collections[(event.connection_id, event.request_id)] = command_collection(event.command_name, event.command)
+
+    def succeeded(self, event) -> None:
+        self._finish(event, "")
+
+    def failed(self, event) -> None:
+        self._finish(event, str(event.failure.get("errmsg", "")) if isinstance(event.failure, dict) else "failed")
+
+    def _finish(self, event, error: str) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        self.tracer.record(
+            f"mongodb.{event.command_name}",
+            event.duration_micros / 1e6,
+            "client",
+            {"db.system": "mongodb", "db.operation": event.command_name, "db.mongodb.collection": collection},
+            error,
+        )
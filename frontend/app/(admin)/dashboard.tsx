@@ -1,4 +1,4 @@
-import React, { useCallback, useEffect, useMemo, useState } from 'react';
+import React, { useCallback, useEffect, useMemo, useRef, useState } from 'react';
 import { View, Text, StyleSheet, ScrollView, RefreshControl, ActivityIndicator, TouchableOpacity } from 'react-native';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { Ionicons } from '@expo/vector-icons';
@@ -45,6 +45,25 @@ interface RecentAppointment {
   status: string;
 }
 
+const normalizeStats = (payload: any): DashboardStats => ({
+  totalAppointments: payload?.total_appointments ?? 0,
+  todayAppointments: payload?.today_appointments ?? 0,
+  completedAppointments: payload?.completed_appointments ?? 0,
+  totalBarbers: payload?.total_barbers ?? 0,
+  revenueToday: payload?.revenue_today ?? 0,
+  ticketAverage: payload?.ticket_average ?? 0,
+  occupancyRate: payload?.occupancy_rate ?? null,
+  capacity: payload?.capacity ?? null,
+  statusBreakdown: payload?.status_breakdown ?? {
+    scheduled: 0,
+    completed: 0,
+    cancelled: 0,
+    in_progress: 0,
+  },
+  topServices: payload?.top_services ?? [],
+  lastUpdated: payload?.last_updated,
+});
+
 export default function AdminDashboardScreen() {
   const { user } = useAuth();
   const [stats, setStats] = useState<DashboardStats | null>(null);
@@ -53,6 +72,14 @@ export default function AdminDashboardScreen() {
   const [refreshing, setRefreshing] = useState(false);
   const [error, setError] = useState<string | null>(null);
   const [shopName, setShopName] = useState<string>('');
+  const [shopId, setShopId] = useState<string | null>(null);
+  const rawStats = useRef<any>(null);
+
+  const applyPayload = (payload: any) => {
+    rawStats.current = payload;
+    setStats(normalizeStats(payload));
+    setRecentAppointments(payload?.recent_appointments ?? []);
+  };
 
   const loadDashboardData = useCallback(async () => {
     setError(null);
@@ -74,29 +101,8 @@ export default function AdminDashboardScreen() {
         params: { shop_id: shop.shop_id }
       });
 
-      const payload = statsResponse.data;
-
-      const normalized: DashboardStats = {
-        totalAppointments: payload?.total_appointments ?? 0,
-        todayAppointments: payload?.today_appointments ?? 0,
-        completedAppointments: payload?.completed_appointments ?? 0,
-        totalBarbers: payload?.total_barbers ?? 0,
-        revenueToday: payload?.revenue_today ?? 0,
-        ticketAverage: payload?.ticket_average ?? 0,
-        occupancyRate: payload?.occupancy_rate ?? null,
-        capacity: payload?.capacity ?? null,
-        statusBreakdown: payload?.status_breakdown ?? {
-          scheduled: 0,
-          completed: 0,
-          cancelled: 0,
-          in_progress: 0,
-        },
-        topServices: payload?.top_services ?? [],
-        lastUpdated: payload?.last_updated,
-      };
-
-      setStats(normalized);
-      setRecentAppointments(payload?.recent_appointments ?? []);
+      setShopId(shop.shop_id);
+      applyPayload(statsResponse.data);
     } catch (error: any) {
       console.error('Error loading dashboard data:', error);
       setError('No pudimos cargar el panel de métricas. Desliza para reintentar.');
@@ -115,6 +121,21 @@ export default function AdminDashboardScreen() {
     loadDashboardData();
   }, [loadDashboardData]);
 
+  useEffect(() => {
+    // Live deltas where EventSource exists (web); native keeps pull-to-refresh
+    if (!shopId || !BACKEND_URL || typeof EventSource === 'undefined') return;
+
+    const source = new EventSource(`${BACKEND_URL}/api/dashboard/stream?shop_id=${shopId}`);
+    source.addEventListener('stats', (message: MessageEvent) => {
+      applyPayload(JSON.parse(message.data));
+    });
+    source.addEventListener('delta', (message: MessageEvent) => {
+      const event = JSON.parse(message.data);
+      applyPayload({ ...rawStats.current, ...event.changes, last_updated: event.last_updated });
+    });
+    return () => source.close();
+  }, [shopId]);
+
   const onRefresh = () => {
     setRefreshing(true);
     loadDashboardData();
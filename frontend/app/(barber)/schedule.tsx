@@ -18,60 +18,80 @@ interface Appointment {
   scheduled_time: string;
   status: string;
   notes?: string;
+  client_name?: string;
+  service_name?: string;
+  service_duration?: number;
 }
 
 export default function BarberScheduleScreen() {
   const { user } = useAuth();
   const [appointments, setAppointments] = useState<Appointment[]>([]);
+  const [barberId, setBarberId] = useState<string | null>(null);
   const [barberStatus, setBarberStatus] = useState('available');
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
     if (user) {
-      loadBarberData();
-      loadAppointments();
+      loadAgenda();
     }
   }, [user]);
 
-  const loadBarberData = async () => {
-    try {
-      // Get barber profile
-      const response = await axios.get(`${BACKEND_URL}/api/barbers?user_id=${user?.user_id}`);
-      if (response.data && response.data.length > 0) {
-        setBarberStatus(response.data[0].status || 'available');
-      }
-    } catch (error) {
-      console.error('Error loading barber data:', error);
-    }
-  };
+  useEffect(() => {
+    if (!barberId || !BACKEND_URL) return;
+
+    // Live updates: refetch the agenda when an appointment changes instead of polling
+    let socket: WebSocket | null = null;
+    let retry: ReturnType<typeof setTimeout> | null = null;
+    let closed = false;
 
-  const loadAppointments = async () => {
+    const connect = () => {
+      socket = new WebSocket(`${BACKEND_URL.replace(/^http/, 'ws')}/api/ws/schedule?barber_id=${barberId}`);
+      socket.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.type === 'resync' || event.collection === 'appointments' || event.collection === 'appointment_series') {
+          loadAgenda();
+        } else if (event.collection === 'barbers' && event.data?.status) {
+          setBarberStatus(event.data.status);
+        }
+      };
+      socket.onclose = () => {
+        if (!closed) {
+          retry = setTimeout(connect, 5000);
+        }
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      if (retry) clearTimeout(retry);
+      socket?.close();
+    };
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [barberId]);
+
+  const loadAgenda = async () => {
     try {
-      // Get barber's appointments
-      const barberResponse = await axios.get(`${BACKEND_URL}/api/barbers?user_id=${user?.user_id}`);
-      if (barberResponse.data && barberResponse.data.length > 0) {
-        const barberId = barberResponse.data[0].barber_id;
-        const appointmentsResponse = await axios.get(
-          `${BACKEND_URL}/api/appointments?barber_id=${barberId}&status=scheduled`
-        );
-        setAppointments(appointmentsResponse.data);
-      }
+      // Barber profile and upcoming appointments in a single request
+      const response = await axios.get(`${BACKEND_URL}/api/barbers/me/agenda`, {
+        params: { user_id: user?.user_id, status: 'scheduled' },
+      });
+      setBarberId(response.data.barber.barber_id);
+      setBarberStatus(response.data.barber.status || 'available');
+      setAppointments(response.data.appointments);
     } catch (error) {
-      console.error('Error loading appointments:', error);
+      console.error('Error loading agenda:', error);
     } finally {
       setLoading(false);
     }
   };
 
   const updateStatus = async (newStatus: string) => {
+    if (!barberId) return;
     try {
-      const barberResponse = await axios.get(`${BACKEND_URL}/api/barbers?user_id=${user?.user_id}`);
-      if (barberResponse.data && barberResponse.data.length > 0) {
-        const barberId = barberResponse.data[0].barber_id;
-        await axios.put(`${BACKEND_URL}/api/barbers/${barberId}`, { status: newStatus });
-        setBarberStatus(newStatus);
-        Alert.alert('Éxito', `Estado actualizado a ${newStatus}`);
-      }
+      await axios.put(`${BACKEND_URL}/api/barbers/${barberId}`, { status: newStatus });
+      setBarberStatus(newStatus);
+      Alert.alert('Éxito', `Estado actualizado a ${newStatus}`);
     } catch (error) {
       Alert.alert('Error', 'No se pudo actualizar el estado');
     }
@@ -161,6 +181,14 @@ export default function BarberScheduleScreen() {
             {format(appointmentDate, "EEEE, d MMM", { locale: es })}
           </Text>
         </View>
+        {item.client_name && (
+          <Text style={styles.notes}>Cliente: {item.client_name}</Text>
+        )}
+        {item.service_name && (
+          <Text style={styles.notes}>
+            {item.service_name}{item.service_duration ? ` · ${item.service_duration} min` : ''}
+          </Text>
+        )}
         {item.notes && (
           <Text style={styles.notes}>Notas: {item.notes}</Text>
         )}
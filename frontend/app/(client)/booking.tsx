@@ -100,6 +100,8 @@ interface Barbershop {
   shop_id: string;
   name: string;
   address: string;
+  services: Service[];
+  barbers: Barber[];
 }
 
 export default function BookingScreen() {
@@ -174,11 +176,12 @@ export default function BookingScreen() {
         return;
       }
 
-      const response = await axios.get(`${BACKEND_URL}/api/barbershops`);
-      setBarbershops(response.data);
+      // Shops come with their services and barbers, so later steps need no requests
+      const response = await axios.get(`${BACKEND_URL}/api/bootstrap/booking`);
+      setBarbershops(response.data.shops);
 
       if (params.shop_id) {
-        const shop = response.data.find((s: Barbershop) => s.shop_id === params.shop_id);
+        const shop = response.data.shops.find((s: Barbershop) => s.shop_id === params.shop_id);
         if (shop) {
           setSelectedShop(shop);
           setStep(2);
@@ -192,22 +195,11 @@ export default function BookingScreen() {
     }
   };
 
-  const loadServicesAndBarbers = async () => {
+  const loadServicesAndBarbers = () => {
     if (!selectedShop) return;
 
-    try {
-      const [servicesRes, barbersRes] = await Promise.all([
-        axios.get(`${BACKEND_URL}/api/services`, { params: { shop_id: selectedShop.shop_id } }),
-        axios.get(`${BACKEND_URL}/api/barbers`, { params: { shop_id: selectedShop.shop_id } }),
-      ]);
-
-      setServices(servicesRes.data);
-      setBarbers(barbersRes.data.filter((b: Barber) => b.status === 'available'));
-    } catch (error) {
-      console.error('Error loading services/barbers:', error);
-      setServices([]);
-      setBarbers([]);
-    }
+    setServices(selectedShop.services);
+    setBarbers(selectedShop.barbers.filter((b: Barber) => b.status === 'available'));
   };
 
   const handleConfirmBooking = async () => {
@@ -40,26 +40,13 @@ export default function ClientHomeScreen() {
 
   const loadData = async () => {
     try {
-      const [shopsRes, apptsRes] = await Promise.all([
-        axios.get(`${BACKEND_URL}/api/barbershops`),
-        user
-          ? axios.get(`${BACKEND_URL}/api/appointments`, {
-              params: { client_user_id: user.user_id, status: 'scheduled' }
-            })
-          : Promise.resolve({ data: [] })
-      ]);
+      // Shops and upcoming appointments in a single round trip
+      const response = await axios.get(`${BACKEND_URL}/api/bootstrap/booking`, {
+        params: user ? { user_id: user.user_id } : {}
+      });
 
-      setBarbershops(shopsRes.data);
-
-      if (apptsRes.data.length > 0) {
-        const sorted = apptsRes.data.sort(
-          (a: Appointment, b: Appointment) =>
-            new Date(a.scheduled_time).getTime() - new Date(b.scheduled_time).getTime()
-        );
-        setNextAppointment(sorted[0]);
-      } else {
-        setNextAppointment(null);
-      }
+      setBarbershops(response.data.shops);
+      setNextAppointment(response.data.upcoming_appointments[0] ?? null);
     } catch (error) {
       console.error('Error loading data:', error);
     } finally {